@@ -0,0 +1,829 @@
+"""
+Module for benchmarking mbloodmoon reconstruction routines.
+"""
+
+import os
+from pathlib import Path
+import tempfile
+from time import perf_counter
+from timeit import repeat
+import tracemalloc
+from unittest import mock
+
+from astropy.io import fits
+import numpy as np
+from scipy.signal import convolve
+from scipy.signal import correlate
+from scipy.stats import binned_statistic_2d
+
+from mbloodmoon import chop
+from mbloodmoon import codedmask
+from mbloodmoon import count
+from mbloodmoon import count_cube
+from mbloodmoon import count_stream
+from mbloodmoon import decode
+from mbloodmoon import decode_batch
+from mbloodmoon import decode_tiled
+from mbloodmoon import decode_window
+from mbloodmoon import IncrementalReconstructor
+from mbloodmoon import index_events
+from mbloodmoon import model_sky
+from mbloodmoon import prefetch
+from mbloodmoon import products
+from mbloodmoon import ProductWriter
+from mbloodmoon import reconstruct
+from mbloodmoon import simulation
+from mbloodmoon import snratio
+from mbloodmoon import variance
+from mbloodmoon.backend import _shift_add
+from mbloodmoon.backend import configure
+from mbloodmoon.catalog import CatalogWriter
+from mbloodmoon.io import simulation_files
+from mbloodmoon.mask import _fold
+from mbloodmoon.mask import model_shadowgram
+from mbloodmoon.optim import _load_checkpoint
+from mbloodmoon.optim import _save_checkpoint
+from mbloodmoon.optim import component_cache_clear
+from mbloodmoon.optim import component_cache_info
+from mbloodmoon.optim import optimize
+from mbloodmoon.psflib import build_psf_library
+from mbloodmoon.psflib import check_psf_library
+from mbloodmoon.psflib import PSFLIB_TOLERANCE
+from mbloodmoon.types import UpscaleFactor
+
+
+def timeit_best(f, number: int = 5, rep: int = 3) -> float:
+    """Best-of-`rep` average time over `number` calls to `f`, in seconds."""
+    return min(repeat(f, number=number, repeat=rep)) / number
+
+
+def peak_memory(f) -> int:
+    """Peak memory allocated by a call to `f`, in bytes."""
+    tracemalloc.start()
+    f()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+def _decode_reference(camera, detector):
+    """`decode` as computed by direct `scipy.signal.correlate` calls."""
+    cc = correlate(camera.decoder, detector, mode="full")
+    return cc - camera.balancing * np.sum(detector) / np.sum(camera.bulk)
+
+
+def _variance_reference(camera, detector):
+    """`variance` as computed by direct `scipy.signal.correlate` calls."""
+    cc = correlate(camera.decoder, detector, mode="full")
+    var = correlate(np.square(camera.decoder), detector, mode="full")
+    sum_det, sum_bulk = np.sum(detector), np.sum(camera.bulk)
+    return var + np.square(camera.balancing) * sum_det / np.square(sum_bulk) - 2 * cc * camera.balancing / sum_bulk
+
+
+def bench_decode(mask_filepath: str,
+                 upscale_x: int = 5,
+                 upscale_y: int = 1,
+                 ) -> dict:
+    """Compares `decode` and `variance` against per-call `scipy.signal.correlate`."""
+    wfm = codedmask(mask_filepath, upscale_x=upscale_x, upscale_y=upscale_y)
+    detector = np.random.default_rng(0).poisson(5.0, wfm.detector_shape).astype(float)
+    # first calls populate the camera's spectra caches.
+    sky, var = decode(wfm, detector), variance(wfm, detector)
+
+    results = {
+        "decode_reference": timeit_best(lambda: _decode_reference(wfm, detector)),
+        "decode": timeit_best(lambda: decode(wfm, detector)),
+        "variance_reference": timeit_best(lambda: _variance_reference(wfm, detector)),
+        "variance": timeit_best(lambda: variance(wfm, detector)),
+        "decode_maxerr": float(np.max(np.abs(sky - _decode_reference(wfm, detector)))),
+        "variance_maxerr": float(np.max(np.abs(var - _variance_reference(wfm, detector)))),
+    }
+
+    print(f"### decode/variance, upscale ({upscale_x}, {upscale_y}), sky shape {wfm.sky_shape}")
+    for name in ["decode", "variance"]:
+        t_ref, t = results[f"{name}_reference"], results[name]
+        print(f"{name}: {t_ref * 1e3:.2f} ms -> {t * 1e3:.2f} ms "
+              f"(x{t_ref / t:.2f}, max abs err {results[f'{name}_maxerr']:.1e})")
+    return results
+
+
+def bench_reconstruct(mask_filepath: str,
+                      upscale_x: int = 5,
+                      upscale_y: int = 1,
+                      ) -> dict:
+    """Compares fused `reconstruct` against `decode`, `variance` and `snratio` calls."""
+    wfm = codedmask(mask_filepath, upscale_x=upscale_x, upscale_y=upscale_y)
+    detector = np.random.default_rng(0).poisson(5.0, wfm.detector_shape).astype(float)
+    _ = reconstruct(wfm, detector)
+
+    def separate():
+        sky, var = decode(wfm, detector), variance(wfm, detector)
+        return sky, var, snratio(sky, var)
+
+    results = {
+        "separate": timeit_best(separate),
+        "reconstruct": timeit_best(lambda: reconstruct(wfm, detector)),
+    }
+    print(f"### reconstruct, upscale ({upscale_x}, {upscale_y}), sky shape {wfm.sky_shape}")
+    print(f"decode + variance + snratio: {results['separate'] * 1e3:.2f} ms -> "
+          f"reconstruct: {results['reconstruct'] * 1e3:.2f} ms "
+          f"(x{results['separate'] / results['reconstruct']:.2f})")
+    return results
+
+
+def bench_decode_batch(mask_filepath: str,
+                       upscale_x: int = 5,
+                       upscale_y: int = 1,
+                       batchsize: int = 32,
+                       workers: int = -1,
+                       ) -> dict:
+    """Compares per-image throughput of `decode_batch` against a loop of `decode` calls."""
+    wfm = codedmask(mask_filepath, upscale_x=upscale_x, upscale_y=upscale_y)
+    detectors = np.random.default_rng(0).poisson(5.0, (batchsize, *wfm.detector_shape)).astype(float)
+    _ = decode(wfm, detectors[0])
+
+    results = {
+        "loop": timeit_best(lambda: [decode(wfm, d) for d in detectors], number=1) / batchsize,
+        "batch": timeit_best(lambda: decode_batch(wfm, detectors, workers=workers), number=1) / batchsize,
+    }
+    print(f"### decode_batch, upscale ({upscale_x}, {upscale_y}), {batchsize} images, workers {workers}")
+    print(f"per image: {results['loop'] * 1e3:.2f} ms -> {results['batch'] * 1e3:.2f} ms "
+          f"(x{results['loop'] / results['batch']:.2f})")
+    return results
+
+
+def bench_upscale_engine(mask_filepath: str,
+                         upscales: tuple = ((5, 1), (8, 1), (16, 1), (4, 4)),
+                         ) -> dict:
+    """Compares the "fft" and "upscale" correlation engines over a range of upscale factors."""
+    results = {}
+    print("### correlation engines")
+    for upscale_x, upscale_y in upscales:
+        for engine in ["fft", "upscale"]:
+            with configure(engine=engine):
+                wfm = codedmask(mask_filepath, upscale_x=upscale_x, upscale_y=upscale_y)
+                detector = np.random.default_rng(0).poisson(5.0, wfm.detector_shape).astype(float)
+                _ = decode(wfm, detector)
+                results[(upscale_x, upscale_y, engine)] = timeit_best(lambda: decode(wfm, detector))
+        t_fft, t_up = results[(upscale_x, upscale_y, "fft")], results[(upscale_x, upscale_y, "upscale")]
+        print(f"upscale ({upscale_x}, {upscale_y}): fft {t_fft * 1e3:.2f} ms, upscale {t_up * 1e3:.2f} ms "
+              f"(x{t_fft / t_up:.2f})")
+    return results
+
+
+def report_float32_accuracy(mask_filepath: str,
+                            upscale_x: int = 5,
+                            upscale_y: int = 1,
+                            ) -> dict:
+    """Compares reconstruction products of single and double precision cameras.
+    Errors are reported relative to the maximum absolute value of the double precision product."""
+    wfm64 = codedmask(mask_filepath, upscale_x=upscale_x, upscale_y=upscale_y)
+    wfm32 = codedmask(mask_filepath, upscale_x=upscale_x, upscale_y=upscale_y, dtype=np.float32)
+    detector = np.random.default_rng(0).poisson(5.0, wfm64.detector_shape).astype(float)
+    bins = wfm64.bins_sky
+    shift_x, shift_y = bins.x[len(bins.x) // 3] + 0.01, bins.y[len(bins.y) // 2]
+
+    products64 = dict(zip(["sky", "variance", "snr"], reconstruct(wfm64, detector)))
+    products32 = dict(zip(["sky", "variance", "snr"], reconstruct(wfm32, detector)))
+    products64["model_sky"] = model_sky(wfm64, shift_x, shift_y, 1000.0)
+    products32["model_sky"] = model_sky(wfm32, shift_x, shift_y, 1000.0)
+
+    results = {}
+    print(f"### float32 vs float64, upscale ({upscale_x}, {upscale_y}), sky shape {wfm64.sky_shape}")
+    for name, a64 in products64.items():
+        a32 = products32[name]
+        finite = np.isfinite(a64)
+        delta = np.abs(a32[finite].astype(np.float64) - a64[finite])
+        scale = np.max(np.abs(a64[finite]))
+        results[name] = {
+            "max_rel_err": float(np.max(delta) / scale),
+            "rms_rel_err": float(np.sqrt(np.mean(np.square(delta))) / scale),
+            "argmax_match": bool(
+                np.argmax(np.where(finite, a32, -np.inf)) == np.argmax(np.where(finite, a64, -np.inf))
+            ),
+            "megabytes": (a64.nbytes / 1e6, a32.nbytes / 1e6),
+        }
+        r = results[name]
+        print(f"{name}: max rel err {r['max_rel_err']:.1e}, rms rel err {r['rms_rel_err']:.1e}, "
+              f"same argmax {r['argmax_match']}, {r['megabytes'][0]:.1f} MB -> {r['megabytes'][1]:.1f} MB")
+    t64 = timeit_best(lambda: reconstruct(wfm64, detector))
+    t32 = timeit_best(lambda: reconstruct(wfm32, detector))
+    print(f"reconstruct: {t64 * 1e3:.2f} ms -> {t32 * 1e3:.2f} ms (x{t64 / t32:.2f})")
+    return results
+
+
+def bench_workers(mask_filepath: str,
+                  upscale_x: int = 5,
+                  upscale_y: int = 1,
+                  workers: tuple = (1, 2, 4, 8, -1),
+                  ) -> dict:
+    """Times `reconstruct` and `model_sky` over a range of FFT worker threads."""
+    results = {}
+    print(f"### fft workers, upscale ({upscale_x}, {upscale_y})")
+    for n in workers:
+        with configure(workers=n):
+            wfm = codedmask(mask_filepath, upscale_x=upscale_x, upscale_y=upscale_y)
+            detector = np.random.default_rng(0).poisson(5.0, wfm.detector_shape).astype(float)
+            shift_x, shift_y = wfm.bins_sky.x[len(wfm.bins_sky.x) // 3] + 0.01, wfm.bins_sky.y[1] + 0.01
+            _ = reconstruct(wfm, detector)
+            results[n] = {
+                "reconstruct": timeit_best(lambda: reconstruct(wfm, detector)),
+                "model_sky": timeit_best(lambda: model_sky(wfm, shift_x, shift_y, 1.0)),
+            }
+        print(f"workers {n}: reconstruct {results[n]['reconstruct'] * 1e3:.2f} ms, "
+              f"model_sky {results[n]['model_sky'] * 1e3:.2f} ms")
+    return results
+
+
+def bench_convolve(mask_filepath: str,
+                   upscales: tuple = ((1, 1), (5, 1), (8, 2)),
+                   kernels: tuple = ((2, 1), (4, 1), (8, 1), (16, 1), (4, 4), (8, 8)),
+                   ) -> dict:
+    """Compares shifting and adding against FFT and SciPy direct convolution of the mask with small kernels,
+    such as the `psfy` one. Justifies the backend `_DIRECT_MAX_SIZE`."""
+    rng = np.random.default_rng(0)
+    results = {}
+    print("### small kernel convolution")
+    for upscale_x, upscale_y in upscales:
+        wfm = codedmask(mask_filepath, upscale_x=upscale_x, upscale_y=upscale_y)
+        mask = np.asarray(wfm.mask, dtype=float)
+        for shape in kernels:
+            kernel = rng.random(shape)
+            r = {
+                "shift_add": timeit_best(lambda: _shift_add(mask, kernel, "same")),
+                "fft": timeit_best(lambda: convolve(mask, kernel, mode="same", method="fft")),
+                "direct": timeit_best(lambda: convolve(mask, kernel, mode="same", method="direct")),
+            }
+            results[(upscale_x, upscale_y), shape] = r
+            print(f"upscale ({upscale_x}, {upscale_y}), mask {mask.shape}, kernel {shape}: "
+                  f"shift-add {r['shift_add'] * 1e3:.2f} ms, fft {r['fft'] * 1e3:.2f} ms, "
+                  f"direct {r['direct'] * 1e3:.2f} ms")
+    return results
+
+
+def bench_sparse(mask_filepath: str,
+                 upscale_x: int = 5,
+                 upscale_y: int = 1,
+                 events: tuple = (10, 30, 100, 300, 1000),
+                 ) -> dict:
+    """Compares sparse and FFT `decode` over detector images with a growing number of events.
+    Reports the crossover in units of the backend "sparse" configuration value."""
+    wfm = codedmask(mask_filepath, upscale_x=upscale_x, upscale_y=upscale_y)
+    rng = np.random.default_rng(0)
+    results = {}
+    print(f"### sparse decode, upscale ({upscale_x}, {upscale_y}), sky shape {wfm.sky_shape}")
+    for n in events:
+        detector = np.zeros(wfm.detector_shape)
+        np.add.at(detector.ravel(), rng.integers(0, detector.size, n), 1.0)
+        fill_factor = np.count_nonzero(detector) / detector.size
+        with configure(sparse=0.0):
+            _ = decode(wfm, detector)
+            t_fft = timeit_best(lambda: decode(wfm, detector))
+        with configure(sparse=float("inf")):
+            t_sparse = timeit_best(lambda: decode(wfm, detector))
+        results[n] = {"fill_factor": fill_factor, "fft": t_fft, "sparse": t_sparse}
+        print(f"{n} events, fill factor {fill_factor:.1e}: fft {t_fft * 1e3:.2f} ms, "
+              f"sparse {t_sparse * 1e3:.2f} ms (x{t_fft / t_sparse:.2f})")
+
+    # sparse decoding cost is linear in the number of non-zero pixels.
+    per_pixel = min(r["sparse"] / (r["fill_factor"] * wfm.detector_shape[0] * wfm.detector_shape[1])
+                    for r in results.values())
+    t_fft = min(r["fft"] for r in results.values())
+    crossover = t_fft / per_pixel / (wfm._sparse_fill_factor * wfm.detector_shape[0] * wfm.detector_shape[1])
+    results["crossover"] = crossover
+    print(f"measured crossover: sparse={crossover:.2f}")
+    return results
+
+
+def bench_decode_window(mask_filepath: str,
+                        upscale_x: int = 5,
+                        upscale_y: int = 1,
+                        widths: tuple = (32, 64, 96, 128, 256),
+                        ) -> dict:
+    """Compares `decode_window` over a `chop` window against a full `decode`, as in the optimizer's coarse step.
+    Then times its direct and FFT correlations over windows of growing width, and reports their crossover
+    in units of `mask._DECODE_WINDOW_DIRECT`."""
+    wfm = codedmask(mask_filepath, upscale_x=upscale_x, upscale_y=upscale_y)
+    pos = (wfm.sky_shape[0] // 2, wfm.sky_shape[1] // 3)
+    shadowgram = model_shadowgram(wfm, wfm.bins_sky.x[pos[1]], wfm.bins_sky.y[pos[0]], 1.0)
+    window, _ = chop(wfm, pos)
+    min_i, max_i, min_j, max_j = window
+    _ = decode(wfm, shadowgram)
+
+    results = {
+        "decode": timeit_best(lambda: decode(wfm, shadowgram)),
+        "decode_window": timeit_best(lambda: decode_window(wfm, shadowgram, window)),
+        "maxerr": float(np.max(np.abs(
+            decode_window(wfm, shadowgram, window) - decode(wfm, shadowgram)[min_i:max_i, min_j:max_j]
+        ))),
+    }
+    print(f"### decode_window, upscale ({upscale_x}, {upscale_y}), window {window}")
+    print(f"decode: {results['decode'] * 1e3:.2f} ms -> decode_window: {results['decode_window'] * 1e3:.2f} ms "
+          f"(x{results['decode'] / results['decode_window']:.2f}, max abs err {results['maxerr']:.1e})")
+
+    # direct correlation cost is linear in `window area * detector size`, FFT cost in `L * log2(L)`.
+    # narrow windows overestimate the direct cost per multiply-add, which has a fixed overhead.
+    crossovers = []
+    for width in widths:
+        window = (min_i, max_i, pos[1] - width // 2, pos[1] - width // 2 + width)
+        area = (max_i - min_i) * width
+        # same as `decode_window`, the sizes of the decoder block and of the detector.
+        (nb, mb) = wfm.detector_shape
+        fft_size = (max_i - min_i + nb - 1) * (width + mb - 1) + shadowgram.size
+        with mock.patch("mbloodmoon.mask._DECODE_WINDOW_DIRECT", float("inf")):
+            t_direct = timeit_best(lambda: decode_window(wfm, shadowgram, window))
+        with mock.patch("mbloodmoon.mask._DECODE_WINDOW_DIRECT", 0.0):
+            t_fft = timeit_best(lambda: decode_window(wfm, shadowgram, window))
+        crossover = t_fft / (t_direct / (area * shadowgram.size)) / (fft_size * np.log2(fft_size))
+        crossovers.append(crossover)
+        results[width] = {"direct": t_direct, "fft": t_fft, "crossover": crossover}
+        print(f"window {window}: direct {t_direct * 1e3:.2f} ms, fft {t_fft * 1e3:.2f} ms, "
+              f"crossover {crossover:.1f}")
+    results["crossover"] = float(np.median(crossovers))
+    print(f"measured crossover: {results['crossover']:.1f}")
+    return results
+
+
+def bench_decode_tiled(mask_filepath: str,
+                       upscale_x: int = 16,
+                       upscale_y: int = 2,
+                       budgets: tuple = (2**26, 2**24, 2**22),
+                       ) -> dict:
+    """Compares time and peak memory of `decode_tiled` over a range of memory budgets against `decode`."""
+    wfm = codedmask(mask_filepath, upscale_x=upscale_x, upscale_y=upscale_y)
+    detector = np.random.default_rng(0).poisson(5.0, wfm.detector_shape).astype(float)
+    _ = wfm.balancing, wfm._rfft_decoder
+    sky = decode(wfm, detector)
+    out = np.empty(wfm.sky_shape, dtype=wfm.dtype)
+
+    results = {
+        "decode": (timeit_best(lambda: decode(wfm, detector), number=1), peak_memory(lambda: decode(wfm, detector))),
+    }
+    print(f"### decode_tiled, upscale ({upscale_x}, {upscale_y}), sky shape {wfm.sky_shape}, "
+          f"sky size {sky.nbytes / 2**20:.1f} MiB")
+    print(f"decode: {results['decode'][0] * 1e3:.2f} ms, peak {results['decode'][1] / 2**20:.1f} MiB")
+    for budget in budgets:
+        def f():
+            return decode_tiled(wfm, detector, max_memory=budget, out=out)
+        results[budget] = (timeit_best(f, number=1), peak_memory(f))
+        maxerr = float(np.max(np.abs(f() - sky)))
+        print(f"decode_tiled, budget {budget / 2**20:.1f} MiB: {results[budget][0] * 1e3:.2f} ms, "
+              f"peak {results[budget][1] / 2**20:.1f} MiB, max abs err {maxerr:.1e}")
+    return results
+
+
+def bench_camera_cache(mask_filepath: str,
+                       upscale_x: int = 5,
+                       upscale_y: int = 1,
+                       ) -> dict:
+    """Compares camera set-up time, up to the balancing array, with and without the on-disk cache."""
+    def setup(cache_dir=None):
+        wfm = codedmask(mask_filepath, upscale_x=upscale_x, upscale_y=upscale_y, cache_dir=cache_dir)
+        return wfm.mask, wfm.decoder, wfm.bulk, wfm.balancing, wfm.bins_sky
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        setup(cache_dir)
+        results = {
+            "nocache": timeit_best(setup, number=1),
+            "cache": timeit_best(lambda: setup(cache_dir), number=1),
+        }
+    print(f"### camera cache, upscale ({upscale_x}, {upscale_y})")
+    print(f"set-up: {results['nocache'] * 1e3:.2f} ms -> {results['cache'] * 1e3:.2f} ms "
+          f"(x{results['nocache'] / results['cache']:.2f})")
+    return results
+
+
+def bench_fold(mask_filepath: str) -> dict:
+    """Compares the mask rasterizer `_fold` against `scipy.stats.binned_statistic_2d`."""
+    wfm = codedmask(mask_filepath)
+    bins = wfm._bins_mask(UpscaleFactor(1, 1))
+    results = {}
+    print(f"### fold, mask shape {wfm.mask_shape}")
+    for name in ["mask", "decoder", "bulk"]:
+        ml = getattr(wfm.mdl, name)
+        t_ref = timeit_best(
+            lambda: binned_statistic_2d(ml["X"], ml["Y"], ml["VAL"], statistic="max", bins=[bins.x, bins.y])[0].T,
+            number=20,
+        )
+        t = timeit_best(lambda: _fold(ml, bins), number=20)
+        results[name] = {"binned_statistic_2d": t_ref, "fold": t}
+        print(f"{name}: {t_ref * 1e3:.2f} ms -> {t * 1e3:.2f} ms (x{t_ref / t:.2f})")
+    return results
+
+
+def bench_simulation_loading(simulation_filepath: str,
+                             mask_filepath: str,
+                             upscale_x: int = 5,
+                             upscale_y: int = 1,
+                             ) -> dict:
+    """Compares time and peak memory of counting all-column, column-projected and chunked photon events."""
+    wfm = codedmask(mask_filepath, upscale_x=upscale_x, upscale_y=upscale_y)
+
+    def all_columns():
+        return count(wfm, simulation(simulation_filepath).data)[0]
+
+    def projected():
+        return count(wfm, simulation(simulation_filepath, columns=("X", "Y")).data)[0]
+
+    def chunked():
+        return sum(count(wfm, c)[0] for c in simulation(simulation_filepath, columns=("X", "Y")).chunks(2**18))
+
+    results = {}
+    print(f"### simulation loading, {simulation(simulation_filepath).nevents} events")
+    for name, f in [("all columns", all_columns), ("projected", projected), ("chunked", chunked)]:
+        results[name] = (timeit_best(f, number=1), peak_memory(f))
+        print(f"{name}: {results[name][0] * 1e3:.2f} ms, peak {results[name][1] / 2**20:.1f} MiB")
+    return results
+
+
+def bench_count(simulation_filepath: str,
+                mask_filepath: str,
+                upscale_x: int = 5,
+                upscale_y: int = 1,
+                ) -> dict:
+    """Compares `count_stream` binning against `np.histogram2d` over the same events."""
+    wfm = codedmask(mask_filepath, upscale_x=upscale_x, upscale_y=upscale_y)
+    sdl = simulation(simulation_filepath, columns=("X", "Y"))
+    data, bins = sdl.data, wfm.bins_detector
+    expected, *_ = np.histogram2d(data["Y"], data["X"], bins=[bins.y, bins.x])
+
+    results = {
+        "histogram2d": timeit_best(lambda: np.histogram2d(data["Y"], data["X"], bins=[bins.y, bins.x]), number=1),
+        "count_stream": timeit_best(lambda: count_stream(wfm, (data,)), number=1),
+        "count_stream_chunks": timeit_best(lambda: count_stream(wfm, sdl.chunks(2**18)), number=1),
+        "match": bool(np.array_equal(count_stream(wfm, sdl.chunks(2**18))[0], expected)),
+    }
+    t_ref = results["histogram2d"]
+    print(f"### count, {sdl.nevents} events, detector shape {wfm.detector_shape}")
+    print(f"histogram2d: {t_ref * 1e3:.2f} ms -> count_stream: {results['count_stream'] * 1e3:.2f} ms "
+          f"(x{t_ref / results['count_stream']:.2f}), from file chunks: {results['count_stream_chunks'] * 1e3:.2f} ms, "
+          f"exact match {results['match']}")
+    return results
+
+
+def bench_count_cube(simulation_filepath: str,
+                     mask_filepath: str,
+                     upscale_x: int = 5,
+                     upscale_y: int = 1,
+                     ntime: int = 100,
+                     energy_edges: tuple = (2.0, 5.0, 10.0, 20.0, 50.0),
+                     ) -> dict:
+    """Compares `count_cube` against `count` calls over filtered copies of the events, for each window and band."""
+    wfm = codedmask(mask_filepath, upscale_x=upscale_x, upscale_y=upscale_y)
+    data = simulation(simulation_filepath, columns=("X", "Y", "TIME", "ENERGY")).data
+    time_edges = np.linspace(data["TIME"].min(), data["TIME"].max(), ntime + 1)
+
+    def filtered():
+        cube = []
+        for t0, t1 in zip(time_edges[:-1], time_edges[1:]):
+            in_time = (data["TIME"] >= t0) & (data["TIME"] < t1)
+            cube.append([
+                count(wfm, data[in_time & (data["ENERGY"] >= e0) & (data["ENERGY"] < e1)])[0]
+                for e0, e1 in zip(energy_edges[:-1], energy_edges[1:])
+            ])
+        return cube
+
+    events = index_events(wfm, data)
+    results = {
+        "filtered": timeit_best(filtered, number=1, rep=1),
+        "count_cube": timeit_best(lambda: count_cube(wfm, data, time_edges, energy_edges), number=1),
+        "count_cube_indexed": timeit_best(lambda: count_cube(wfm, events, time_edges, energy_edges), number=1),
+    }
+    print(f"### count_cube, {len(data)} events, {ntime} time windows, {len(energy_edges) - 1} energy bands")
+    print(f"filtered count: {results['filtered'] * 1e3:.2f} ms -> count_cube: {results['count_cube'] * 1e3:.2f} ms "
+          f"(x{results['filtered'] / results['count_cube']:.2f}), "
+          f"re-sliced from index: {results['count_cube_indexed'] * 1e3:.2f} ms")
+    return results
+
+
+def bench_incremental(simulation_filepath: str,
+                      mask_filepath: str,
+                      upscale_x: int = 5,
+                      upscale_y: int = 1,
+                      packets: tuple = (10, 100, 1000, 10000),
+                      exposure: int = 1_000_000,
+                      ) -> dict:
+    """Compares per-packet latency of `IncrementalReconstructor` against re-counting and re-decoding all events."""
+    wfm = codedmask(mask_filepath, upscale_x=upscale_x, upscale_y=upscale_y)
+    data = simulation(simulation_filepath, columns=("X", "Y")).data[:exposure + max(packets)]
+    live = IncrementalReconstructor(wfm)
+    live.add_events(data[:exposure])
+
+    results = {}
+    print(f"### incremental reconstruction, upscale ({upscale_x}, {upscale_y}), exposure {exposure} events")
+    for n in packets:
+        packet = data[exposure:exposure + n]
+        t_full = timeit_best(lambda: reconstruct(wfm, count(wfm, data[:exposure + n])[0]), number=1)
+        t_live = timeit_best(lambda: live.add_events(packet), number=1)
+        results[n] = {"full": t_full, "incremental": t_live}
+        print(f"{n} events packet: {t_full * 1e3:.2f} ms -> {t_live * 1e3:.2f} ms (x{t_full / t_live:.2f})")
+    return results
+
+
+def bench_prefetch(simulation_filepath: str,
+                   mask_filepath: str,
+                   upscale_x: int = 5,
+                   upscale_y: int = 1,
+                   observations: int = 4,
+                   decodes: int = 10,
+                   ) -> dict:
+    """Compares a batch of load-count-analyze runs with and without `prefetch` of the next observation.
+    Each observation links the same simulation file for all cameras, the analysis decodes `decodes` times."""
+    wfm = codedmask(mask_filepath, upscale_x=upscale_x, upscale_y=upscale_y)
+
+    def analyze(detectors):
+        for _ in range(decodes):
+            reconstruct(wfm, detectors[0])
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        dirpaths = [Path(tmpdir) / f"observation{i}" for i in range(observations)]
+        for dirpath in dirpaths:
+            for cam in ["cam1a", "cam1b"]:
+                (dirpath / cam).mkdir(parents=True)
+                for name in ["detected", "reconstructed", "sources"]:
+                    os.symlink(Path(simulation_filepath).resolve(), dirpath / cam / f"{cam}_{name}.fits")
+
+        def sequential():
+            for dirpath in dirpaths:
+                filepaths = simulation_files(dirpath)
+                sdls = [simulation(filepaths[cam]["reconstructed"]) for cam in ["cam1a", "cam1b"]]
+                analyze([count(wfm, sdl.data)[0] for sdl in sdls])
+
+        def prefetched():
+            for obs in prefetch(dirpaths, wfm):
+                analyze(obs.detectors)
+
+        t_analysis = timeit_best(lambda: analyze([np.ones(wfm.detector_shape)]), number=1) * observations
+        start = perf_counter()
+        sequential()
+        t_sequential = perf_counter() - start
+        start = perf_counter()
+        prefetched()
+        t_prefetched = perf_counter() - start
+
+    results = {"analysis": t_analysis, "sequential": t_sequential, "prefetched": t_prefetched}
+    print(f"### prefetch, {observations} observations, {os.cpu_count()} CPUs")
+    print(f"analysis alone: {t_analysis:.2f} s")
+    print(f"sequential: {t_sequential:.2f} s -> prefetched: {t_prefetched:.2f} s (x{t_sequential / t_prefetched:.2f})")
+    return results
+
+
+def bench_products(simulation_filepath: str,
+                   mask_filepath: str,
+                   upscale_x: int = 5,
+                   upscale_y: int = 1,
+                   iterations: int = 5,
+                   ) -> dict:
+    """Compares storage size and read time of IROS-like residuals in a FITS file and in a product directory.
+    Residuals subtract one point source model per iteration from the reconstructed sky."""
+    wfm = codedmask(mask_filepath, upscale_x=upscale_x, upscale_y=upscale_y)
+    sky, var, _ = reconstruct(wfm, count(wfm, simulation(simulation_filepath, columns=("X", "Y")).data)[0])
+    rng = np.random.default_rng(0)
+    residuals = [sky]
+    for _ in range(iterations):
+        shift_x, shift_y = rng.uniform(wfm.bins_sky.x[0], wfm.bins_sky.x[-1]), rng.uniform(-50, 50)
+        residuals.append(residuals[-1] - model_sky(wfm, shift_x, shift_y, 1000.0))
+    last = f"residual_{iterations}"
+
+    def size(path: Path) -> int:
+        return sum(p.stat().st_size for p in path.iterdir()) if path.is_dir() else path.stat().st_size
+
+    results = {}
+    print(f"### products, upscale ({upscale_x}, {upscale_y}), sky + variance + {iterations} residuals")
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fitspath = Path(tmpdir) / "products.fits"
+        hdus = [fits.ImageHDU(a) for a in [sky, var, *residuals[1:]]]
+        fits.HDUList([fits.PrimaryHDU(), *hdus]).writeto(fitspath)
+        t_read = timeit_best(lambda: np.array(fits.getdata(fitspath, ext=iterations + 2)), number=1)
+        results["fits"] = (size(fitspath), t_read)
+
+        for name, dtype, delta in [("raw", None, False), ("delta", None, True), ("delta float32", np.float32, True)]:
+            dirpath = Path(tmpdir) / name
+            writer = ProductWriter(dirpath, wfm, dtype=dtype)
+            writer.write("sky", sky)
+            writer.write("variance", var)
+            for i, residual in enumerate(residuals[1:], start=1):
+                if delta:
+                    writer.write_delta(f"residual_{i}", residual, reference="sky")
+                else:
+                    writer.write(f"residual_{i}", residual)
+            t_read = timeit_best(lambda: np.array(products(dirpath)[last]), number=1)
+            results[name] = (size(dirpath), t_read)
+
+    for name, (nbytes, t_read) in results.items():
+        print(f"{name}: {nbytes / 2**20:.1f} MiB, reading {last} {t_read * 1e3:.2f} ms")
+    return results
+
+
+def bench_catalog(simulation_filepath: str,
+                  mask_filepath: str,
+                  upscale_x: int = 5,
+                  upscale_y: int = 1,
+                  iterations: int = 30,
+                  flush_every: int = 5,
+                  ) -> dict:
+    """Compares time and peak memory of logging IROS-like iterations as in `iros_performance.perform_IROS`,
+    keeping all sources and residuals until a table is written, against streaming them with `CatalogWriter`."""
+    wfm = codedmask(mask_filepath, upscale_x=upscale_x, upscale_y=upscale_y)
+    sdl = simulation(simulation_filepath)
+    sky, var, _ = reconstruct(wfm, count(wfm, simulation(simulation_filepath, columns=("X", "Y")).data)[0])
+    model = model_sky(wfm, 0.0, 0.0, 1000.0)
+    sources = [((1.0 * i, 0.5 * i, 1000.0), (0.5 * i, 1.0 * i, 1000.0)) for i in range(iterations)]
+
+    def residuals():
+        residual = sky
+        for iteration_sources in sources:
+            residual = residual - model
+            yield iteration_sources, (residual, residual)
+
+    def logged(filepath):
+        log = {cam: {"sources_log": [], "residuals_log": []} for cam in ["cam1a", "cam1b"]}
+        for iteration_sources, iteration_residuals in residuals():
+            for k, cam in enumerate(log):
+                log[cam]["sources_log"].append(iteration_sources[k])
+                log[cam]["residuals_log"].append(iteration_residuals[k])
+        hdus = [
+            fits.BinTableHDU.from_columns(
+                [fits.Column(name=n, array=[s[c] for s in log[cam]["sources_log"]], format="D")
+                 for c, n in enumerate(["SKYSHIFT_X", "SKYSHIFT_Y", "FLUENCE"])],
+                name=cam.upper(),
+            )
+            for cam in log
+        ]
+        fits.HDUList([fits.PrimaryHDU(), *hdus]).writeto(filepath)
+
+    def streamed(filepath):
+        with CatalogWriter(filepath, wfm, (sdl, sdl), (sky, sky), (var, var), flush_every=flush_every) as catalog:
+            for iteration_sources, iteration_residuals in residuals():
+                catalog.append(iteration_sources, iteration_residuals)
+
+    results = {}
+    print(f"### catalog, {iterations} iterations, flushing every {flush_every}")
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for name, f in [("logged", logged), ("streamed", streamed)]:
+            filepath = Path(tmpdir) / f"{name}.fits"
+            start = perf_counter()
+            f(filepath)
+            elapsed = perf_counter() - start
+            filepath.unlink()
+            results[name] = (elapsed, peak_memory(lambda: f(filepath)))
+            print(f"{name}: {results[name][0] * 1e3:.1f} ms, peak {results[name][1] / 2**20:.1f} MiB")
+    return results
+
+
+def bench_checkpoint(simulation_filepath: str,
+                     mask_filepath: str,
+                     upscale_x: int = 5,
+                     upscale_y: int = 1,
+                     ) -> dict:
+    """Times the per-iteration cost of `iros` checkpoints, and resuming from one against starting over."""
+    wfm = codedmask(mask_filepath, upscale_x=upscale_x, upscale_y=upscale_y)
+    sdl = simulation(simulation_filepath)
+
+    def start():
+        return tuple(zip(*(reconstruct(wfm, count(wfm, s.data)[0]) for s in (sdl, sdl))))
+
+    skys, variances, _ = start()
+    state = {"loaders": [str(sdl.filepath)] * 2, "dataset": "reconstructed", "sky_shape": list(wfm.sky_shape),
+             "dtype": np.dtype(wfm.dtype).name, "snr_threshold": 0.0, "psf_library": None,
+             "iteration": 0, "slot": 1, "sources": []}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        _save_checkpoint(Path(tmpdir), state, skys, variances)
+        t_save = timeit_best(lambda: _save_checkpoint(Path(tmpdir), state, skys))
+        t_resume = timeit_best(lambda: _load_checkpoint(Path(tmpdir), state))
+        t_start = timeit_best(start, number=1)
+
+    results = {"checkpoint": t_save, "resume": t_resume, "start": t_start}
+    print(f"### iros checkpoints, upscale ({upscale_x}, {upscale_y}), {sdl.nevents} events per camera")
+    print(f"checkpoint: {t_save * 1e3:.2f} ms per iteration")
+    print(f"starting over: {t_start * 1e3:.2f} ms -> resuming: {t_resume * 1e3:.2f} ms")
+    return results
+
+
+def bench_optimize(mask_filepath: str,
+                   upscale_x: int = 5,
+                   upscale_y: int = 1,
+                   sources: tuple = ((0.0, 0.0, 5e4), (3.3, 1.7, 2e4), (-40.2, 10.4, 3e4)),
+                   ) -> dict:
+    """Times `optimize` on simulated point sources over a flat background, and reports the fit errors."""
+    wfm = codedmask(mask_filepath, upscale_x=upscale_x, upscale_y=upscale_y)
+    rng = np.random.default_rng(0)
+    results = {}
+    print(f"### optimize, upscale ({upscale_x}, {upscale_y})")
+    for source in sources:
+        sky, _, _ = reconstruct(wfm, rng.poisson(1.0 + model_shadowgram(wfm, *source)).astype(float))
+        arg = np.unravel_index(np.argmax(sky), sky.shape)
+        fit = optimize(wfm, sky, arg)
+        # the component cache is cleared, so that every call decodes.
+        t = timeit_best(lambda: (component_cache_clear(), optimize(wfm, sky, arg)), number=1)
+        results[source] = (t, fit)
+        print(f"source {source}: {t * 1e3:.1f} ms, fit ({fit[0]:.3f}, {fit[1]:.3f}, {fit[2]:.1f})")
+    return results
+
+
+def bench_component_cache(mask_filepath: str,
+                          upscale_x: int = 5,
+                          upscale_y: int = 1,
+                          sources: tuple = ((0.0, 0.0, 5e4), (3.3, 1.7, 2e4), (-40.2, 10.4, 3e4)),
+                          iterations: int = 8,
+                          ) -> dict:
+    """
+    Times an IROS-like loop of `optimize` calls over a single sky, removing the fitted source
+    at each iteration, with the component cache cleared at every call or shared across calls.
+    """
+    wfm = codedmask(mask_filepath, upscale_x=upscale_x, upscale_y=upscale_y)
+    rng = np.random.default_rng(0)
+    detector = rng.poisson(1.0 + sum(model_shadowgram(wfm, *source) for source in sources)).astype(float)
+    sky_start, _, _ = reconstruct(wfm, detector)
+    results = {}
+    print(f"### component cache, upscale ({upscale_x}, {upscale_y}), {iterations} iterations")
+    for shared in (False, True):
+        component_cache_clear()
+        sky, times = sky_start.copy(), []
+        for _ in range(iterations):
+            if not shared:
+                component_cache_clear()
+            arg = np.unravel_index(np.argmax(sky), sky.shape)
+            t0 = perf_counter()
+            fit = optimize(wfm, sky, arg)
+            times.append(perf_counter() - t0)
+            sky = sky - model_sky(wfm, *fit)
+        info = component_cache_info()
+        results[shared] = (times, info)
+        print(
+            f"{'shared' if shared else 'cleared'}: total {sum(times) * 1e3:.0f} ms, "
+            f"iterations {', '.join(f'{t * 1e3:.0f}' for t in times)} ms, "
+            f"{info['hits']} hits, {info['misses']} misses, {info['nbytes'] / 2**10:.0f} KiB"
+        )
+    return results
+
+
+def bench_psf_library(mask_filepath: str,
+                      upscale_x: int = 5,
+                      upscale_y: int = 1,
+                      strides: tuple = ((5, 25), (2, 10)),
+                      n: int = 20,
+                      ) -> dict:
+    """
+    Times building PSF libraries and modeling sources from them, and reports their errors against `model_sky`,
+    and the fraction of the grid cells `iros` would model with the library at the default tolerance.
+    """
+    wfm = codedmask(mask_filepath, upscale_x=upscale_x, upscale_y=upscale_y)
+    rng = np.random.default_rng(0)
+    bins = wfm.bins_sky
+    shifts = np.column_stack([
+        rng.uniform(0.9 * bins.x[0], 0.9 * bins.x[-1], n),
+        rng.uniform(0.9 * bins.y[0], 0.9 * bins.y[-1], n),
+    ])
+    t_exact = timeit_best(lambda: model_sky(wfm, *shifts[0], 1.0), number=3)
+    results = {}
+    print(f"### psf library, upscale ({upscale_x}, {upscale_y}), model_sky {t_exact * 1e3:.1f} ms")
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for stride in strides:
+            t0 = perf_counter()
+            library = build_psf_library(wfm, Path(tmpdir) / f"psflib_{stride[0]}_{stride[1]}", stride=stride)
+            t_build = perf_counter() - t0
+            t_model = timeit_best(lambda: library.model_sky(*shifts[0], 1.0), number=3)
+            window_errors, sky_errors = check_psf_library(library, shifts)
+            within = np.mean(library.errors <= PSFLIB_TOLERANCE)
+            results[stride] = (t_build, t_model, window_errors, sky_errors, within)
+            print(
+                f"stride {stride}: {library.responses.nbytes / 2**20:.1f} MiB, build {t_build:.1f} s, "
+                f"model {t_model * 1e3:.2f} ms, window error median {np.median(window_errors):.4f}, "
+                f"sky error median {np.median(sky_errors):.3f} max {np.max(sky_errors):.3f}, "
+                f"cells within tolerance {within:.0%}"
+            )
+    return results
+
+
+if __name__ == '__main__':
+
+    # path for mask .fits
+    root_path = "/mnt/d/PhD_AASS/Coding/Images_fits/"
+    mask_file = "wfm_mask.fits"
+
+    bench_decode(root_path + mask_file, upscale_x=5)
+    bench_reconstruct(root_path + mask_file, upscale_x=5)
+    bench_decode_batch(root_path + mask_file, upscale_x=5)
+    bench_upscale_engine(root_path + mask_file)
+    report_float32_accuracy(root_path + mask_file, upscale_x=5)
+    bench_workers(root_path + mask_file, upscale_x=5)
+    bench_sparse(root_path + mask_file, upscale_x=5)
+    bench_decode_window(root_path + mask_file, upscale_x=5)
+    bench_decode_tiled(root_path + mask_file)
+    bench_camera_cache(root_path + mask_file)
+    bench_fold(root_path + mask_file)
+    bench_simulation_loading(root_path + "simulation.fits", root_path + mask_file)
+    bench_count(root_path + "simulation.fits", root_path + mask_file)
+    bench_count_cube(root_path + "simulation.fits", root_path + mask_file)
+    bench_incremental(root_path + "simulation.fits", root_path + mask_file)
+    bench_prefetch(root_path + "simulation.fits", root_path + mask_file)
+    bench_products(root_path + "simulation.fits", root_path + mask_file)
+    bench_catalog(root_path + "simulation.fits", root_path + mask_file)
+    bench_checkpoint(root_path + "simulation.fits", root_path + mask_file)
+    bench_optimize(root_path + mask_file)
+    bench_component_cache(root_path + mask_file)
+    bench_psf_library(root_path + mask_file)
+
+
+# end
@@ -13,27 +13,60 @@ codedmask : Function
 simulation : Function
     Loads and manages WFM simulation data
 
+prefetch : Function
+    Loads and bins the next simulations on a background thread, while the present one is analyzed
+
+ProductWriter, products : Class, Function
+    Writes and reads reconstruction products as memory-mappable arrays and compressed residual deltas
+
 count : Function
     Creates detector images from photon event data
 
+count_stream : Function
+    Creates detector images from chunks of photon event data, e.g. memory-mapped tables
+
+count_cube, index_events : Function
+    Creates cubes of detector images over time windows and energy bands
+
 decode : Function
     Reconstructs sky images using balanced cross-correlation
 
+decode_window : Function
+    Reconstructs a window of the sky image, e.g. around a source
+
+decode_tiled : Function
+    Reconstructs sky images within a memory budget, optionally into memory-mapped arrays
+
 variance : Function
     Computes balanced sky image variance
 
+decode_batch, variance_batch : Function
+    Batched versions of decode and variance over stacks of detector images
+
 snratio : Function
     Computes balanced sky image signal-to-noise ratio
 
+reconstruct : Function
+    Computes balanced sky image, variance and signal-to-noise ratio in a single pass
+
+IncrementalReconstructor : Class
+    Updates sky image and variance as new events arrive, e.g. for live data
+
 model_shadowgram : Function
     Generates realistic detector shadowgrams
 
 model_sky : Function
     Creates simulated sky images with instrumental effects
 
+build_psf_library, load_psf_library, check_psf_library : Function
+    Stores decoded point-source responses over a sky grid on disk, and models sources by interpolating them
+
 optimize : Function
     Estimates source parameters through two-stage optimization
 
+component_cache_info, component_cache_clear : Function
+    Inspects and frees the memory-bounded cache of model components shared by `optimize` calls
+
 iros : Function
     Source subtraction by Iterative Removal of Sources method.
 
@@ -42,17 +75,36 @@ For detailed documentation on specific functions, use help() on the individual
 components or refer to the module docstrings.
 """
 
+__version__ = "0.1.0"
+
+from .io import prefetch
+from .io import products
+from .io import ProductWriter
 from .io import simulation
 from .io import simulation_files
 from .mask import chop
 from .mask import codedmask
 from .mask import count
+from .mask import count_cube
+from .mask import count_stream
 from .mask import decode
+from .mask import decode_batch
+from .mask import decode_tiled
+from .mask import decode_window
+from .mask import index_events
+from .mask import IncrementalReconstructor
 from .mask import model_shadowgram
 from .mask import model_sky
+from .mask import reconstruct
 from .mask import shift2pos
 from .mask import snratio
 from .mask import strip
 from .mask import variance
+from .mask import variance_batch
+from .optim import component_cache_clear
+from .optim import component_cache_info
 from .optim import iros
 from .optim import optimize
+from .psflib import build_psf_library
+from .psflib import check_psf_library
+from .psflib import load_psf_library
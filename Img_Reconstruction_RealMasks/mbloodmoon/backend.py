@@ -0,0 +1,223 @@
+"""
+Backend configuration for the correlations of the WFM analysis pipeline.
+
+This module provides:
+- A process-wide configuration for correlation engine, method and FFT worker threads
+- A context manager to temporarily switch configuration, within the present thread only
+- Environment variable defaults, so that configuration can be set from outside Python
+- `correlate` and `convolve` routines honoring the configuration
+
+Configuration keys, and the environment variables setting their defaults:
+- "engine" (MBLOODMOON_ENGINE, default "fft"): engine used for decoding correlations.
+    - "fft": correlates at full, upscaled resolution against cached decoder spectra.
+    - "upscale": correlates at native mask resolution, one polyphase component of the
+      box-summed detector at a time, exploiting the block structure of upscaled masks.
+- "workers" (MBLOODMOON_WORKERS, default 1): number of `scipy.fft` worker threads.
+  Negative values count back from the number of available CPUs, -1 means all of them.
+- "method" (MBLOODMOON_METHOD, default "fft"): method of `correlate` and `convolve`,
+  either "fft", "direct" or "auto". With "fft", kernels of at most `_DIRECT_MAX_SIZE` elements,
+  e.g. that of `psfy`, are still applied directly, as a sum of shifted and scaled copies of the other input.
+  With "auto", SciPy picks the method heuristically, which often underestimates FFT performance
+  on mask-sized arrays, and "direct" always takes the SciPy direct method.
+- "sparse" (MBLOODMOON_SPARSE, default 1.2): crossover of the sparse decoding path, in units of
+  the FFT cost `L * log2(L)`, with `L` the padded FFT size. Detector images whose non-zero pixels
+  times decoder size fall below it are decoded by accumulating shifted decoders instead.
+  The default is measured by `benchmarks.bench_sparse`, zero disables the sparse path.
+- "cache_bytes" (MBLOODMOON_CACHE_BYTES, default 2**28): memory budget of the process-wide cache of
+  decoded model components shared by `optimize` calls, in bytes. Zero disables caching.
+"""
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+import os
+import threading
+from typing import Iterator
+
+import numpy as np
+import numpy.typing as npt
+from scipy.fft import set_workers
+from scipy.signal import convolve as _convolve
+from scipy.signal import correlate as _correlate
+
+_ENGINES = ("fft", "upscale")
+_METHODS = ("fft", "direct", "auto")
+# largest kernel, in elements, applied by shifting and adding with the "fft" method.
+# `benchmarks.bench_convolve` measures shifting and adding 1.1-10 times faster than FFT for kernels
+# of 2 to 16 elements over masks upscaled by (1, 1) to (8, 2), and 2-4 times slower for 8 x 8 kernels.
+# SciPy direct convolution is slower than FFT for all of them.
+_DIRECT_MAX_SIZE = 16
+
+_config = {
+    "engine": os.environ.get("MBLOODMOON_ENGINE", "fft"),
+    "workers": int(os.environ.get("MBLOODMOON_WORKERS", 1)),
+    "method": os.environ.get("MBLOODMOON_METHOD", "fft"),
+    "sparse": float(os.environ.get("MBLOODMOON_SPARSE", 1.2)),
+    "cache_bytes": int(os.environ.get("MBLOODMOON_CACHE_BYTES", 2**28)),
+}
+# values set by `configure`, which only apply to the context, e.g. the thread, setting them.
+_overrides: ContextVar[dict] = ContextVar("mbloodmoon_backend_overrides", default={})
+_config_lock = threading.Lock()
+
+
+def _validate(config: dict) -> dict:
+    """Checks configuration keys and values.
+
+    Args:
+        config: a dictionary of configuration values.
+
+    Returns:
+        The input configuration.
+
+    Raises:
+        ValueError: for unknown keys or invalid values.
+    """
+    if unknown := set(config) - set(_config):
+        raise ValueError(f"Unknown backend configuration keys {sorted(unknown)}.")
+    if "engine" in config and config["engine"] not in _ENGINES:
+        raise ValueError(f"Correlation engine must be one of {_ENGINES}, got '{config['engine']}'.")
+    if "method" in config and config["method"] not in _METHODS:
+        raise ValueError(f"Correlation method must be one of {_METHODS}, got '{config['method']}'.")
+    if "workers" in config and not (isinstance(config["workers"], int) and config["workers"] != 0):
+        raise ValueError("Number of workers must be a non-zero integer.")
+    if "sparse" in config and not (isinstance(config["sparse"], (int, float)) and config["sparse"] >= 0):
+        raise ValueError("Sparse crossover must be a non-negative number.")
+    if "cache_bytes" in config and not (isinstance(config["cache_bytes"], int) and config["cache_bytes"] >= 0):
+        raise ValueError("Cache memory budget must be a non-negative integer.")
+    return config
+
+
+def get_config() -> dict:
+    """Returns a copy of the present backend configuration, including the values set by `configure`."""
+    with _config_lock:
+        return _config | _overrides.get()
+
+
+def set_config(**kwargs) -> None:
+    """
+    Sets backend configuration values for the whole process, for all threads but
+    those within a `configure` context setting the same values.
+
+    Args:
+        engine: correlation engine, either "fft" or "upscale".
+        workers: number of `scipy.fft` worker threads.
+        method: correlation method, either "fft", "direct" or "auto".
+        sparse: crossover of the sparse decoding path, zero disables it.
+        cache_bytes: memory budget of the model component cache, zero disables it.
+
+    Raises:
+        ValueError: for unknown keys or invalid values.
+    """
+    _validate(kwargs)
+    with _config_lock:
+        _config.update(kwargs)
+
+
+@contextmanager
+def configure(**kwargs) -> Iterator[dict]:
+    """
+    Context manager temporarily setting backend configuration values. Values are set for the present
+    thread only, so that a context does not affect other threads, nor is affected by them.
+    `mbloodmoon.io.prefetch` workers run with the values of the thread starting them.
+
+    Args:
+        engine: correlation engine, either "fft" or "upscale".
+        workers: number of `scipy.fft` worker threads.
+        method: correlation method, either "fft", "direct" or "auto".
+        sparse: crossover of the sparse decoding path, zero disables it.
+        cache_bytes: memory budget of the model component cache, zero disables it.
+
+    Yields:
+        The configuration in use within the context.
+
+    Example:
+        >>> with configure(workers=-1):
+        >>>     sky = decode(camera, detector)
+    """
+    token = _overrides.set(_overrides.get() | _validate(kwargs))
+    try:
+        yield get_config()
+    finally:
+        _overrides.reset(token)
+
+
+def get_workers(workers: int | None = None) -> int:
+    """Returns `workers` if specified, otherwise the configured number of FFT worker threads."""
+    return get_config()["workers"] if workers is None else workers
+
+
+def _shift_add(in1: npt.NDArray, in2: npt.NDArray, mode: str) -> npt.NDArray:
+    """Convolves an array with a small kernel `in2`, adding a shifted and scaled copy of `in1` per kernel element."""
+    shape = tuple(n1 + n2 - 1 for n1, n2 in zip(in1.shape, in2.shape))
+    out = np.zeros(shape, dtype=np.result_type(in1, in2))
+    for k in np.ndindex(in2.shape):
+        if in2[k]:
+            out[tuple(slice(i, i + n) for i, n in zip(k, in1.shape))] += in2[k] * in1
+    if mode == "full":
+        return out
+    # same slicing as `scipy.signal.convolve`.
+    if mode == "same":
+        starts, lengths = [(n - n1) // 2 for n, n1 in zip(shape, in1.shape)], in1.shape
+    else:
+        starts, lengths = [n2 - 1 for n2 in in2.shape], [n1 - n2 + 1 for n1, n2 in zip(in1.shape, in2.shape)]
+    return out[tuple(slice(start, start + length) for start, length in zip(starts, lengths))]
+
+
+def _is_small_kernel(in1: npt.NDArray, in2: npt.NDArray, method: str) -> bool:
+    """Whether `in2` is a kernel applied by shifting and adding rather than with the configured method."""
+    return (
+        method == "fft"
+        and np.ndim(in1) == np.ndim(in2)
+        and np.size(in2) <= _DIRECT_MAX_SIZE
+        and all(n1 >= n2 for n1, n2 in zip(np.shape(in1), np.shape(in2)))
+    )
+
+
+def correlate(
+    in1: npt.NDArray,
+    in2: npt.NDArray,
+    mode: str = "full",
+) -> npt.NDArray:
+    """
+    Cross-correlates two arrays with the configured method and worker threads.
+    Same as `scipy.signal.correlate`, applying small kernels directly, see `_DIRECT_MAX_SIZE`.
+
+    Args:
+        in1: First input.
+        in2: Second input. Should have the same number of dimensions as `in1`.
+        mode: Either "full", "valid" or "same".
+
+    Returns:
+        The cross-correlation of `in1` with `in2`.
+    """
+    config = get_config()
+    if _is_small_kernel(in1, in2, config["method"]):
+        return _shift_add(np.asarray(in1), np.conj(np.flip(in2)), mode)
+    with set_workers(config["workers"]):
+        return _correlate(in1, in2, mode=mode, method=config["method"])
+
+
+def convolve(
+    in1: npt.NDArray,
+    in2: npt.NDArray,
+    mode: str = "full",
+) -> npt.NDArray:
+    """
+    Convolves two arrays with the configured method and worker threads.
+    Same as `scipy.signal.convolve`, applying small kernels directly, see `_DIRECT_MAX_SIZE`.
+
+    Args:
+        in1: First input.
+        in2: Second input. Should have the same number of dimensions as `in1`.
+        mode: Either "full", "valid" or "same".
+
+    Returns:
+        The convolution of `in1` with `in2`.
+    """
+    config = get_config()
+    if _is_small_kernel(in1, in2, config["method"]):
+        return _shift_add(np.asarray(in1), np.asarray(in2), mode)
+    with set_workers(config["workers"]):
+        return _convolve(in1, in2, mode=mode, method=config["method"])
+
+
+_validate(_config)
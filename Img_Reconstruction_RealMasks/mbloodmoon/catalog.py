@@ -0,0 +1,245 @@
+"""
+Source catalogs of the IROS analysis.
+
+This module provides:
+- A writer appending IROS sources to a FITS catalog, one binary table per flush
+- A reader joining the binary tables of a catalog back into a single record array
+
+Catalog rows hold, for each camera and iteration, the source position in sky-shift
+coordinates, sky pixels, angles from the optical axis and equatorial coordinates, together
+with its fluence, signal-to-noise ratio and fit quality.
+"""
+
+from dataclasses import dataclass
+from dataclasses import field
+from pathlib import Path
+
+from astropy.io import fits
+import numpy as np
+import numpy.typing as npt
+
+from .coords import _shiftgrid2equatorial
+from .coords import _to_angles
+from .io import SimulationDataLoader
+from .mask import chop
+from .mask import CodedMaskCamera
+
+# name, FITS format and unit of the catalog columns.
+_CATALOG_COLUMNS = (
+    ("ITERATION", "J", ""),
+    ("CAMERA", "8A", ""),
+    ("SHIFT_X", "D", "mm"),
+    ("SHIFT_Y", "D", "mm"),
+    ("PIX_I", "J", "pixel"),
+    ("PIX_J", "J", "pixel"),
+    ("THETA_X", "D", "deg"),
+    ("THETA_Y", "D", "deg"),
+    ("RA", "D", "deg"),
+    ("DEC", "D", "deg"),
+    ("FLUENCE", "D", ""),
+    ("SNR", "D", ""),
+    ("FIT_MSE", "D", ""),
+)
+
+
+@dataclass
+class CatalogWriter:
+    """
+    Appends the sources found by `iros` to a FITS catalog.
+
+    Rows are buffered and written every `flush_every` iterations as a new binary table
+    appended to the file, so that memory does not grow with iterations and an interrupted
+    run keeps all the tables flushed before. Coordinates are converted a flush at a time,
+    over all buffered rows at once. `load_catalog` joins the tables back.
+
+    For each camera and iteration, the columns are:
+    - ITERATION: the IROS iteration
+    - CAMERA: the camera name
+    - SHIFT_X, SHIFT_Y: source position in sky-shift coordinates (mm)
+    - PIX_I, PIX_J: sky pixel (row, column) of the source position
+    - THETA_X, THETA_Y: source angles from the optical axis (deg)
+    - RA, DEC: source equatorial coordinates (deg)
+    - FLUENCE: fitted source fluence
+    - SNR: signal-to-noise ratio at the source pixel, before removing the source
+    - FIT_MSE: mean squared residual within the `chop` window around the source, as minimized by `optimize`
+
+    Attributes:
+        filepath: Path to the FITS catalog, created with its primary HDU
+        camera: CodedMaskCamera of the analysis
+        loaders: Data loaders of the two cameras, in the order of `iros` results
+        skys: Sky images of the two cameras, before any source was removed. Defaults to None,
+            set by `start`, e.g. as the `on_reconstruct` callback of `iros`
+        variances: Variance images of the two cameras. Defaults to None, set by `start`
+        names: Names of the two cameras. Defaults to ("cam1a", "cam1b")
+        flush_every: Number of iterations buffered before writing
+        resume: If true and the catalog file exists, appends to it, numbering iterations after its last one.
+            Defaults to False.
+        iteration: Iteration of the next sources appended, zero or following the last one of a resumed catalog
+
+    Raises:
+        ValueError: If `flush_every` is not a positive integer.
+        ValueError: If resuming a catalog written for another camera.
+        OSError: If the catalog file already exists and is not resumed.
+
+    Example:
+        The sky images and variances `iros` reconstructs are passed to the catalog, rather than
+        reconstructed again:
+        >>> with CatalogWriter(filepath, camera, (sdl_cam1a, sdl_cam1b)) as catalog:
+        >>>     for sources, residuals in iros(camera, sdl_cam1a, sdl_cam1b, 30, on_reconstruct=catalog.start):
+        >>>         catalog.append(sources, residuals)
+
+        A run checkpointed by `iros` is resumed together with its catalog. `start` then receives the residuals
+        of the last checkpointed iteration rather than the reconstructed skys, so that the SNR column matches
+        an uninterrupted run only if the catalog holds every checkpointed iteration, e.g. with `flush_every=1`:
+        >>> with CatalogWriter(filepath, camera, (sdl_cam1a, sdl_cam1b), resume=True) as catalog:
+        >>>     for sources, residuals in iros(
+        >>>         camera, sdl_cam1a, sdl_cam1b, 30, checkpoint_dir=path, resume=True, on_reconstruct=catalog.start
+        >>>     ):
+        >>>         catalog.append(sources, residuals)
+    """
+
+    filepath: Path
+    camera: CodedMaskCamera
+    loaders: tuple[SimulationDataLoader, SimulationDataLoader]
+    skys: tuple[npt.NDArray, npt.NDArray] | None = None
+    variances: tuple[npt.NDArray, npt.NDArray] | None = None
+    names: tuple[str, str] = ("cam1a", "cam1b")
+    flush_every: int = 1
+    resume: bool = False
+    iteration: int = field(init=False, default=0)
+    _rows: list = field(init=False, repr=False, default_factory=list)
+
+    def __post_init__(self):
+        if not (isinstance(self.flush_every, int) and self.flush_every > 0):
+            raise ValueError("Flush period must be a positive integer.")
+        self.filepath = Path(self.filepath)
+        header = fits.Header()
+        header["MASKFILE"] = (Path(self.camera.mdl.filepath).name, "mask FITS file")
+        header["UPSCALEX"] = (self.camera.upscale_f.x, "mask upscale factor over x")
+        header["UPSCALEY"] = (self.camera.upscale_f.y, "mask upscale factor over y")
+        if self.resume and self.filepath.exists():
+            existing = fits.getheader(self.filepath)
+            if any(existing.get(key) != header[key] for key in ("MASKFILE", "UPSCALEX", "UPSCALEY")):
+                raise ValueError("The catalog was written for another camera.")
+            iterations = load_catalog(self.filepath)["ITERATION"]
+            self.iteration = int(iterations.max()) + 1 if len(iterations) else 0
+            return
+        fits.PrimaryHDU(header=header).writeto(self.filepath)
+
+    def start(
+        self,
+        skys: tuple[npt.NDArray, npt.NDArray],
+        variances: tuple[npt.NDArray, npt.NDArray],
+    ) -> None:
+        """
+        Sets the sky images the next sources are found in, and their variances.
+
+        Args:
+            skys: Sky images of the two cameras.
+            variances: Variance images of the two cameras.
+        """
+        self.skys, self.variances = tuple(skys), tuple(variances)
+
+    def append(
+        self,
+        sources: tuple[tuple[float, float, float], tuple[float, float, float]],
+        residuals: tuple[npt.NDArray, npt.NDArray],
+    ) -> None:
+        """
+        Adds the results of an IROS iteration to the catalog.
+
+        Args:
+            sources: The (shift_x, shift_y, fluence) source parameters for the two cameras.
+            residuals: The residual sky images for the two cameras, after the sources were removed.
+
+        Raises:
+            ValueError: If sky images and variances were neither given nor set by `start`.
+        """
+        if self.skys is None or self.variances is None:
+            raise ValueError("Sky images and variances are missing, see `CatalogWriter.start`.")
+        bins = self.camera.bins_sky
+        for k, ((shift_x, shift_y, fluence), residual) in enumerate(zip(sources, residuals)):
+            # same as `shift2pos`, clipped to the sky.
+            i = int(np.clip(np.searchsorted(bins.y, shift_y, side="right") - 1, 0, len(bins.y) - 2))
+            j = int(np.clip(np.searchsorted(bins.x, shift_x, side="right") - 1, 0, len(bins.x) - 2))
+            # variance is clipped as in `iros`.
+            snr = self.skys[k][i, j] / np.sqrt(max(self.variances[k][i, j], 1.0))
+            (min_i, max_i, min_j, max_j), _ = chop(self.camera, (i, j))
+            mse = np.mean(np.square(residual[min_i:max_i, min_j:max_j]))
+            self._rows.append((self.iteration, k, shift_x, shift_y, i, j, fluence, snr, mse))
+        # the residuals are the skys the next sources are found in.
+        self.skys = tuple(residuals)
+        self.iteration += 1
+        if self.iteration % self.flush_every == 0:
+            self.flush()
+
+    def flush(self) -> None:
+        """Writes the buffered rows as a new binary table of the catalog."""
+        if not self._rows:
+            return
+        iterations, cams, shift_xs, shift_ys, pix_is, pix_js, fluences, snrs, mses = map(np.array, zip(*self._rows))
+        thetas = _to_angles(shift_xs, shift_ys, self.camera.specs["mask_detector_distance"])
+        ras, decs = np.empty(len(cams)), np.empty(len(cams))
+        for k, sdl in enumerate(self.loaders):
+            on_camera = cams == k
+            ras[on_camera], decs[on_camera] = _shiftgrid2equatorial(
+                shift_xs[on_camera],
+                shift_ys[on_camera],
+                sdl.pointings["z"],
+                sdl.pointings["x"],
+                self.camera.specs["mask_detector_distance"],
+            )
+        arrays = (
+            iterations,
+            np.array(self.names)[cams],
+            shift_xs,
+            shift_ys,
+            pix_is,
+            pix_js,
+            thetas.x,
+            thetas.y,
+            ras,
+            decs,
+            fluences,
+            snrs,
+            mses,
+        )
+        table = fits.BinTableHDU.from_columns(
+            [
+                fits.Column(name=name, format=format_, unit=unit, array=array)
+                for (name, format_, unit), array in zip(_CATALOG_COLUMNS, arrays)
+            ],
+            name="CATALOG",
+        )
+        fits.append(self.filepath, table.data, table.header)
+        self._rows.clear()
+
+    def close(self) -> None:
+        """Writes the rows still buffered."""
+        self.flush()
+
+    def __enter__(self) -> "CatalogWriter":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        # rows are written even when iterating fails, e.g. because the optimizer did.
+        self.close()
+
+
+def load_catalog(filepath: str | Path) -> npt.NDArray:
+    """
+    Reads a catalog written by `CatalogWriter`.
+
+    Args:
+        filepath: path to the FITS catalog.
+
+    Returns:
+        A record array with a row for each camera and iteration, and the columns of `CatalogWriter`.
+        Empty if no table was flushed.
+    """
+    with fits.open(filepath) as hdul:
+        tables = [np.array(hdu.data) for hdu in hdul[1:]]
+    if not tables:
+        columns = [fits.Column(name=name, format=format_, unit=unit) for name, format_, unit in _CATALOG_COLUMNS]
+        tables = [np.array(fits.BinTableHDU.from_columns(columns, nrows=0).data)]
+    return np.concatenate(tables).view(np.recarray)
@@ -18,6 +18,7 @@ import warnings
 
 import numpy as np
 import numpy.typing as npt
+from numpy.lib.stride_tricks import sliding_window_view
 from scipy.interpolate import RegularGridInterpolator
 
 from .types import BinsRectangular
@@ -55,6 +56,32 @@ def upscale(
     return m
 
 
+def _boxsum(
+    m: npt.NDArray,
+    upscale_x: int = 1,
+    upscale_y: int = 1,
+) -> npt.NDArray:
+    """Separable box-sum filter over the last two axes, in `full` mode.
+
+    Each output element is the sum of an `upscale_y` x `upscale_x` window of the zero-padded
+    input, so that the output is `upscale_y - 1` rows and `upscale_x - 1` columns larger
+    than the input. This is the same as `scipy.signal.convolve(m, np.ones((upscale_y, upscale_x)))`
+    over 2D inputs.
+
+    Args:
+        m: Input array, or a stack of 2D arrays over the leading axes
+        upscale_x: box width over the x direction
+        upscale_y: box height over the y direction
+
+    Returns:
+        Box-summed array.
+    """
+    pad = [(0, 0)] * (m.ndim - 2) + [(upscale_y - 1, upscale_y - 1), (upscale_x - 1, upscale_x - 1)]
+    padded = np.pad(m, pad)
+    summed = sliding_window_view(padded, upscale_y, axis=-2).sum(axis=-1)
+    return sliding_window_view(summed, upscale_x, axis=-1).sum(axis=-1)
+
+
 def compose(
     a: npt.NDArray,
     b: npt.NDArray,
@@ -306,7 +333,7 @@ def _rbilinear(
         ]
     )
     total = sum(weights.values())
-    return OrderedDict([(k, v / total) for k, v in weights.items()])
+    return OrderedDict([(k, float(v / total)) for k, v in weights.items()])
 
 
 def _interp(
@@ -490,6 +517,38 @@ def _rbilinear_relative(
     )
 
 
+def _rbilinear_relative_gradient(
+    cx: float,
+    cy: float,
+    bins_x: npt.NDArray,
+    bins_y: npt.NDArray,
+) -> tuple[OrderedDict, OrderedDict, OrderedDict, tuple[int, int]]:
+    """
+    Same as `_rbilinear_relative`, also returning the derivatives of the weights with respect to `cx` and `cy`.
+
+    Weights are `(1 - u) * (1 - v)`, `u * (1 - v)`, `(1 - u) * v` and `u * v` for poles A, B, C and D of
+    `_rbilinear`, with `u` and `v` the distances of the center from the pivot midpoint in units of bin steps.
+    Derivatives follow, with signs given by the side of the pivot the center lies on.
+    Centers in the outermost bins have a single, constant weight.
+
+    Returns:
+        Ordered dictionaries mapping positions relative to the pivot to their weights, and to the weight
+        derivatives with respect to `cx` and `cy`. The pivot.
+    """
+    weights, pivot = _rbilinear_relative(cx, cy, bins_x, bins_y)
+    if len(weights) == 1:
+        zeros = OrderedDict([(k, 0.0) for k in weights])
+        return weights, zeros, zeros.copy(), pivot
+
+    (_, wa), ((_, sign_x), wb), ((sign_y, _), wc), (_, wd) = weights.items()
+    u, v = wb + wd, wc + wd
+    ddx, ddy = sign_x / (bins_x[1] - bins_x[0]), sign_y / (bins_y[1] - bins_y[0])
+    keys = tuple(weights)
+    grad_x = OrderedDict(zip(keys, (-(1 - v) * ddx, (1 - v) * ddx, -v * ddx, v * ddx)))
+    grad_y = OrderedDict(zip(keys, (-(1 - u) * ddy, -u * ddy, (1 - u) * ddy, u * ddy)))
+    return weights, grad_x, grad_y, pivot
+
+
 def _unframe(a: npt.NDArray, value: float = 0.0) -> npt.NDArray:
     """Removes outer frames of a 2D array until a non-zero frame is found.
 
@@ -6,18 +6,39 @@ This module provides dataclasses and utilities for:
 - Managing simulation data including photon events and pointing information
 - Accessing detector, reconstruction, and source information
 - Parsing configuration data from FITS headers
+- Prefetching simulation data on a background thread, while the previous observation is analyzed
+- Writing and reading reconstruction products as memory-mappable arrays with a JSON sidecar
 """
 
+from contextvars import copy_context
 from dataclasses import dataclass
+from dataclasses import field
 from functools import cached_property
+import json
+import os
 from pathlib import Path
+from queue import Empty
+from queue import Full
+from queue import Queue
+import threading
+from typing import Iterable
+from typing import Iterator
+from typing import Literal
+from typing import TYPE_CHECKING
+import zlib
 
 from astropy.io import fits
 from astropy.io.fits.fitsrec import FITS_rec
 from astropy.io.fits.header import Header
+import numpy as np
+import numpy.typing as npt
 
-from bloodmoon.types import CoordEquatorial
-from bloodmoon.types import CoordHorizontal
+from .types import BinsRectangular
+from .types import CoordEquatorial
+from .types import CoordHorizontal
+
+if TYPE_CHECKING:
+    from .mask import CodedMaskCamera
 
 
 def _validate_fits(filepath: Path) -> bool:
@@ -84,6 +105,10 @@ def simulation_files(dirpath: str | Path) -> dict[str, dict[str, Path]]:
     }
 
 
+# cached properties of `SimulationDataLoader` holding the open simulation file or data read from it.
+_SIMULATION_FILE_BACKED = ("_hdul", "data")
+
+
 @dataclass(frozen=True)
 class SimulationDataLoader:
     """
@@ -92,11 +117,18 @@ class SimulationDataLoader:
     The class provides access to photon events and instrument configuration from a
     FITS file containing WFM simulation data for a single camera.
 
+    The file is opened once, and the photon event table is memory-mapped. When `columns`
+    is specified, only those event table columns are read, either all at once through
+    `data` or a chunk of events at a time through `chunks`.
+
     Attributes:
         filepath (Path): Path to the FITS file
+        columns (tuple[str, ...] | None): Names of the event table columns to load, e.g. ("X", "Y").
+            Defaults to None, loading all columns.
 
     Properties:
         data: Photon event data from FITS extension 1
+        nevents: Number of photon events
         header: Primary FITS header
         mask_detector_distance (float): Distance between mask and detector in mm
         pointings (dict[str, CoordEquatorial]): Camera axis directions in equatorial frame
@@ -108,14 +140,60 @@ class SimulationDataLoader:
     """
 
     filepath: Path
+    columns: tuple[str, ...] | None = None
+
+    @cached_property
+    def _hdul(self) -> fits.HDUList:
+        """The simulation FITS file, opened once. HDUs are loaded on first access and their data memory-mapped."""
+        return fits.open(self.filepath, memmap=True, lazy_load_hdus=True)
+
+    def __getstate__(self) -> dict:
+        """Pickles the loader without its open file and photon events, which are loaded again on demand."""
+        return {k: v for k, v in self.__dict__.items() if k not in _SIMULATION_FILE_BACKED}
+
+    def __setstate__(self, state: dict):
+        # cached properties live in the instance dictionary, even for frozen dataclasses.
+        self.__dict__.update(state)
+
+    def _project(self, events: FITS_rec) -> FITS_rec | npt.NDArray:
+        """Restricts events to the loader's columns, copying them out of the memory-mapped table."""
+        if self.columns is None:
+            return events
+        return np.rec.fromarrays([events[c] for c in self.columns], names=list(self.columns))
 
     @cached_property
-    def data(self) -> FITS_rec:
-        return fits.getdata(self.filepath, ext=1, header=False)
+    def data(self) -> FITS_rec | npt.NDArray:
+        """Photon events, restricted to `columns` if specified, otherwise the memory-mapped event table."""
+        return self._project(self._hdul[1].data)
+
+    @cached_property
+    def nevents(self) -> int:
+        """Number of photon events, read from the event table header."""
+        return int(self._hdul[1].header["NAXIS2"])
+
+    def chunks(self, size: int = 2**20) -> Iterator[FITS_rec | npt.NDArray]:
+        """
+        Iterates over photon events, a chunk at a time. Only the memory-mapped pages of each chunk
+        are read, and only `columns` are copied, so that memory stays bounded by the chunk size.
+
+        Args:
+            size: Maximum number of events per chunk.
+
+        Yields:
+            Consecutive chunks of photon events, restricted to `columns` if specified.
+
+        Raises:
+            ValueError: If chunk size is not a positive integer.
+        """
+        if not (isinstance(size, int) and size > 0):
+            raise ValueError("Chunk size must be a positive integer.")
+        events = self._hdul[1].data
+        for start in range(0, self.nevents, size):
+            yield self._project(events[start : start + size])
 
     @cached_property
     def header(self) -> Header:
-        return fits.getheader(self.filepath, ext=0)
+        return self._hdul[0].header
 
     @cached_property
     def pointings(self) -> dict[str, CoordEquatorial]:
@@ -148,12 +226,17 @@ class SimulationDataLoader:
         }
 
 
-def simulation(filepath: str | Path) -> SimulationDataLoader:
+def simulation(
+    filepath: str | Path,
+    columns: tuple[str, ...] | None = None,
+) -> SimulationDataLoader:
     """
     Checks validity of filepath and intializes SimulationDataLoader.
 
     Args:
         filepath: path to FITS file.
+        columns: optional names of the photon event columns to load, e.g. ("X", "Y") for `count`.
+            Defaults to None, loading all columns.
 
     Returns:
         a MaskDataLoader dataclass.
@@ -163,7 +246,137 @@ def simulation(filepath: str | Path) -> SimulationDataLoader:
         raise FileNotFoundError("The simulation file does not exists.")
     if not _validate_fits(filepath):
         raise ValueError("File not in valid FITS format.")
-    return SimulationDataLoader(filepath)
+    return SimulationDataLoader(filepath, None if columns is None else tuple(columns))
+
+
+@dataclass(frozen=True)
+class Observation:
+    """
+    Simulation data of a camera pair, as loaded by `prefetch`.
+
+    Attributes:
+        dirpath: Path to the simulation directory
+        loaders: Data loaders of the two cameras
+        detectors: Detector images of the two cameras, None if `prefetch` was not given a camera
+    """
+
+    dirpath: Path
+    loaders: tuple[SimulationDataLoader, SimulationDataLoader]
+    detectors: tuple[npt.NDArray, npt.NDArray] | None = None
+
+
+def _load_observation(
+    dirpath: str | Path,
+    camera: "CodedMaskCamera | None",
+    cameras: tuple[str, str],
+    dataset: str,
+    columns: tuple[str, ...] | None,
+    chunksize: int,
+) -> Observation:
+    """Opens the simulation files of a camera pair and, if a camera is given, bins their photon events."""
+    filepaths = simulation_files(dirpath)
+    loaders = tuple(simulation(filepaths[c][dataset], columns=columns) for c in cameras)
+    # headers are read here too, so that the consumer never blocks on the file.
+    for sdl in loaders:
+        _ = sdl.header, sdl.nevents
+    if camera is None:
+        return Observation(Path(dirpath), loaders)
+    # `mask` imports from this module, hence the deferred import.
+    from .mask import count_stream
+
+    detectors = tuple(count_stream(camera, sdl.chunks(chunksize))[0] for sdl in loaders)
+    return Observation(Path(dirpath), loaders, detectors)
+
+
+def prefetch(
+    dirpaths: Iterable[str | Path],
+    camera: "CodedMaskCamera | None" = None,
+    cameras: tuple[str, str] = ("cam1a", "cam1b"),
+    dataset: Literal["detected", "reconstructed"] = "reconstructed",
+    columns: tuple[str, ...] | None = None,
+    maxsize: int = 1,
+    chunksize: int = 2**20,
+) -> Iterator[Observation]:
+    """
+    Iterates over simulation directories, loading the next observations on a background thread
+    while the present one is processed, e.g. by `iros`.
+
+    For each directory, the thread opens the two cameras' simulation files and, if `camera` is
+    specified, bins their photon events into detector images. Loaded observations wait in a queue
+    of `maxsize` entries, so that at most `maxsize + 2` observations are held in memory at once:
+    those queued, the one being loaded and the one being processed.
+
+    Args:
+        dirpaths: Simulation directories, each laid out as expected by `simulation_files`.
+        camera: Optional CodedMaskCamera binning the photon events. Defaults to None, no binning.
+        cameras: Names of the two cameras to load. Defaults to ("cam1a", "cam1b").
+        dataset: Either "detected" or "reconstructed". Defaults to "reconstructed".
+        columns: Optional names of the photon event columns to load. Defaults to None, all columns.
+        maxsize: Maximum number of loaded observations waiting to be processed.
+        chunksize: Number of photon events binned at a time.
+
+    Yields:
+        An Observation for each directory, in order.
+
+    Raises:
+        ValueError: If `dataset` is not "detected" or "reconstructed", or `maxsize` is not a positive integer.
+        Any error raised loading an observation, when that observation is reached.
+
+    Example:
+        >>> for obs in prefetch(dirpaths, camera):
+        >>>     for sources, residuals in iros(camera, *obs.loaders, max_iterations=5, detectors=obs.detectors):
+        >>>         ...
+    """
+    if dataset not in ["detected", "reconstructed"]:
+        raise ValueError("Argument `dataset` must be either `detected` or `reconstructed`.")
+    if not (isinstance(maxsize, int) and maxsize > 0):
+        raise ValueError("Queue size must be a positive integer.")
+
+    queue = Queue(maxsize=maxsize)
+    stop = threading.Event()
+    done = object()
+
+    def put(item) -> bool:
+        """Waits for a free queue slot, gives up if the consumer stopped iterating."""
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                continue
+        return False
+
+    def work():
+        try:
+            for dirpath in dirpaths:
+                if not put(_load_observation(dirpath, camera, cameras, dataset, columns, chunksize)):
+                    return
+        except BaseException as e:
+            put(e)
+            return
+        put(done)
+
+    # the worker runs with the backend configuration of the caller, see `mbloodmoon.backend.configure`.
+    thread = threading.Thread(target=copy_context().run, args=(work,), name="mbloodmoon-prefetch", daemon=True)
+    thread.start()
+    try:
+        while (item := queue.get()) is not done:
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        # frees a blocked producer, then waits for it to notice.
+        try:
+            while True:
+                queue.get_nowait()
+        except Empty:
+            pass
+        thread.join()
+
+
+# cached properties of `MaskDataLoader` holding the open mask file or data memory-mapped from it.
+_MASK_FILE_BACKED = ("_hdul", "mask", "decoder", "bulk")
 
 
 @dataclass(frozen=True)
@@ -172,7 +385,8 @@ class MaskDataLoader:
     Container for WFM coded mask parameters and patterns.
 
     The class provides access to mask geometry, decoder patterns, and associated
-    parameters from a single FITS file containing WFM mask data.
+    parameters from a single FITS file containing WFM mask data. The file is opened
+    once, headers and record arrays are cached, and HDU data are memory-mapped.
 
     Attributes:
         filepath: Path to the FITS file
@@ -182,6 +396,7 @@ class MaskDataLoader:
         mask: Mask pattern data from extension 2
         decoder: Decoder pattern data from extension 3
         bulk: Bulk pattern data from extension 4
+        bytes_read: Number of bytes of the FITS file accessed so far
     """
 
     filepath: Path
@@ -190,6 +405,19 @@ class MaskDataLoader:
         """Access mask parameters via dictionary-style lookup."""
         return self.specs[key]
 
+    @cached_property
+    def _hdul(self) -> fits.HDUList:
+        """The mask FITS file, opened once. HDUs are loaded on first access and their data memory-mapped."""
+        return fits.open(self.filepath, memmap=True, lazy_load_hdus=True)
+
+    def __getstate__(self) -> dict:
+        """Pickles the loader without its open file and memory-mapped data, which are loaded again on demand."""
+        return {k: v for k, v in self.__dict__.items() if k not in _MASK_FILE_BACKED}
+
+    def __setstate__(self, state: dict):
+        # cached properties live in the instance dictionary, even for frozen dataclasses.
+        self.__dict__.update(state)
+
     @cached_property
     def specs(self) -> dict[str, float]:
         """
@@ -198,8 +426,8 @@ class MaskDataLoader:
         Returns:
             Dictionary of mask parameters (dimensions, bounds, distances) as float values
         """
-        h1 = dict(fits.getheader(self.filepath, ext=0)) | dict(fits.getheader(self.filepath, ext=2))
-        h2 = dict(fits.getheader(self.filepath, ext=3))
+        h1 = dict(self._hdul[0].header) | dict(self._hdul[2].header)
+        h2 = dict(self._hdul[3].header)
 
         info = {"mask_minx": h1["MINX"],
                 "mask_miny": h1["MINY"],
@@ -220,7 +448,7 @@ class MaskDataLoader:
 
         return {k: float(v) for k, v in info.items()}
 
-    @property
+    @cached_property
     def mask(self) -> fits.FITS_rec:
         """
         Load mask data from mask FITS file.
@@ -228,9 +456,9 @@ class MaskDataLoader:
         Returns:
             FITS record array containing mask data
         """
-        return fits.getdata(self.filepath, ext=2)
+        return self._hdul[2].data
 
-    @property
+    @cached_property
     def decoder(self) -> fits.FITS_rec:
         """
         Load decoder data from mask FITS file.
@@ -238,9 +466,9 @@ class MaskDataLoader:
         Returns:
             FITS record array containing decoder data
         """
-        return fits.getdata(self.filepath, ext=3)
+        return self._hdul[3].data
 
-    @property
+    @cached_property
     def bulk(self) -> fits.FITS_rec:
         """
         Load bulk data from mask FITS file.
@@ -248,7 +476,27 @@ class MaskDataLoader:
         Returns:
             FITS record array containing bulk data
         """
-        return fits.getdata(self.filepath, ext=4)
+        return self._hdul[4].data
+
+    @property
+    def bytes_read(self) -> int:
+        """
+        Number of bytes of the FITS file accessed so far: headers of all HDUs, plus
+        data of the HDUs whose data were loaded. Memory-mapped data are counted in full.
+
+        Returns:
+            Bytes count, zero if the file was never opened.
+        """
+        if "_hdul" not in self.__dict__:
+            return 0
+        count = 0
+        for hdu in self._hdul:
+            info = hdu.fileinfo()
+            count += info["datLoc"] - info["hdrLoc"]
+            # astropy HDUs store their data in the instance dictionary once loaded.
+            if "data" in hdu.__dict__:
+                count += info["datSpan"]
+        return count
 
 
 def fetch_mask(filepath: str | Path) -> MaskDataLoader:
@@ -269,6 +517,253 @@ def fetch_mask(filepath: str | Path) -> MaskDataLoader:
     return MaskDataLoader(Path(filepath))
 
 
+# name of the sidecar file describing a product directory.
+_PRODUCTS_INDEX = "products.json"
+
+
+def _xor_bits(a: npt.NDArray, b: npt.NDArray) -> npt.NDArray:
+    """Bitwise XOR of two arrays of the same floating point type, as unsigned integers."""
+    uint = np.dtype(f"u{a.dtype.itemsize}")
+    return np.bitwise_xor(a.view(uint), b.view(uint))
+
+
+def _encode_delta(array: npt.NDArray, reference: npt.NDArray, level: int) -> bytes:
+    """
+    Losslessly compresses an array against a reference of the same shape and type.
+    The XOR of their bit patterns is zero for equal values and has leading zero bytes for close ones.
+    Bytes are shuffled so that bytes of the same significance are contiguous, then deflated.
+    """
+    bits = _xor_bits(np.ascontiguousarray(array), np.ascontiguousarray(reference))
+    shuffled = bits.reshape(-1).view(np.uint8).reshape(-1, array.dtype.itemsize).T
+    return zlib.compress(np.ascontiguousarray(shuffled).tobytes(), level)
+
+
+def _decode_delta(payload: bytes, reference: npt.NDArray) -> npt.NDArray:
+    """Inverse of `_encode_delta`."""
+    shuffled = np.frombuffer(zlib.decompress(payload), dtype=np.uint8).reshape(reference.dtype.itemsize, -1)
+    uint = np.dtype(f"u{reference.dtype.itemsize}")
+    bits = np.ascontiguousarray(shuffled.T).view(uint).reshape(reference.shape)
+    return np.bitwise_xor(bits, np.ascontiguousarray(reference).view(uint)).view(reference.dtype)
+
+
+@dataclass
+class ProductWriter:
+    """
+    Writes reconstruction products, e.g. sky, variance and residual images, into a directory.
+
+    Each product is stored as a raw `.npy` file, which `ProductLoader` memory-maps, or as a
+    compressed delta against another product. Deltas are lossless and suit IROS residuals, which
+    differ little between iterations. A JSON sidecar, `products.json`, records the sky bins,
+    camera metadata and how each product is stored. Writing to an existing product directory
+    adds to it.
+
+    Attributes:
+        dirpath: Path to the product directory, created if missing
+        camera: Optional CodedMaskCamera, whose sky bins and specifications are recorded
+        dtype: Optional floating point type the products are cast to, e.g. np.float32 or np.float16.
+            Defaults to None, storing products with their own type. Casting to a smaller type is lossy.
+        metadata: Optional dictionary of JSON-serializable values, recorded in the sidecar
+        level: zlib compression level of deltas, from 0 to 9
+
+    Example:
+        >>> writer = ProductWriter(dirpath, camera, dtype=np.float32)
+        >>> writer.write("sky", sky)
+        >>> writer.write("variance", var)
+        >>> for i, (sources, residuals) in enumerate(iros(camera, sdl_cam1a, sdl_cam1b, max_iterations=5)):
+        >>>     writer.write_delta(f"residual_{i}", residuals[0], reference="sky")
+    """
+
+    dirpath: Path
+    camera: "CodedMaskCamera | None" = None
+    dtype: npt.DTypeLike | None = None
+    metadata: dict = field(default_factory=dict)
+    level: int = 6
+    index: dict = field(init=False, repr=False)
+
+    def __post_init__(self):
+        from . import __version__
+
+        self.dirpath = Path(self.dirpath)
+        self.dirpath.mkdir(parents=True, exist_ok=True)
+        if (self.dirpath / _PRODUCTS_INDEX).is_file():
+            with open(self.dirpath / _PRODUCTS_INDEX) as f:
+                self.index = json.load(f)
+        else:
+            self.index = {"version": __version__, "bins": None, "camera": None, "metadata": {}, "products": {}}
+        if self.camera is not None:
+            self.index["bins"] = {"x": self.camera.bins_sky.x.tolist(), "y": self.camera.bins_sky.y.tolist()}
+            self.index["camera"] = {
+                "mask": str(self.camera.mdl.filepath),
+                "upscale": list(self.camera.upscale_f),
+                "dtype": np.dtype(self.camera.dtype).name,
+                "specs": self.camera.specs,
+            }
+        self.index["metadata"].update(self.metadata)
+
+    def _cast(self, array: npt.NDArray) -> npt.NDArray:
+        """The product as stored, cast to the writer's data type if specified."""
+        array = np.asarray(array)
+        return array if self.dtype is None else array.astype(self.dtype, copy=False)
+
+    def _commit(self, name: str, entry: dict) -> None:
+        """Records a product in the sidecar, which is replaced atomically."""
+        self.index["products"][name] = entry
+        tmp_path = self.dirpath / f".{_PRODUCTS_INDEX}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.index, f, indent=1)
+        os.replace(tmp_path, self.dirpath / _PRODUCTS_INDEX)
+
+    def _check_overwrite(self, name: str) -> None:
+        """Refuses to overwrite a product other deltas are encoded against, since they would decode wrongly."""
+        dependants = [k for k, entry in self.index["products"].items() if entry.get("reference") == name]
+        if dependants:
+            raise ValueError(f"Product '{name}' is the reference of {dependants} and cannot be overwritten.")
+
+    def write(self, name: str, array: npt.NDArray) -> Path:
+        """
+        Stores a product as a raw, memory-mappable `.npy` file.
+
+        Args:
+            name: Product name, e.g. "sky".
+            array: Product array.
+
+        Returns:
+            Path to the stored file.
+
+        Raises:
+            ValueError: If the product exists and is the reference of a delta.
+        """
+        self._check_overwrite(name)
+        array = self._cast(array)
+        filepath = self.dirpath / f"{name}.npy"
+        np.save(filepath, array)
+        self._commit(name, {"file": filepath.name, "encoding": "raw", "dtype": array.dtype.name, "shape": array.shape})
+        return filepath
+
+    def write_delta(self, name: str, array: npt.NDArray, reference: str) -> Path:
+        """
+        Stores a product as a compressed, lossless delta against a product written before.
+        Reading it back requires reading the reference too, so referencing a raw product,
+        rather than the previous delta, keeps reads to two files.
+
+        Args:
+            name: Product name, e.g. "residual_3".
+            array: Product array.
+            reference: Name of the reference product, e.g. "sky" or "residual_2".
+
+        Returns:
+            Path to the stored file.
+
+        Raises:
+            ValueError: If the reference product is missing, is the product itself, or differs in shape
+                or type once cast. If the product exists and is the reference of a delta.
+        """
+        if reference not in self.index["products"]:
+            raise ValueError(f"Reference product '{reference}' was not written.")
+        if reference == name:
+            raise ValueError(f"Product '{name}' cannot be its own reference.")
+        self._check_overwrite(name)
+        array = self._cast(array)
+        ref = ProductLoader(self.dirpath, self.index)[reference]
+        if array.shape != ref.shape or array.dtype != ref.dtype:
+            raise ValueError(
+                f"Product must match its reference shape {ref.shape} and type {ref.dtype}, "
+                f"got {array.shape} and {array.dtype}."
+            )
+        filepath = self.dirpath / f"{name}.xor.zlib"
+        filepath.write_bytes(_encode_delta(array, ref, self.level))
+        self._commit(
+            name,
+            {
+                "file": filepath.name,
+                "encoding": "xor-zlib",
+                "reference": reference,
+                "dtype": array.dtype.name,
+                "shape": array.shape,
+            },
+        )
+        return filepath
+
+
+@dataclass(frozen=True)
+class ProductLoader:
+    """
+    Reads reconstruction products written by `ProductWriter`.
+
+    Raw products are memory-mapped, so that opening one costs the same regardless of its size,
+    and only the pages accessed are read. Delta products are decompressed against their reference.
+
+    Attributes:
+        dirpath: Path to the product directory
+        index: Content of the product directory's sidecar
+
+    Properties:
+        names: Names of the products, in order of writing
+        bins: Sky bins of the products, None if no camera was recorded
+        camera: Camera metadata (mask file, upscale factors, data type, specifications), None if not recorded
+        metadata: User metadata
+    """
+
+    dirpath: Path
+    index: dict
+
+    def __getitem__(self, name: str) -> npt.NDArray:
+        """
+        Reads a product.
+
+        Args:
+            name: Product name.
+
+        Returns:
+            The product array, read-only and memory-mapped for raw products.
+
+        Raises:
+            KeyError: If the product is missing.
+        """
+        entry = self.index["products"][name]
+        if entry["encoding"] == "raw":
+            return np.load(self.dirpath / entry["file"], mmap_mode="r")
+        return _decode_delta((self.dirpath / entry["file"]).read_bytes(), self[entry["reference"]])
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.index["products"]
+
+    @property
+    def names(self) -> tuple[str, ...]:
+        return tuple(self.index["products"])
+
+    @cached_property
+    def bins(self) -> BinsRectangular | None:
+        if self.index["bins"] is None:
+            return None
+        return BinsRectangular(x=np.array(self.index["bins"]["x"]), y=np.array(self.index["bins"]["y"]))
+
+    @property
+    def camera(self) -> dict | None:
+        return self.index["camera"]
+
+    @property
+    def metadata(self) -> dict:
+        return self.index["metadata"]
+
+
+def products(dirpath: str | Path) -> ProductLoader:
+    """
+    Checks validity of dirpath and initializes ProductLoader.
+
+    Args:
+        dirpath: path to a product directory, as written by `ProductWriter`.
+
+    Returns:
+        a ProductLoader dataclass.
+    """
+    dr = Path(dirpath)
+    if not (dr / _PRODUCTS_INDEX).is_file():
+        raise FileNotFoundError("The product directory does not exist or lacks its sidecar.")
+    with open(dr / _PRODUCTS_INDEX) as f:
+        return ProductLoader(dr, json.load(f))
+
+
 """
 too much dataclasses
 
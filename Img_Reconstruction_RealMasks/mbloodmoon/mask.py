@@ -15,17 +15,30 @@ from bisect import bisect
 from bisect import bisect_left
 from bisect import bisect_right
 from dataclasses import dataclass
+from dataclasses import field
 from functools import cache
 from functools import cached_property
+import hashlib
+import json
+import os
 from pathlib import Path
+import shutil
+import tempfile
+from typing import Iterable
 
 from astropy.io.fits.fitsrec import FITS_rec
 import numpy as np
 import numpy.typing as npt
-from scipy.signal import convolve
-from scipy.signal import correlate
-from scipy.stats import binned_statistic_2d
-
+from numpy.lib.stride_tricks import sliding_window_view
+from scipy.fft import irfft2
+from scipy.fft import next_fast_len
+from scipy.fft import rfft2
+
+from .backend import convolve
+from .backend import correlate
+from .backend import get_config
+from .backend import get_workers
+from .images import _boxsum
 from .images import _erosion
 from .images import _interp
 from .images import _rbilinear_relative
@@ -56,11 +69,46 @@ def _bin(
     return np.linspace(start, stop, int((stop - start) / step) + 1)
 
 
+def _bin_indices(
+    values: npt.NDArray,
+    edges: npt.NDArray,
+) -> npt.NDArray:
+    """Bin indices of values over equally spaced bin edges, computed arithmetically.
+    Bins are half-open, except for the last one which includes its right edge, as with `np.histogram`.
+
+    Args:
+        values: Array of values to bin
+        edges: Equally spaced bin edges
+
+    Returns:
+        Integer array of bin indices, -1 for values out of the edges range or NaN.
+    """
+    values = np.asarray(values, dtype=float)
+    n = len(edges) - 1
+    position = values - edges[0]
+    position *= n / (edges[-1] - edges[0])
+    np.clip(position, 0, n - 1, out=position)
+    with np.errstate(invalid="ignore"):
+        indices = position.astype(np.intp)
+    # rounding may put values close to an edge into the neighbouring bin.
+    # these are checked against the edges, which are exact.
+    position -= indices
+    near = np.flatnonzero((position < 1e-6) | (position > 1 - 1e-6))
+    if near.size:
+        near_indices, near_values = indices[near], values[near]
+        near_indices -= near_values < edges[near_indices]
+        near_indices += (near_values >= edges[near_indices + 1]) & (near_indices < n - 1)
+        indices[near] = near_indices
+    indices[~((values >= edges[0]) & (values <= edges[-1]))] = -1
+    return indices
+
+
 def _fold(
     ml: FITS_rec,
     mask_bins: BinsRectangular,
 ) -> npt.NDArray:
     """Convert mask data from FITS record to 2D binned array.
+    Each bin holds the maximum value of the records falling into it, or NaN if there are none.
 
     Args:
         ml: FITS record containing mask data
@@ -69,7 +117,22 @@ def _fold(
     Returns:
         2D array containing binned mask data
     """
-    return binned_statistic_2d(ml["X"], ml["Y"], ml["VAL"], statistic="max", bins=[mask_bins.x, mask_bins.y])[0].T
+    n, m = len(mask_bins.y) - 1, len(mask_bins.x) - 1
+    cols, rows = _bin_indices(ml["X"], mask_bins.x), _bin_indices(ml["Y"], mask_bins.y)
+    inside = (rows >= 0) & (cols >= 0)
+    flat = rows[inside] * m + cols[inside]
+    values = np.asarray(ml["VAL"], dtype=float)[inside]
+
+    counts = np.bincount(flat, minlength=n * m)
+    if np.all(counts <= 1):
+        # mask records usually sit one per bin, and a plain scatter suffices.
+        folded = np.full(n * m, np.nan)
+        folded[flat] = values
+    else:
+        folded = np.full(n * m, -np.inf)
+        np.maximum.at(folded, flat, values)
+        folded[counts == 0] = np.nan
+    return folded.reshape(n, m)
 
 
 def _bisect_interval(
@@ -127,6 +190,7 @@ class CodedMaskCamera:
     Args:
         mdl: Mask data loader object containing mask and detector specifications
         upscale_f: Tuple of upscaling factors for x and y dimensions
+        dtype: Floating point type of the decoding arrays and of all reconstruction products
 
     Raises:
         ValueError: If detector plane is larger than mask or if upscale factors are not positive
@@ -134,6 +198,7 @@ class CodedMaskCamera:
 
     mdl: MaskDataLoader
     upscale_f: UpscaleFactor
+    dtype: np.dtype = np.dtype(np.float64)
 
     @property
     def specs(self) -> dict:
@@ -190,12 +255,18 @@ class CodedMaskCamera:
     @cached_property
     def mask(self) -> npt.NDArray:
         """2D array representing the coded mask pattern."""
-        return upscale(_fold(self.mdl.mask, self._bins_mask(UpscaleFactor(1, 1))).astype(int), *self.upscale_f)
+        # mask stays an integer array, since erosion (see `apply_vignetting`) requires it.
+        return upscale(_fold(self.mdl.mask, self._bins_mask(UpscaleFactor(1, 1))).astype(np.int8), *self.upscale_f)
 
     @cached_property
     def decoder(self) -> npt.NDArray:
         """2D array representing the mask pattern used for decoding."""
-        return upscale(_fold(self.mdl.decoder, self._bins_mask(UpscaleFactor(1, 1))), *self.upscale_f)
+        return upscale(self._decoder_native, *self.upscale_f)
+
+    @cached_property
+    def _decoder_native(self) -> npt.NDArray:
+        """2D array representing the decoder pattern, at native mask resolution."""
+        return _fold(self.mdl.decoder, self._bins_mask(UpscaleFactor(1, 1))).astype(self.dtype)
 
     @cached_property
     def bulk(self) -> npt.NDArray:
@@ -205,12 +276,56 @@ class CodedMaskCamera:
         bins = self._bins_mask(self.upscale_f)
         xmin, xmax = _bisect_interval(bins.x, self.mdl["detector_minx"], self.mdl["detector_maxx"])
         ymin, ymax = _bisect_interval(bins.y, self.mdl["detector_miny"], self.mdl["detector_maxy"])
-        return upscale(framed_bulk, *self.upscale_f)[ymin:ymax, xmin:xmax]
+        return upscale(framed_bulk.astype(self.dtype), *self.upscale_f)[ymin:ymax, xmin:xmax]
 
     @cached_property
     def balancing(self) -> npt.NDArray:
         """2D array representing the correlation between decoder and bulk patterns."""
-        return correlate(self.decoder, self.bulk, mode="full")
+        return _correlate_decoder(self, _rfft_detector(self, self.bulk))
+
+    @cached_property
+    def _rfft_shape(self) -> tuple[int, int]:
+        """Padded shape of the real FFTs used for `full` mode correlations with detector-shaped arrays."""
+        n, m = self.sky_shape
+        return next_fast_len(n, real=True), next_fast_len(m, real=True)
+
+    @cached_property
+    def _rfft_decoder(self) -> npt.NDArray:
+        """Real FFT spectrum of the decoder, zero-padded to `_rfft_shape`."""
+        return rfft2(self.decoder, self._rfft_shape, workers=get_workers())
+
+    @cached_property
+    def _rfft_decoder_squared(self) -> npt.NDArray:
+        """Real FFT spectrum of the squared decoder, zero-padded to `_rfft_shape`."""
+        return rfft2(np.square(self.decoder), self._rfft_shape, workers=get_workers())
+
+    @cached_property
+    def _sparse_fill_factor(self) -> float:
+        """Detector fill factor at which sparse and FFT decoding cost the same, per unit of sparse crossover."""
+        fft_size = np.prod(self._rfft_shape)
+        return float(fft_size * np.log2(fft_size) / (self.decoder.size * np.prod(self.detector_shape)))
+
+    @cached_property
+    def _phases_shape(self) -> tuple[int, int]:
+        """Shape of each polyphase component of a box-summed detector, see `_rfft_detector_phases`."""
+        (n, m), (uy, ux) = self.detector_shape, (self.upscale_f.y, self.upscale_f.x)
+        return -(-(n + uy - 1) // uy), -(-(m + ux - 1) // ux)
+
+    @cached_property
+    def _phases_rfft_shape(self) -> tuple[int, int]:
+        """Padded shape of the real FFTs used by the native resolution correlation engine."""
+        (n, m), (o, p) = self._phases_shape, self._decoder_native.shape
+        return next_fast_len(n + o - 1, real=True), next_fast_len(m + p - 1, real=True)
+
+    @cached_property
+    def _phases_rfft_decoder(self) -> npt.NDArray:
+        """Real FFT spectrum of the native decoder flipped over both axes, zero-padded to `_phases_rfft_shape`."""
+        return rfft2(self._decoder_native[::-1, ::-1], self._phases_rfft_shape, workers=get_workers())
+
+    @cached_property
+    def _phases_rfft_decoder_squared(self) -> npt.NDArray:
+        """Same as `_phases_rfft_decoder`, for the squared native decoder."""
+        return rfft2(np.square(self._decoder_native[::-1, ::-1]), self._phases_rfft_shape, workers=get_workers())
 
     @cached_property
     def detector_shape(self) -> tuple[int, int]:
@@ -241,6 +356,8 @@ def codedmask(
     mask_filepath: str | Path,
     upscale_x: int = 1,
     upscale_y: int = 1,
+    dtype: npt.DTypeLike = np.float64,
+    cache_dir: str | Path | None = None,
 ) -> CodedMaskCamera:
     """
     An interface to CodedMaskCamera.
@@ -249,12 +366,18 @@ def codedmask(
         mask_filepath: a str or a path object pointing to the mask filepath
         upscale_x: upscaling factor over the x direction
         upscale_y: upscaling factor over the y direction
+        dtype: floating point type of decoding arrays and reconstruction products,
+            either `np.float64` (default) or `np.float32`. Single precision halves memory
+            and speeds up correlations, see `benchmarks.report_float32_accuracy` for accuracy.
+        cache_dir: optional directory for caching the camera's derived arrays on disk.
+            Cached arrays are memory-mapped on load rather than recomputed from the mask file.
+            Entries are keyed by mask file content, upscale factors, data type and library version.
 
     Returns:
         a CodedMaskCamera object.
 
     Raises:
-        ValueError: for invalid upscale factors.
+        ValueError: for invalid upscale factors or data type.
     """
     mdl = MaskDataLoader(mask_filepath)
 
@@ -271,7 +394,303 @@ def codedmask(
     if not ((isinstance(upscale_x, int) and upscale_x > 0) and (isinstance(upscale_y, int) and upscale_y > 0)):
         raise ValueError("Upscale factors must be positive integers.")
 
-    return CodedMaskCamera(mdl, UpscaleFactor(x=upscale_x, y=upscale_y))
+    if np.dtype(dtype) not in (np.float32, np.float64):
+        raise ValueError("Data type must be either `np.float32` or `np.float64`.")
+
+    camera = CodedMaskCamera(mdl, UpscaleFactor(x=upscale_x, y=upscale_y), np.dtype(dtype))
+    if cache_dir is not None:
+        cache_path = Path(cache_dir) / _camera_cache_key(mask_filepath, camera.upscale_f, camera.dtype)
+        if not _load_camera_cache(camera, cache_path):
+            _save_camera_cache(camera, cache_path)
+    return camera
+
+
+# camera cached properties stored on disk. bins are stored as one array per axis.
+_CAMERA_CACHE_ARRAYS = ("mask", "decoder", "_decoder_native", "bulk", "balancing")
+_CAMERA_CACHE_BINS = ("bins_mask", "bins_detector", "bins_sky")
+_CAMERA_CACHE_SHAPES = ("detector_shape", "mask_shape", "sky_shape")
+
+
+def _camera_cache_key(
+    mask_filepath: str | Path,
+    upscale_f: UpscaleFactor,
+    dtype: np.dtype,
+) -> str:
+    """
+    Camera cache entry name.
+
+    Args:
+        mask_filepath: path to the mask FITS file
+        upscale_f: upscale factors of the camera
+        dtype: data type of the camera
+
+    Returns:
+        A hex digest of mask file content, upscale factors, data type and library version.
+    """
+    from . import __version__
+
+    digest = hashlib.sha256()
+    with open(mask_filepath, "rb") as f:
+        for chunk in iter(lambda: f.read(2**20), b""):
+            digest.update(chunk)
+    digest.update(f"{upscale_f.x},{upscale_f.y},{np.dtype(dtype).name},{__version__}".encode())
+    return digest.hexdigest()
+
+
+def _load_camera_cache(camera: CodedMaskCamera, cache_path: Path) -> bool:
+    """
+    Fills the camera cached properties with memory-mapped arrays from a cache entry.
+
+    Args:
+        camera: a CodedMaskCamera object
+        cache_path: directory of the cache entry
+
+    Returns:
+        True if the cache entry exists and was loaded, false otherwise.
+    """
+    try:
+        with open(cache_path / "meta.json") as f:
+            meta = json.load(f)
+        values = {name: np.load(cache_path / f"{name}.npy", mmap_mode="r") for name in _CAMERA_CACHE_ARRAYS}
+        for name in _CAMERA_CACHE_BINS:
+            values[name] = BinsRectangular(
+                x=np.load(cache_path / f"{name}_x.npy", mmap_mode="r"),
+                y=np.load(cache_path / f"{name}_y.npy", mmap_mode="r"),
+            )
+    except (OSError, ValueError):
+        return False
+    values.update({name: tuple(meta[name]) for name in _CAMERA_CACHE_SHAPES})
+    # cached properties live in the instance dictionary, even for frozen dataclasses.
+    camera.__dict__.update(values)
+    return True
+
+
+def _save_camera_cache(camera: CodedMaskCamera, cache_path: Path) -> None:
+    """
+    Computes the camera cached properties and stores them into a new cache entry.
+    The entry is written to a temporary directory first and then renamed, so that
+    concurrent processes never see incomplete entries.
+
+    Args:
+        camera: a CodedMaskCamera object
+        cache_path: directory of the cache entry
+    """
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = Path(tempfile.mkdtemp(dir=cache_path.parent))
+    try:
+        for name in _CAMERA_CACHE_ARRAYS:
+            np.save(tmp_path / f"{name}.npy", getattr(camera, name))
+        for name in _CAMERA_CACHE_BINS:
+            bins = getattr(camera, name)
+            np.save(tmp_path / f"{name}_x.npy", bins.x)
+            np.save(tmp_path / f"{name}_y.npy", bins.y)
+        with open(tmp_path / "meta.json", "w") as f:
+            json.dump({name: getattr(camera, name) for name in _CAMERA_CACHE_SHAPES}, f)
+        os.rename(tmp_path, cache_path)
+    except OSError:
+        # another process stored the same entry first.
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+def _rfft_detector(
+    camera: CodedMaskCamera,
+    detector: npt.NDArray,
+    workers: int | None = None,
+) -> npt.NDArray:
+    """Real FFT spectrum of a detector image, ready for correlation with the cached decoder spectra.
+
+    Args:
+        camera: CodedMaskCamera object containing the decoder pattern
+        detector: 2D array of detector counts, or a stack of them over the leading axes
+        workers: Number of `scipy.fft` worker threads, defaults to backend configuration
+
+    Returns:
+        The detector spectrum, in the layout expected by `_correlate_decoder` for the
+        present backend engine.
+
+    Raises:
+        ValueError: If detector shape does not match camera's detector shape.
+    """
+    if detector.shape[-2:] != camera.detector_shape:
+        raise ValueError(f"Detector shape {detector.shape} does not match camera's {camera.detector_shape}.")
+    detector = detector.astype(camera.dtype, copy=False)
+    if get_config()["engine"] == "upscale":
+        return _rfft_detector_phases(camera, detector, workers)
+    # correlating with `detector` is convolving with `detector` flipped over both axes.
+    return rfft2(detector[..., ::-1, ::-1], camera._rfft_shape, workers=get_workers(workers))
+
+
+def _correlate_decoder(
+    camera: CodedMaskCamera,
+    detector_spectrum: npt.NDArray,
+    squared: bool = False,
+    workers: int | None = None,
+) -> npt.NDArray:
+    """Cross-correlates the (maybe squared) camera decoder with a detector image, using cached spectra.
+
+    Args:
+        camera: CodedMaskCamera object containing the decoder pattern
+        detector_spectrum: Detector image spectrum, as returned by `_rfft_detector`
+        squared: If true, correlates against the squared decoder
+        workers: Number of `scipy.fft` worker threads, defaults to backend configuration
+
+    Returns:
+        Same as `correlate(camera.decoder, detector, mode="full")`, or with `np.square(camera.decoder)`.
+        Stacked spectra result in stacked correlations.
+    """
+    if get_config()["engine"] == "upscale":
+        return _correlate_decoder_phases(camera, detector_spectrum, squared, workers)
+    n, m = camera.sky_shape
+    spectrum = camera._rfft_decoder_squared if squared else camera._rfft_decoder
+    return irfft2(spectrum * detector_spectrum, camera._rfft_shape, workers=get_workers(workers))[..., :n, :m]
+
+
+def _rfft_detector_phases(
+    camera: CodedMaskCamera,
+    detector: npt.NDArray,
+    workers: int | None = None,
+) -> npt.NDArray:
+    """
+    Native resolution correlation engine, forward step.
+
+    Correlating an upscaled decoder `upscale(d, ux, uy)` with a detector `b` is the same as
+    correlating the native decoder `d` with the `ux` x `uy` box-summed detector `s`, decimated
+    by the upscale factors. There are `ux * uy` decimations, one per phase `(ry, rx)`, each
+    with elements `s[k * uy + ry, l * ux + rx]`.
+
+    Args:
+        camera: CodedMaskCamera object containing the decoder pattern
+        detector: 2D array of detector counts, or a stack of them over the leading axes
+        workers: Number of `scipy.fft` worker threads, defaults to backend configuration
+
+    Returns:
+        Spectra of the detector phases, with shape (..., uy, ux, *_phases_rfft_shape)
+    """
+    uy, ux = camera.upscale_f.y, camera.upscale_f.x
+    n, m = camera._phases_shape
+    summed = _boxsum(detector, ux, uy)
+    pad = [(0, 0)] * (detector.ndim - 2) + [(0, n * uy - summed.shape[-2]), (0, m * ux - summed.shape[-1])]
+    phases = np.pad(summed, pad).reshape(*detector.shape[:-2], n, uy, m, ux)
+    phases = np.moveaxis(phases, (-3, -1), (-4, -3))
+    return rfft2(phases, camera._phases_rfft_shape, workers=get_workers(workers))
+
+
+def _correlate_decoder_phases(
+    camera: CodedMaskCamera,
+    detector_spectrum: npt.NDArray,
+    squared: bool = False,
+    workers: int | None = None,
+) -> npt.NDArray:
+    """
+    Native resolution correlation engine, backward step.
+    Correlates each detector phase with the native decoder, then interleaves the phases back.
+
+    Args:
+        camera: CodedMaskCamera object containing the decoder pattern
+        detector_spectrum: Detector phases spectra, as returned by `_rfft_detector_phases`
+        squared: If true, correlates against the squared decoder
+        workers: Number of `scipy.fft` worker threads, defaults to backend configuration
+
+    Returns:
+        Same as `correlate(camera.decoder, detector, mode="full")`, or with `np.square(camera.decoder)`.
+    """
+    uy, ux = camera.upscale_f.y, camera.upscale_f.x
+    (n, m), (o, p) = camera._phases_shape, camera._decoder_native.shape
+    (nb, mb), (ns, ms) = camera.detector_shape, camera.sky_shape
+    spectrum = camera._phases_rfft_decoder_squared if squared else camera._phases_rfft_decoder
+    phases = irfft2(spectrum * detector_spectrum, camera._phases_rfft_shape, workers=get_workers(workers))
+    # phase `(ry, rx)` element `(k, l)` maps to the upscaled correlation at position
+    # `(k * uy + ry, l * ux + rx)`, counting backward from the last element.
+    phases = phases[..., : n + o - 1, : m + p - 1]
+    interleaved = np.moveaxis(phases, (-4, -3), (-3, -1))
+    interleaved = interleaved.reshape(*phases.shape[:-4], (n + o - 1) * uy, (m + p - 1) * ux)
+    last_i, last_j = nb + uy - 2 + (o - 1) * uy, mb + ux - 2 + (p - 1) * ux
+    return interleaved[..., last_i - ns + 1 : last_i + 1, last_j - ms + 1 : last_j + 1][..., ::-1, ::-1]
+
+
+def _is_sparse(
+    camera: CodedMaskCamera,
+    detector: npt.NDArray,
+) -> bool:
+    """Whether a detector image is sparse enough for `_correlate_sparse` to beat FFT correlation.
+
+    Args:
+        camera: CodedMaskCamera object containing the decoder pattern
+        detector: 2D array of detector counts
+
+    Returns:
+        True if the detector fill factor is below the backend's sparse crossover.
+    """
+    crossover = get_config()["sparse"] * camera._sparse_fill_factor
+    return np.count_nonzero(detector) < crossover * detector.size
+
+
+def _correlate_sparse(
+    camera: CodedMaskCamera,
+    detector: npt.NDArray,
+    squared: bool = False,
+) -> npt.NDArray:
+    """
+    Event-driven correlation of the (maybe squared) camera decoder with a sparse detector image.
+
+    A detector pixel `(i, j)` with counts `c` contributes `c * decoder` to the sky
+    slice starting at `(nb - 1 - i, mb - 1 - j)`, with `(nb, mb)` the detector shape.
+    The cost scales with the number of non-zero pixels, rather than with the sky size.
+    Pixels are grouped by counts, so that each group adds the same scaled decoder in place.
+
+    Args:
+        camera: CodedMaskCamera object containing the decoder pattern
+        detector: 2D array of detector counts, e.g. as returned by `count`
+        squared: If true, correlates against the squared decoder
+
+    Returns:
+        Same as `correlate(camera.decoder, detector, mode="full")`, or with `np.square(camera.decoder)`.
+
+    Raises:
+        ValueError: If detector shape does not match camera's detector shape.
+    """
+    if detector.shape != camera.detector_shape:
+        raise ValueError(f"Detector shape {detector.shape} does not match camera's {camera.detector_shape}.")
+    decoder = np.square(camera.decoder) if squared else camera.decoder
+    (n, m), (nb, mb) = decoder.shape, camera.detector_shape
+    out = np.zeros(camera.sky_shape, dtype=camera.dtype)
+    rows, cols = np.nonzero(detector)
+    counts = detector[rows, cols]
+    # `np.add.at` over a strided view of the sky is several times slower than adding slices in place,
+    # which are bandwidth bound. grouping by counts leaves no temporary array per pixel.
+    for c in np.unique(counts):
+        scaled = decoder if c == 1 else (c * decoder).astype(camera.dtype, copy=False)
+        on_counts = counts == c
+        for i, j in zip((nb - 1 - rows[on_counts]).tolist(), (mb - 1 - cols[on_counts]).tolist()):
+            out[i : i + n, j : j + m] += scaled
+    return out
+
+
+def _correlations(
+    camera: CodedMaskCamera,
+    detector: npt.NDArray,
+) -> tuple[npt.NDArray, npt.NDArray]:
+    """Cross-correlations of the decoder and of the squared decoder with a detector image.
+    Sparse detector images are correlated event by event, the others share one detector spectrum."""
+    if _is_sparse(camera, detector):
+        return _correlate_sparse(camera, detector), _correlate_sparse(camera, detector, squared=True)
+    detector_spectrum = _rfft_detector(camera, detector)
+    return _correlate_decoder(camera, detector_spectrum), _correlate_decoder(camera, detector_spectrum, squared=True)
+
+
+def _sums(
+    camera: CodedMaskCamera,
+    detector: npt.NDArray,
+) -> tuple:
+    """
+    Total counts of a detector image and of the camera bulk, for balancing.
+    Detector totals are returned in the camera data type, with singleton trailing axes
+    for stacks of detector images, so that they do not promote reconstruction products.
+    """
+    sum_bulk = float(np.sum(camera.bulk))
+    if detector.ndim == 2:
+        return float(np.sum(detector)), sum_bulk
+    return np.sum(detector, axis=(-2, -1), keepdims=True).astype(camera.dtype), sum_bulk
 
 
 def encode(
@@ -304,11 +723,10 @@ def variance(
     Returns:
         Variance map of the reconstructed sky image
     """
-    cc = correlate(camera.decoder, detector, mode="full")
-    var = correlate(np.square(camera.decoder), detector, mode="full")
-    sum_det, sum_bulk = map(np.sum, (detector, camera.bulk))
+    cc, var = _correlations(camera, detector)
+    sum_det, sum_bulk = _sums(camera, detector)
     var_bal = (
-        var + np.square(camera.balancing) * sum_det / np.square(sum_bulk) - 2 * cc * camera.balancing / sum_bulk
+        var + np.square(camera.balancing) * sum_det / sum_bulk**2 - 2 * cc * camera.balancing / sum_bulk
     )
     return var_bal
 
@@ -340,6 +758,7 @@ def decode(
     detector: npt.NDArray,
 ) -> npt.NDArray:
     """Reconstruct balanced sky image from detector counts using cross-correlation.
+    Sparse detector images are correlated event by event, see `_correlate_sparse`.
 
     Args:
         camera: CodedMaskCamera object containing mask and decoder patterns
@@ -349,12 +768,398 @@ def decode(
         Balanced cross-correlation sky image
             - Variance map of the reconstructed sky image
     """
-    cc = correlate(camera.decoder, detector, mode="full")
-    sum_det, sum_bulk = map(np.sum, (detector, camera.bulk))
+    if _is_sparse(camera, detector):
+        cc = _correlate_sparse(camera, detector)
+    else:
+        cc = _correlate_decoder(camera, _rfft_detector(camera, detector))
+    sum_det, sum_bulk = _sums(camera, detector)
     cc_bal = cc - camera.balancing * sum_det / sum_bulk
     return cc_bal
 
 
+def _decoder_block(
+    camera: CodedMaskCamera,
+    window: tuple[int, int, int, int],
+) -> npt.NDArray:
+    """
+    Block of the decoder contributing to a window of the `full` mode correlation with a detector image.
+    Sky element `(k, l)` correlates the detector with the decoder slice starting at `(k - nb + 1, l - mb + 1)`,
+    with `(nb, mb)` the detector shape. Decoder elements out of bounds are zero-padded.
+
+    Args:
+        camera: CodedMaskCamera object containing the decoder pattern
+        window: (min_i, max_i, min_j, max_j) sky window, upper bounds excluded
+
+    Returns:
+        Array with shape (max_i - min_i + nb - 1, max_j - min_j + mb - 1). Its `valid` mode correlation
+        with a detector image is the window of the `full` mode correlation.
+    """
+    min_i, max_i, min_j, max_j = window
+    (n, m), (nb, mb) = camera.decoder.shape, camera.detector_shape
+    top, left = min_i - nb + 1, min_j - mb + 1
+    block = np.zeros((max_i - min_i + nb - 1, max_j - min_j + mb - 1), dtype=camera.dtype)
+    si, ei = max(top, 0), min(top + block.shape[0], n)
+    sj, ej = max(left, 0), min(left + block.shape[1], m)
+    block[si - top : ei - top, sj - left : ej - left] = camera.decoder[si:ei, sj:ej]
+    return block
+
+
+def _check_window(camera: CodedMaskCamera, window: tuple[int, int, int, int]):
+    """Window helper."""
+    min_i, max_i, min_j, max_j = window
+    n, m = camera.sky_shape
+    if not (0 <= min_i < max_i <= n and 0 <= min_j < max_j <= m):
+        raise ValueError(f"Window {window} is empty or out of sky bounds {camera.sky_shape}.")
+
+
+# crossover of the direct correlation of `decode_window`, in units of the FFT cost `L * log2(L)`, with `L`
+# the size of the correlated arrays. windows whose area times detector size fall below it are correlated directly.
+# `benchmarks.bench_decode_window` measures it between 8 and 11 over 32 to 256 columns wide windows of
+# the WFM camera upscaled by (5, 1), where the two take the same time at about 96 columns.
+_DECODE_WINDOW_DIRECT = 10.0
+
+
+def decode_window(
+    camera: CodedMaskCamera,
+    detector: npt.NDArray,
+    window: tuple[int, int, int, int],
+) -> npt.NDArray:
+    """Reconstruct a window of the balanced sky image from detector counts.
+
+    Only the requested rows and columns of the cross-correlation are computed, by correlating
+    the detector in `valid` mode against the decoder block they depend on. Small windows,
+    such as those returned by `chop`, come at a fraction of the cost of `decode`.
+
+    Args:
+        camera: CodedMaskCamera object containing mask and decoder patterns
+        detector: 2D array of detector counts
+        window: (min_i, max_i, min_j, max_j) sky window, upper bounds excluded
+
+    Returns:
+        Same as `decode(camera, detector)[min_i:max_i, min_j:max_j]`.
+
+    Raises:
+        ValueError: If detector shape does not match camera's detector shape,
+            or if the window is empty or out of sky bounds.
+    """
+    if detector.shape != camera.detector_shape:
+        raise ValueError(f"Detector shape {detector.shape} does not match camera's {camera.detector_shape}.")
+    _check_window(camera, window)
+    min_i, max_i, min_j, max_j = window
+
+    detector = detector.astype(camera.dtype, copy=False)
+    block = _decoder_block(camera, window)
+    # direct correlation costs `window area * detector size` multiply-adds, see `_DECODE_WINDOW_DIRECT`.
+    fft_size = block.size + detector.size
+    if (max_i - min_i) * (max_j - min_j) * detector.size < _DECODE_WINDOW_DIRECT * fft_size * np.log2(fft_size):
+        cc = np.einsum("abij,ij->ab", sliding_window_view(block, detector.shape), detector)
+    else:
+        cc = correlate(block, detector, mode="valid")
+    sum_det, sum_bulk = _sums(camera, detector)
+    cc_bal = cc - camera.balancing[min_i:max_i, min_j:max_j] * sum_det / sum_bulk
+    return cc_bal
+
+
+def _decode_window_batch(
+    camera: CodedMaskCamera,
+    detectors: npt.NDArray,
+    window: tuple[int, int, int, int],
+    workers: int | None = None,
+) -> npt.NDArray:
+    """Reconstruct a window of the balanced sky images from a stack of detector images.
+
+    The decoder block of the window is transformed once, and correlated with the whole stack
+    in a single pass of FFTs sized as the block, rather than as the sky.
+
+    Args:
+        camera: CodedMaskCamera object containing mask and decoder patterns
+        detectors: (N, H, W) array of detector counts
+        window: (min_i, max_i, min_j, max_j) sky window, upper bounds excluded
+        workers: Number of `scipy.fft` worker threads, defaults to backend configuration
+
+    Returns:
+        (N, max_i - min_i, max_j - min_j) array, same as `decode_window` over each image.
+
+    Raises:
+        ValueError: If `detectors` is not a stack of camera-shaped detector images,
+            or if the window is empty or out of sky bounds.
+    """
+    _check_stack(detectors)
+    if detectors.shape[-2:] != camera.detector_shape:
+        raise ValueError(f"Detector shape {detectors.shape} does not match camera's {camera.detector_shape}.")
+    _check_window(camera, window)
+    min_i, max_i, min_j, max_j = window
+
+    detectors = detectors.astype(camera.dtype, copy=False)
+    block = _decoder_block(camera, window)
+    # `valid` mode correlations never wrap around, hence circular correlations over the block shape suffice.
+    shape = tuple(next_fast_len(k, real=True) for k in block.shape)
+    workers = get_workers(workers)
+    spectra = rfft2(detectors, shape, workers=workers)
+    np.conjugate(spectra, out=spectra)
+    spectra *= rfft2(block, shape, workers=workers)
+    cc = irfft2(spectra, shape, workers=workers)[:, : max_i - min_i, : max_j - min_j]
+    sum_dets, sum_bulk = _sums(camera, detectors)
+    return cc - camera.balancing[min_i:max_i, min_j:max_j] * (sum_dets / sum_bulk)
+
+
+def _tiles(length: int, step: int) -> list[tuple[int, int]]:
+    """Tiling helper."""
+    return [(start, min(start + step, length)) for start in range(0, length, step)]
+
+
+def decode_tiled(
+    camera: CodedMaskCamera,
+    detector: npt.NDArray,
+    max_memory: int = 2**28,
+    out: npt.NDArray | None = None,
+) -> npt.NDArray:
+    """Reconstruct balanced sky image from detector counts, within a memory budget.
+
+    The decoder and the detector are split into tiles, and the cross-correlations of all
+    tile pairs are overlap-added into the output. Tiles are sized so that the FFT buffers
+    of each pair fit `max_memory`, hence memory stays flat however large the sky is.
+    The balancing term is folded in by linearity, correlating the decoder with the detector
+    minus its expected bulk counts, so that no sky-sized balancing array is needed.
+
+    Args:
+        camera: CodedMaskCamera object containing mask and decoder patterns
+        detector: 2D array of detector counts
+        max_memory: Memory budget for the FFT buffers of a tile, in bytes
+        out: Optional output array with the camera sky shape, e.g. a `np.memmap`.
+            It is overwritten with the result.
+
+    Returns:
+        Balanced cross-correlation sky image, same as `decode`. This is `out`, if provided.
+
+    Raises:
+        ValueError: If detector or output shape do not match camera's shapes,
+            or if the memory budget cannot fit a single tile.
+
+    Example:
+        >>> out = np.lib.format.open_memmap("sky.npy", mode="w+", dtype=camera.dtype, shape=camera.sky_shape)
+        >>> sky = decode_tiled(camera, detector, max_memory=2**26, out=out)
+    """
+    if detector.shape != camera.detector_shape:
+        raise ValueError(f"Detector shape {detector.shape} does not match camera's {camera.detector_shape}.")
+    if out is not None and out.shape != camera.sky_shape:
+        raise ValueError(f"Output shape {out.shape} does not match camera's sky shape {camera.sky_shape}.")
+
+    (n, m), (nb, mb) = camera.decoder.shape, camera.detector_shape
+
+    def fft_shape(ti: int, tj: int) -> tuple[int, int]:
+        return (
+            next_fast_len(min(ti, n) + min(ti, nb) - 1, real=True),
+            next_fast_len(min(tj, m) + min(tj, mb) - 1, real=True),
+        )
+
+    # two input spectra, their product and the inverse transform, each about as large as the padded tile.
+    ti, tj = max(n, nb), max(m, mb)
+    while 4 * np.prod(fft_shape(ti, tj)) * camera.dtype.itemsize > max_memory:
+        if ti == tj == 1:
+            raise ValueError(f"Memory budget of {max_memory} bytes does not fit a single tile.")
+        if ti >= tj:
+            ti = (ti + 1) // 2
+        else:
+            tj = (tj + 1) // 2
+
+    if out is None:
+        out = np.zeros(camera.sky_shape, dtype=camera.dtype)
+    else:
+        out[...] = 0
+    sum_det, sum_bulk = _sums(camera, detector)
+    balanced = detector.astype(camera.dtype) - camera.bulk * (sum_det / sum_bulk)
+    workers = get_workers()
+    for r0, r1 in _tiles(nb, ti):
+        for c0, c1 in _tiles(mb, tj):
+            block = balanced[r0:r1, c0:c1]
+            if not np.any(block):
+                continue
+            for a0, a1 in _tiles(n, ti):
+                for b0, b1 in _tiles(m, tj):
+                    h, w = a1 - a0 + r1 - r0 - 1, b1 - b0 + c1 - c0 - 1
+                    shape = next_fast_len(h, real=True), next_fast_len(w, real=True)
+                    spectrum = rfft2(camera.decoder[a0:a1, b0:b1], shape, workers=workers)
+                    spectrum *= rfft2(block[::-1, ::-1], shape, workers=workers)
+                    # the tile pair correlation starts at sky element `(a0 + nb - r1, b0 + mb - c1)`.
+                    i0, j0 = a0 + nb - r1, b0 + mb - c1
+                    out[i0 : i0 + h, j0 : j0 + w] += irfft2(spectrum, shape, workers=workers)[:h, :w]
+    return out
+
+
+def reconstruct(
+    camera: CodedMaskCamera,
+    detector: npt.NDArray,
+) -> tuple[npt.NDArray, npt.NDArray, npt.NDArray]:
+    """Reconstruct balanced sky image, variance and signal-to-noise ratio from detector counts.
+
+    Fused version of `decode`, `variance` and `snratio`: the detector is transformed once,
+    and its correlations with the decoder and the squared decoder share the same spectrum.
+    Sparse detector images skip the transform, see `_correlate_sparse`.
+
+    Args:
+        camera: CodedMaskCamera object containing mask and decoder patterns
+        detector: 2D array of detector counts
+
+    Returns:
+        A tuple of three arrays:
+            - Balanced cross-correlation sky image, same as `decode`
+            - Variance map of the reconstructed sky image, same as `variance`
+            - Signal-to-noise ratio map, same as `snratio` over the two former
+    """
+    cc, var = _correlations(camera, detector)
+    sum_det, sum_bulk = _sums(camera, detector)
+
+    # sky = cc - B * sum_det / sum_bulk, and by substitution
+    # var_bal = var + B^2 * sum_det / sum_bulk^2 - 2 * cc * B / sum_bulk = var - (sky + cc) * B / sum_bulk.
+    # operations are carried in place, to only hold three sky-sized buffers.
+    sky = np.multiply(camera.balancing, sum_det / sum_bulk)
+    np.subtract(cc, sky, out=sky)
+    cc += sky
+    cc *= camera.balancing
+    cc /= sum_bulk
+    var -= cc
+    del cc
+    return sky, var, snratio(sky, var)
+
+
+@dataclass
+class IncrementalReconstructor:
+    """Running sky reconstruction, updated as new detector counts arrive.
+
+    Decoding is linear in the detector counts, and so is the variance. A packet of new counts `d`
+    updates the balanced sky by `cc - B * sum(d) / sum_bulk`, and the variance by
+    `var + B^2 * sum(d) / sum_bulk^2 - 2 * cc * B / sum_bulk`, with `cc` and `var` the correlations
+    of `d` with the decoder and the squared decoder, and `B` the balancing array. Small packets go
+    through the sparse correlation path, so that update latency scales with packet size, not exposure.
+
+    Args:
+        camera: CodedMaskCamera object containing mask and decoder patterns
+
+    Attributes:
+        detector: Running detector image, sum of all counts so far
+        sky: Balanced sky image, same as `decode(camera, detector)`
+        var: Variance map of the sky image, same as `variance(camera, detector)`
+
+    Example:
+        >>> live = IncrementalReconstructor(camera)
+        >>> for packet in packets:
+        >>>     live.add_events(packet)
+        >>>     snr = live.snr
+    """
+
+    camera: CodedMaskCamera
+    detector: npt.NDArray = field(init=False, repr=False)
+    sky: npt.NDArray = field(init=False, repr=False)
+    var: npt.NDArray = field(init=False, repr=False)
+
+    def __post_init__(self):
+        self.detector = np.zeros(self.camera.detector_shape, dtype=self.camera.dtype)
+        self.sky = np.zeros(self.camera.sky_shape, dtype=self.camera.dtype)
+        self.var = np.zeros(self.camera.sky_shape, dtype=self.camera.dtype)
+
+    @property
+    def snr(self) -> npt.NDArray:
+        """Signal-to-noise ratio map of the sky image, see `snratio`."""
+        return snratio(self.sky, self.var)
+
+    def add_events(self, data: npt.NDArray) -> None:
+        """
+        Bins a packet of events over the detector and updates the reconstruction.
+
+        Args:
+            data: Array of event data with `X` and `Y` coordinates
+        """
+        self.add_counts(count(self.camera, data)[0])
+
+    def add_counts(self, counts: npt.NDArray) -> None:
+        """
+        Adds a detector image of new counts and updates the reconstruction.
+
+        Args:
+            counts: 2D array of new detector counts
+
+        Raises:
+            ValueError: If counts shape does not match camera's detector shape.
+        """
+        if counts.shape != self.camera.detector_shape:
+            raise ValueError(f"Counts shape {counts.shape} does not match camera's {self.camera.detector_shape}.")
+        cc, var = _correlations(self.camera, counts)
+        sum_counts, sum_bulk = _sums(self.camera, counts)
+        balancing = self.camera.balancing
+        var += np.square(balancing) * (sum_counts / sum_bulk**2)
+        var -= cc * balancing * (2 / sum_bulk)
+        cc -= balancing * (sum_counts / sum_bulk)
+        self.detector += counts
+        self.sky += cc
+        self.var += var
+
+
+def _check_stack(detectors: npt.NDArray):
+    """Batch helper."""
+    if detectors.ndim != 3:
+        raise ValueError(f"Expected a (N, H, W) stack of detector images, got array with shape {detectors.shape}.")
+
+
+def decode_batch(
+    camera: CodedMaskCamera,
+    detectors: npt.NDArray,
+    workers: int | None = None,
+) -> npt.NDArray:
+    """Reconstruct balanced sky images from a stack of detector images.
+
+    The FFTs run over the whole stack at once, reusing the camera's decoder spectrum.
+
+    Args:
+        camera: CodedMaskCamera object containing mask and decoder patterns
+        detectors: (N, H, W) array of detector counts, e.g. time slices or energy bands
+        workers: Number of `scipy.fft` worker threads. Negative values count back from
+            the number of available CPUs, -1 means all of them. Defaults to backend configuration.
+
+    Returns:
+        (N, n, m) array of balanced cross-correlation sky images, same as `decode` over each image.
+
+    Raises:
+        ValueError: If `detectors` is not a stack of camera-shaped detector images.
+    """
+    _check_stack(detectors)
+    cc = _correlate_decoder(camera, _rfft_detector(camera, detectors, workers), workers=workers)
+    sum_dets, sum_bulk = _sums(camera, detectors)
+    cc -= camera.balancing * (sum_dets / sum_bulk)
+    return cc
+
+
+def variance_batch(
+    camera: CodedMaskCamera,
+    detectors: npt.NDArray,
+    workers: int | None = None,
+) -> npt.NDArray:
+    """Reconstruct balanced sky variances from a stack of detector images.
+
+    Args:
+        camera: CodedMaskCamera object containing mask and decoder patterns
+        detectors: (N, H, W) array of detector counts, e.g. time slices or energy bands
+        workers: Number of `scipy.fft` worker threads. Negative values count back from
+            the number of available CPUs, -1 means all of them. Defaults to backend configuration.
+
+    Returns:
+        (N, n, m) array of variance maps, same as `variance` over each image.
+
+    Raises:
+        ValueError: If `detectors` is not a stack of camera-shaped detector images.
+    """
+    _check_stack(detectors)
+    detector_spectra = _rfft_detector(camera, detectors, workers)
+    cc = _correlate_decoder(camera, detector_spectra, workers=workers)
+    var = _correlate_decoder(camera, detector_spectra, squared=True, workers=workers)
+    del detector_spectra
+    sum_dets, sum_bulk = _sums(camera, detectors)
+    var += np.square(camera.balancing) * (sum_dets / sum_bulk**2)
+    cc *= camera.balancing * (2 / sum_bulk)
+    var -= cc
+    return var
+
+
 def psf(camera: CodedMaskCamera) -> npt.NDArray:
     """Calculate Point Spread Function (PSF) of the coded mask system.
 
@@ -380,9 +1185,182 @@ def count(
     Returns:
         2D array of binned detector counts
     """
+    return count_stream(camera, (data,))
+
+
+# events are binned in blocks of this size, so that temporary arrays stay in cache.
+_COUNT_BLOCKSIZE = 2**16
+
+
+def count_stream(
+    camera: CodedMaskCamera,
+    chunks: Iterable[npt.NDArray],
+) -> tuple[npt.NDArray, BinsRectangular]:
+    """Create 2D histogram of detector counts from a stream of event data chunks.
+
+    Bin indices are computed arithmetically over the uniform detector bins and accumulated
+    with `np.bincount` into a single detector array. Results match `np.histogram2d` exactly:
+    the last bin includes its right edge, and events out of the detector or NaN are dropped.
+
+    Args:
+        camera: CodedMaskCamera object containing detector binning
+        chunks: Iterable of event data arrays with `X` and `Y` coordinates, e.g. from
+            `SimulationDataLoader.chunks` or slices of a memory-mapped event table
+
+    Returns:
+        2D array of binned detector counts, and the detector bins.
+
+    Example:
+        >>> sdl = simulation(filepath, columns=("X", "Y"))
+        >>> detector, bins = count_stream(camera, sdl.chunks())
+    """
+    bins = camera.bins_detector
+    n, m = len(bins.y) - 1, len(bins.x) - 1
+    counts = np.zeros(n * m, dtype=np.intp)
+    for chunk in chunks:
+        for start in range(0, len(chunk), _COUNT_BLOCKSIZE):
+            pixels = _detector_pixels(camera, chunk[start : start + _COUNT_BLOCKSIZE])
+            counts += np.bincount(pixels[pixels >= 0], minlength=n * m)
+    return counts.reshape(n, m).astype(float), bins
+
+
+def _detector_pixels(
+    camera: CodedMaskCamera,
+    data: npt.NDArray,
+) -> npt.NDArray:
+    """Flat detector pixel index of each event, -1 for events out of the detector. Same binning as `count_stream`."""
+    bins = camera.bins_detector
+    m = len(bins.x) - 1
+    pixels = np.empty(len(data), dtype=np.intp)
+    for start in range(0, len(data), _COUNT_BLOCKSIZE):
+        block = data[start : start + _COUNT_BLOCKSIZE]
+        cols, rows = _bin_indices(block["X"], bins.x), _bin_indices(block["Y"], bins.y)
+        rows *= m
+        rows += cols
+        rows[cols < 0] = -1
+        rows[rows < 0] = -1
+        pixels[start : start + len(block)] = rows
+    return pixels
+
+
+def _digitize(
+    values: npt.NDArray,
+    edges: npt.NDArray,
+) -> npt.NDArray:
+    """Bin indices of values over monotonically increasing bin edges, -1 for values out of range.
+    Bins are half-open, except for the last one which includes its right edge, as with `np.histogram`."""
+    indices = np.searchsorted(edges, values, side="right") - 1
+    indices[values == edges[-1]] = len(edges) - 2
+    indices[indices >= len(edges) - 1] = -1
+    return indices
+
+
+@dataclass(frozen=True)
+class TimeSortedEvents:
+    """Photon events binned over the detector and sorted by arrival time.
+
+    Events falling into any time window are a contiguous slice of the sorted arrays,
+    so that detector images can be re-sliced over new time windows without rescanning.
+    Instances are created with `index_events`, and consumed by `count_cube`.
+
+    Args:
+        times: Sorted event arrival times
+        pixels: Flat detector pixel index of each event, -1 for events out of the detector
+        energies: Event energies, or None if not indexed
+    """
+
+    times: npt.NDArray
+    pixels: npt.NDArray
+    energies: npt.NDArray | None = None
+
+
+def index_events(
+    camera: CodedMaskCamera,
+    data: npt.NDArray,
+    time_column: str = "TIME",
+    energy_column: str | None = "ENERGY",
+) -> TimeSortedEvents:
+    """Bins events over the detector and sorts them by arrival time, in a single pass over the event list.
+
+    Args:
+        camera: CodedMaskCamera object containing detector binning
+        data: Array of event data with `X`, `Y` and time coordinates, and optionally energies
+        time_column: Name of the event arrival time column
+        energy_column: Name of the event energy column, or None to skip energies
+
+    Returns:
+        A TimeSortedEvents object.
+    """
+    order = np.argsort(data[time_column], kind="stable")
+    return TimeSortedEvents(
+        times=np.asarray(data[time_column], dtype=float)[order],
+        pixels=_detector_pixels(camera, data)[order],
+        energies=None if energy_column is None else np.asarray(data[energy_column], dtype=float)[order],
+    )
+
+
+def count_cube(
+    camera: CodedMaskCamera,
+    data: npt.NDArray | TimeSortedEvents,
+    time_edges: npt.ArrayLike,
+    energy_edges: npt.ArrayLike | None = None,
+    time_column: str = "TIME",
+    energy_column: str = "ENERGY",
+) -> tuple[npt.NDArray, BinsRectangular]:
+    """Create a cube of detector images over time windows and energy bands.
+
+    Events are binned over the detector and sorted by time once (see `index_events`),
+    then each time window is a contiguous slice of the sorted events, binned over detector
+    pixels and energy bands by a single `np.bincount`. Time windows and energy bands follow
+    `np.histogram` conventions: bins are half-open, except for the last which includes its right edge.
+
+    Args:
+        camera: CodedMaskCamera object containing detector binning
+        data: Array of event data with `X`, `Y`, time and energy coordinates, or events
+            already indexed by `index_events`, so that new windows are sliced without rescanning
+        time_edges: Monotonically increasing time window edges
+        energy_edges: Monotonically increasing energy band edges, or None for a single band with all events
+        time_column: Name of the event arrival time column, if `data` is not indexed
+        energy_column: Name of the event energy column, if `data` is not indexed
+
+    Returns:
+        Array of detector counts with shape (n_time, n_energy, H, W), and the detector bins.
+
+    Raises:
+        ValueError: If edges are not monotonically increasing arrays of at least two elements,
+            or if energy bands are requested over events indexed without energies.
+
+    Example:
+        >>> cube, _ = count_cube(camera, sdl.data, time_edges=np.arange(0, 1000, 10))
+        >>> skys = decode_batch(camera, cube.reshape(-1, *camera.detector_shape))
+    """
+    time_edges = np.asarray(time_edges, dtype=float)
+    energy_edges = None if energy_edges is None else np.asarray(energy_edges, dtype=float)
+    for edges in (time_edges, energy_edges):
+        if edges is not None and not (edges.ndim == 1 and len(edges) > 1 and np.all(np.diff(edges) > 0)):
+            raise ValueError("Bin edges must be monotonically increasing arrays of at least two elements.")
+    if not isinstance(data, TimeSortedEvents):
+        data = index_events(camera, data, time_column, None if energy_edges is None else energy_column)
+    if energy_edges is not None and data.energies is None:
+        raise ValueError("Energy bands require events indexed with energies.")
+
     bins = camera.bins_detector
-    counts, *_ = np.histogram2d(data["Y"], data["X"], bins=[bins.y, bins.x])
-    return counts, bins
+    npixels = int(np.prod(camera.detector_shape))
+    nenergy = 1 if energy_edges is None else len(energy_edges) - 1
+    cube = np.zeros((len(time_edges) - 1, nenergy, npixels))
+    starts = np.searchsorted(data.times, time_edges[:-1], side="left")
+    stops = np.searchsorted(data.times, time_edges[1:], side="left")
+    stops[-1] = np.searchsorted(data.times, time_edges[-1], side="right")
+    for window, (start, stop) in enumerate(zip(starts, stops)):
+        pixels = data.pixels[start:stop]
+        if energy_edges is None:
+            indices = pixels[pixels >= 0]
+        else:
+            bands = _digitize(data.energies[start:stop], energy_edges)
+            inside = (pixels >= 0) & (bands >= 0)
+            indices = bands[inside] * npixels + pixels[inside]
+        cube[window] = np.bincount(indices, minlength=nenergy * npixels).reshape(nenergy, npixels)
+    return cube.reshape(len(time_edges) - 1, nenergy, *camera.detector_shape), bins
 
 
 def _detector_footprint(camera: CodedMaskCamera) -> tuple[int, int, int, int]:
@@ -614,6 +1592,40 @@ def apply_vignetting(
     return sg1 * sg2.T
 
 
+def _unnormalized_shadowgram(
+    camera: CodedMaskCamera,
+    shift_x: float,
+    shift_y: float,
+    vignetting: bool,
+    psfy: bool,
+) -> npt.NDArray:
+    """
+    Shadowgram of a point source before normalization, see `model_shadowgram`.
+    Its sum is the fraction of the mask projected over the detector bulk, zero out of the field of view.
+    """
+    # relative component map
+    RCMAP = {
+        0: slice(1, -1),
+        +1: slice(2, None),
+        -1: slice(None, -2),
+    }
+
+    n, m = camera.sky_shape
+    i_min, i_max, j_min, j_max = _detector_footprint(camera)
+    _mask = apply_vignetting(camera, camera.mask, shift_x, shift_y) if vignetting else camera.mask
+    _mask = convolve(_mask, _convolution_kernel_psfy(camera), mode="same") if psfy else _mask
+    _mask = _mask.astype(camera.dtype)
+    components, (pivot_i, pivot_j) = _rbilinear_relative(shift_x, shift_y, camera.bins_sky.x, camera.bins_sky.y)
+    r, c = (n // 2 - pivot_i), (m // 2 - pivot_j)
+    mask_shifted_processed = _shift(_mask, (r, c))
+
+    framed_shadowgram = mask_shifted_processed[i_min - 1 : i_max + 1, j_min - 1 : j_max + 1]
+    return (
+        sum(framed_shadowgram[RCMAP[pos_i], RCMAP[pos_j]] * weight for (pos_i, pos_j), weight in components.items())
+        * camera.bulk
+    )
+
+
 def model_shadowgram(
     camera: CodedMaskCamera,
     shift_x: float,
@@ -645,28 +1657,9 @@ def model_shadowgram(
     Notes:
         - Results are normalized to fluence, e.g. the sum of the result equals `fluence`.
     """
-    # relative component map
-    RCMAP = {
-        0: slice(1, -1),
-        +1: slice(2, None),
-        -1: slice(None, -2),
-    }
-
-    n, m = camera.sky_shape
-    i_min, i_max, j_min, j_max = _detector_footprint(camera)
-    _mask = apply_vignetting(camera, camera.mask, shift_x, shift_y) if vignetting else camera.mask
-    _mask = convolve(_mask, _convolution_kernel_psfy(camera), mode="same") if psfy else _mask
-    components, (pivot_i, pivot_j) = _rbilinear_relative(shift_x, shift_y, camera.bins_sky.x, camera.bins_sky.y)
-    r, c = (n // 2 - pivot_i), (m // 2 - pivot_j)
-    mask_shifted_processed = _shift(_mask, (r, c))
-
-    framed_shadowgram = mask_shifted_processed[i_min - 1 : i_max + 1, j_min - 1 : j_max + 1]
-    model = (
-        sum(framed_shadowgram[RCMAP[pos_i], RCMAP[pos_j]] * weight for (pos_i, pos_j), weight in components.items())
-        * camera.bulk
-    )
+    model = _unnormalized_shadowgram(camera, shift_x, shift_y, vignetting, psfy)
     model /= np.sum(model)
-    return model * fluence
+    return model * float(fluence)
 
 
 def model_sky(
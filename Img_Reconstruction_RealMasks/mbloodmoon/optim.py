@@ -7,36 +7,50 @@ This module provides algorithms for:
 - Two-stage optimization process
 - Model fitting with instrumental effects
 - Caching strategies for performance
+- Checkpointing of Iterative Removal of Sources runs
 
 The optimization handles both spatial and intensity parameters simultaneously.
 """
 
+from bisect import bisect
+from collections import OrderedDict
+from dataclasses import dataclass
+from dataclasses import field
 from functools import lru_cache
-from typing import Callable, Iterable, Literal
+import json
+import os
+from pathlib import Path
+import threading
+from typing import Callable, Hashable, Iterable, Literal
 import warnings
 
 import numpy as np
 import numpy.typing as npt
 from scipy.optimize import minimize
-from scipy.signal import convolve
 
+from .backend import convolve
+from .backend import get_config
 from .images import _rbilinear_relative
+from .images import _rbilinear_relative_gradient
 from .images import _shift
 from .io import SimulationDataLoader
 from .mask import _convolution_kernel_psfy
+from .mask import _decode_window_batch
 from .mask import _detector_footprint
 from .mask import _interpmax
 from .mask import apply_vignetting
 from .mask import chop
 from .mask import CodedMaskCamera
 from .mask import count
-from .mask import decode
+from .mask import decode_window
 from .mask import model_shadowgram
 from .mask import model_sky
+from .mask import reconstruct
 from .mask import shift2pos
 from .mask import snratio
 from .mask import strip
-from .mask import variance
+from .psflib import PSFLIB_TOLERANCE
+from .psflib import PSFLibrary
 from .types import UpscaleFactor
 
 
@@ -52,194 +66,355 @@ def _detector_footprint_cached(camera: CodedMaskCamera):
     return _detector_footprint(camera)
 
 
-def _init_model_coarse(
+def _fluence_lstsq(
     camera: CodedMaskCamera,
+    sky: npt.NDArray,
+    shift_x: float,
+    shift_y: float,
+    bounds: tuple[float, float],
     vignetting: bool = True,
     psfy: bool = True,
-) -> tuple[Callable, Callable]:
+    weights: npt.NDArray | None = None,
+) -> float:
     """
-    This is a faster version of compute_model that caches the decoded shadowgram
-    pattern for repeated evaluations with the same source position but different
-    fluence values. This makes it suitable for fluence optimization.
+    Least-squares source fluence at a fixed position.
+
+    Sky models are linear in fluence, `model = fluence * unit_model`, so that the weighted squared
+    error between the sky and the model within the `chop` window around the source is minimized by
+    `sum(w * sky * unit_model) / sum(w * unit_model ** 2)`. The loss is a parabola in fluence, hence
+    its minimum over an interval is this value clamped to the interval.
 
     Args:
         camera: CodedMaskCamera instance containing all geometric parameters
-        vignetting: If true, shadowgram model simulates vignetting.
-        psfy: If true, the model used for optimization will simulate detector position
-        reconstruction effects.
+        sky: 2D array of the reconstructed sky image to fit
+        shift_x: Source position x-coordinate in sky-shift space (mm)
+        shift_y: Source position y-coordinate in sky-shift space (mm)
+        bounds: The (lower, upper) bounds of the fluence
+        vignetting: If true, the model simulates vignetting.
+        psfy: If true, the model simulates detector position reconstruction effects.
+        weights: Optional weights of the squared errors over the `chop` window, e.g. inverse variances.
+            Defaults to None, same weight for all pixels, i.e. minimizing the loss of `optimize`.
 
     Returns:
-        Two callables. The first is the routine for computing the model, the second
-        is a routine for freeing the cache.
+        The fluence minimizing the weighted squared error, within bounds.
     """
-    cache = [
-        (None, None),
-    ]
-
-    def cache_hash():
-        return cache[0][0]
+    window, _ = chop(camera, shift2pos(camera, shift_x, shift_y))
+    min_i, max_i, min_j, max_j = window
+    unit_model = decode_window(
+        camera, model_shadowgram(camera, shift_x, shift_y, 1, vignetting=vignetting, psfy=psfy), window
+    )
+    truth = sky[min_i:max_i, min_j:max_j]
+    weighted = unit_model if weights is None else weights * unit_model
+    fluence = np.vdot(weighted, truth) / np.vdot(weighted, unit_model)
+    return float(np.clip(fluence, *bounds))
 
-    def cached(shift):
-        return cache_hash() == hash(shift)
 
-    def cache_set(shift, value):
-        cache[0] = hash(shift), value
+# slices of a framed shadowgram, selecting the component shifted by -1, 0 or +1 elements.
+_RCMAP = {
+    0: slice(1, -1),
+    +1: slice(2, None),
+    -1: slice(None, -2),
+}
 
-    def cache_get():
-        return cache[0][1]
 
-    def cache_clear():
-        cache.clear()
-        cache.append(
-            (None, None),
+def _process_mask(
+    camera: CodedMaskCamera,
+    shift_x: float,
+    shift_y: float,
+    vignetting: bool = True,
+    psfy: bool = True,
+) -> npt.NDArray:
+    """Mask pattern seen by a source at the given sky-shift, optionally vignetted and convolved with the PSF over y."""
+    mask_maybe_vignetted = (
+        apply_vignetting(
+            camera,
+            camera.mask,
+            shift_x,
+            shift_y,
+        )
+        if vignetting
+        else camera.mask
+    )
+    mask_maybe_vignetted_maybe_psfy = (
+        convolve(
+            mask_maybe_vignetted,
+            _convolution_kernel_psfy_cached(camera),
+            mode="same",
         )
+        if psfy
+        else mask_maybe_vignetted
+    )
+    return mask_maybe_vignetted_maybe_psfy.astype(camera.dtype)
+
+
+def _normalized_components(
+    camera: CodedMaskCamera,
+    pivot: tuple[int, int],
+    relative_positions: tuple[tuple[int, int], ...],
+    vignetting: bool = True,
+    psfy: bool = True,
+) -> npt.NDArray:
+    """
+    Normalized shadowgrams of sources at sky pixels next to a pivot, for bilinear interpolation between them.
+    Vignetting is evaluated at the pivot for all of them, so that components are consistent.
 
-    def f(shift_x: float, shift_y: float, fluence: float) -> npt.NDArray:
+    Args:
+        camera: CodedMaskCamera instance containing all geometric parameters
+        pivot: the (row, col) sky pixel of the pivot
+        relative_positions: positions of the components relative to the pivot, each within -1 and +1
+        vignetting: If true, shadowgrams simulate vignetting.
+        psfy: If true, shadowgrams simulate detector position reconstruction effects.
+
+    Returns:
+        (len(relative_positions), H, W) stack of detector shadowgrams, each summing to one,
+        or zero if it casts no shadowgram.
+    """
+    n, m = camera.sky_shape
+    pivot_i, pivot_j = pivot
+    i_min, i_max, j_min, j_max = _detector_footprint_cached(camera)
+    r, c = (n // 2 - pivot_i), (m // 2 - pivot_j)
+
+    # we call with pivot because calling with shifts to ensure consistent cached/vignetting combos
+    mask_processed = _process_mask(camera, camera.bins_sky.x[pivot_j], camera.bins_sky.y[pivot_i], vignetting, psfy)
+    mask_shifted_processed = _shift(mask_processed, (r, c))
+    framed_shadowgram = mask_shifted_processed[i_min - 1 : i_max + 1, j_min - 1 : j_max + 1]
+
+    components = np.stack([framed_shadowgram[_RCMAP[i], _RCMAP[j]] for i, j in relative_positions]) * camera.bulk
+    # components out of the sky, next to pivots on its edge, cast no shadowgram and are left zero.
+    sums = np.sum(components, axis=(1, 2), keepdims=True)
+    return np.divide(components, sums, out=np.zeros_like(components), where=sums > 0)
+
+
+def _blend(
+    components: tuple[npt.NDArray, ...] | npt.NDArray,
+    fluence: float,
+    weights: OrderedDict,
+    grad_x: OrderedDict | None = None,
+    grad_y: OrderedDict | None = None,
+) -> npt.NDArray | tuple[npt.NDArray, tuple[npt.NDArray, npt.NDArray, npt.NDArray]]:
+    """
+    Bilinear blend of decoded components scaled by fluence, as computed by `_init_model_cached`.
+    If the weight derivatives are given, also returns the model derivatives with respect to
+    shift_x, shift_y and fluence, which are blends of the same components.
+    """
+    sky_model = sum(dc * w for dc, w in zip(components, weights.values()))
+    if grad_x is None:
+        return sky_model * float(fluence)
+    return sky_model * float(fluence), (
+        sum(dc * w for dc, w in zip(components, grad_x.values())) * float(fluence),
+        sum(dc * w for dc, w in zip(components, grad_y.values())) * float(fluence),
+        sky_model,
+    )
+
+
+def _pivots(bins: npt.NDArray, lower: float, upper: float) -> tuple[int, int]:
+    """First and last sky pixels holding positions within bounds, as interpolation pivots."""
+    return max(bisect(bins, lower) - 1, 0), min(bisect(bins, upper) - 1, len(bins) - 2)
+
+
+@dataclass
+class _LRUCache:
+    """
+    Least recently used cache of arrays, bounded by the bytes of its values.
+    The memory budget is the "cache_bytes" backend configuration, read at each insertion.
+
+    Attributes:
+        hits: Number of lookups finding their key
+        misses: Number of lookups computing their value
+        evictions: Number of values dropped to stay within budget
+        nbytes: Bytes held by the cached values
+    """
+
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    nbytes: int = 0
+    _entries: OrderedDict = field(default_factory=OrderedDict, repr=False)
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def get(self, key: Hashable, compute: Callable[[], npt.NDArray]) -> npt.NDArray:
         """
-        This is a faster version of compute_model that caches the decoded shadowgram
-        pattern for repeated evaluations with the same source position but different
-        fluence values. This makes it suitable for fluence optimization.
+        Returns the value cached for key, computing and caching it if missing.
+        Values larger than the whole budget are returned without being cached.
 
         Args:
-            shift_x: Source position x-coordinate in sky-shift space (mm)
-            shift_y: Source position y-coordinate in sky-shift space (mm)
-            fluence: Source intensity/fluence value
+            key: the cache key
+            compute: routine computing the value of key
 
         Returns:
-            2D array representing the modeled sky reconstruction
-
-        Notes:
-            - Uses last-value caching for the spatial pattern
-            - Only recomputes pattern when position changes
-            - Scales cached pattern by fluence value
+            The value of key.
         """
-        if cached((shift_x, shift_y)):
-            # note we cache the normalized sky model from the normalized shadowgram.
-            # hence the sky model should be adjusted by the shift.
-            # print("cache hit")
-            return cache_get() * fluence
-        # print("cache miss")
-        sg = model_shadowgram(camera, shift_x, shift_y, 1, vignetting=vignetting, psfy=psfy)
-        cache_set((shift_x, shift_y), decode(camera, sg))
-        return cache_get() * fluence
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            self.misses += 1
+        # values are computed out of the lock, threads missing the same key may compute it twice.
+        value = compute()
+        with self._lock:
+            max_bytes = get_config()["cache_bytes"]
+            # caching a value larger than the whole budget would flush all other values, and then itself.
+            if value.nbytes > max_bytes:
+                return value
+            if key not in self._entries:
+                self._entries[key] = value
+                self.nbytes += value.nbytes
+            while self.nbytes > max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+                self.evictions += 1
+        return value
+
+    def info(self) -> dict:
+        """Returns the cache counters, number of entries, bytes held and memory budget."""
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "nbytes": self.nbytes,
+                "max_bytes": get_config()["cache_bytes"],
+            }
+
+    def clear(self) -> None:
+        """Drops all cached values and resets the counters."""
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = self.evictions = self.nbytes = 0
+
+
+# decoded components of `_init_model_cached`, shared by all `optimize` calls of the process.
+_component_cache = _LRUCache()
+
+
+def component_cache_info() -> dict:
+    """
+    Statistics of the process-wide cache of decoded model components, shared by `optimize` calls.
+    Its memory budget is set by the "cache_bytes" backend configuration, see `mbloodmoon.backend`.
+
+    Returns:
+        A dictionary with the number of cache "hits", "misses" and "evictions", the number of
+        "entries", the bytes they hold ("nbytes") and the memory budget ("max_bytes").
+    """
+    return _component_cache.info()
 
-    return f, cache_clear
 
+def component_cache_clear() -> None:
+    """Frees the process-wide cache of decoded model components and resets its statistics."""
+    _component_cache.clear()
 
-def _init_model_fine(
+
+def _pivot_components(
     camera: CodedMaskCamera,
+    pivot: tuple[int, int],
+    vignetting: bool,
+    psfy: bool,
+) -> npt.NDArray:
+    """
+    The nine components of a pivot decoded over its `chop` window, cached process-wide.
+
+    Returns:
+        (3, 3, h, w) array, indexed by component position relative to the pivot, plus one.
+    """
+
+    def compute():
+        relative_positions = tuple((i, j) for i in (-1, 0, 1) for j in (-1, 0, 1))
+        window, _ = chop(camera, pivot)
+        components = _normalized_components(camera, pivot, relative_positions, vignetting, psfy)
+        decoded = _decode_window_batch(camera, components, window)
+        return decoded.reshape(3, 3, *decoded.shape[-2:])
+
+    return _component_cache.get((camera, pivot, vignetting, psfy), compute)
+
+
+def _init_model_cached(
+    camera: CodedMaskCamera,
+    bounds_x: tuple[float, float],
+    bounds_y: tuple[float, float],
     vignetting: bool = True,
     psfy: bool = True,
-) -> tuple[Callable, Callable]:
+) -> Callable:
     """
-    This version decomposes the model into constituent components and caches them
-    separately. This allows for precise interpolation between grid points while
-    maintaining computational efficiency through caching.
+    Model of a point source at positions within bounds, over their `chop` windows.
+    The model is a bilinear blend of the decoded shadowgrams of the sky pixels around the source position,
+    hence its derivatives are blends of the same components, weighted by the derivatives of the blending weights.
+
+    The nine components a pivot may blend are decoded together by `_decode_window_batch` over
+    the pivot's `chop` window, the window `_loss` and `_loss_jac` compute over, and stored as a
+    (3, 3, h, w) array indexed by component position relative to the pivot. Arrays are kept in
+    a process-wide, memory-bounded LRU cache keyed by camera, pivot, vignetting and psfy, so that
+    pivots visited by an `optimize` call are not decoded again by the next ones, e.g. by the following
+    IROS iterations. Evaluating the model of a visited pivot takes no correlation, only lookups
+    and weighted sums.
 
     Args:
         camera: CodedMaskCamera instance containing all geometric parameters
+        bounds_x: (lower, upper) bounds of the source position x-coordinate in sky-shift space (mm)
+        bounds_y: (lower, upper) bounds of the source position y-coordinate in sky-shift space (mm)
         vignetting: If true, shadowgram model simulates vignetting.
         psfy: If true, the model used for optimization will simulate detector position
         reconstruction effects.
 
     Returns:
-        Two callables. The first is the routine for computing the model, the second
-        is a routine for freeing the cache.
+        The routine for computing the model.
     """
-    RCMAP = {
-        0: slice(1, -1),
-        +1: slice(2, None),
-        -1: slice(None, -2),
-    }
-
-    cache = {}
-
-    def cached(key):
-        return key in cache
-
-    def cache_set(key, value):
-        cache[key] = value
-
-    def cache_get(key):
-        return cache[key]
-
-    def cache_clear():
-        cache.clear()
-
-    def process_mask(shift_x, shift_y):
-        mask_maybe_vignetted = (
-            apply_vignetting(
-                camera,
-                camera.mask,
-                shift_x,
-                shift_y,
-            )
-            if vignetting
-            else camera.mask
-        )
-        mask_maybe_vignetted_maybe_psfy = (
-            convolve(
-                mask_maybe_vignetted,
-                _convolution_kernel_psfy_cached(camera),
-                mode="same",
-            )
-            if psfy
-            else mask_maybe_vignetted
-        )
-        return mask_maybe_vignetted_maybe_psfy
-
-    def normalized_component(framed_shadowgram, relative_position):
-        pos_i, pos_j = relative_position
-        return (s := framed_shadowgram[RCMAP[pos_i], RCMAP[pos_j]] * camera.bulk) / np.sum(s)
-
-    def f(shift_x: float, shift_y: float, fluence: float) -> npt.NDArray:
+    (pi_min, pi_max), (pj_min, pj_max) = _pivots(camera.bins_sky.y, *bounds_y), _pivots(camera.bins_sky.x, *bounds_x)
+
+    def f(
+        shift_x: float,
+        shift_y: float,
+        fluence: float,
+        jac: bool = False,
+        window: tuple[int, int, int, int] | None = None,
+    ) -> npt.NDArray | tuple[npt.NDArray, tuple[npt.NDArray, npt.NDArray, npt.NDArray]]:
         """
-        This version decomposes the model into constituent components and caches them
-        separately. This allows for precise interpolation between grid points while
-        maintaining computational efficiency through caching.
+        Model of the sky within a window, blended from cached pivot components.
 
         Args:
             shift_x: Source position x-coordinate in sky-shift space (mm)
             shift_y: Source position y-coordinate in sky-shift space (mm)
             fluence: Source intensity/fluence value
+            jac: If true, also returns the model derivatives with respect to the parameters.
+            window: Optional (min_i, max_i, min_j, max_j) slice of the sky the model is computed over.
+                Defaults to None, the `chop` window of the source position.
 
         Returns:
-            2D array representing the modeled sky reconstruction
+            2D array representing the modeled sky reconstruction within the window. If `jac`,
+            a tuple of the model and of its derivatives with respect to shift_x, shift_y and fluence.
 
-        Notes:
-            - Caches individual spatial components
-            - Suitable for source position optimization
+        Raises:
+            ValueError: If the position is out of bounds, or the window out of its `chop` window.
         """
-        components, pivot = _rbilinear_relative(shift_x, shift_y, camera.bins_sky.x, camera.bins_sky.y)
-        relative_positions = tuple(components.keys())
-        if cached((pivot, *relative_positions)):
-            # print("cache hit")
-            decoded_components = cache_get((pivot, *relative_positions))
-        else:
-            # print("no cache hit")
-            n, m = camera.sky_shape
-            pivot_i, pivot_j = pivot
-            i_min, i_max, j_min, j_max = _detector_footprint_cached(camera)
-            r, c = (n // 2 - pivot_i), (m // 2 - pivot_j)
-
-            # we call with pivot because calling with shifts to ensure consistent cached/vignetting combos
-            mask_processed = process_mask(camera.bins_sky.x[pivot_j], camera.bins_sky.y[pivot_i])
-            mask_shifted_processed = _shift(mask_processed, (r, c))
-            framed_shadowgram = mask_shifted_processed[i_min - 1 : i_max + 1, j_min - 1 : j_max + 1]
-
-            # this makes me suffer, there should be a way to not compute decode four times..
-            # TODO: is it possible to obtain the same behaviour without four decodings?
-            decoded_components = tuple(
-                map(
-                    lambda x: decode(camera, x),
-                    (normalized_component(framed_shadowgram, rpos) for rpos in relative_positions),
-                )
+        if jac:
+            weights, grad_x, grad_y, (pivot_i, pivot_j) = _rbilinear_relative_gradient(
+                shift_x, shift_y, camera.bins_sky.x, camera.bins_sky.y
             )
-            cache_set((pivot, *relative_positions), decoded_components)
-        sky_model = sum(dc * w for dc, w in zip(decoded_components, components.values()))
-        return sky_model * fluence
+        else:
+            (weights, (pivot_i, pivot_j)), grad_x, grad_y = _rbilinear_relative(
+                shift_x, shift_y, camera.bins_sky.x, camera.bins_sky.y
+            ), None, None
+        if not (pi_min <= pivot_i <= pi_max and pj_min <= pivot_j <= pj_max):
+            raise ValueError(f"Source position ({shift_x}, {shift_y}) is out of the model bounds.")
+        pivot_window, _ = chop(camera, (pivot_i, pivot_j))
+        min_i, max_i, min_j, max_j = pivot_window if window is None else window
+        if not (
+            pivot_window[0] <= min_i
+            and max_i <= pivot_window[1]
+            and pivot_window[2] <= min_j
+            and max_j <= pivot_window[3]
+        ):
+            raise ValueError(f"Window {window} is out of the source window {pivot_window}.")
+        components = _pivot_components(camera, (pivot_i, pivot_j), vignetting, psfy)[
+            :,
+            :,
+            min_i - pivot_window[0] : max_i - pivot_window[0],
+            min_j - pivot_window[2] : max_j - pivot_window[2],
+        ]
+        return _blend(tuple(components[i + 1, j + 1] for i, j in weights), fluence, weights, grad_x, grad_y)
 
-    return f, cache_clear
+    return f
 
 
 def _loss(model_f: Callable) -> Callable:
@@ -290,6 +465,46 @@ def _loss(model_f: Callable) -> Callable:
     return f
 
 
+def _loss_jac(model_f: Callable) -> Callable:
+    """
+    Same as `_loss`, for models computing their derivatives, e.g. from `_init_model_cached`.
+
+    Args:
+        model_f: Callable that generates model predictions and derivatives. Should have signature:
+            model_f(shift_x, shift_y, fluence, jac=True, window=window) -> (np.array, tuple of 3 np.array)
+
+    Returns:
+        Callable that computes the loss and its gradient with signature:
+            f(args: np.array, truth: np.array, camera: CodedMaskCamera) -> tuple[float, np.array]
+    """
+
+    def f(args: npt.NDArray, truth: npt.NDArray, camera: CodedMaskCamera) -> tuple[float, npt.NDArray]:
+        """
+        Compute MSE loss between model prediction and truth within the `chop` window, and its
+        gradient. The window is piecewise constant in the source position, hence ignored
+        when differentiating.
+
+        Args:
+            args: Array of [shift_x, shift_y, fluence] parameters to evaluate
+            truth: Full observed sky image to compare against
+            camera: CodedMaskCamera instance containing geometry information
+
+        Returns:
+            Mean Squared Error between model and truth in local window, and its gradient
+            with respect to [shift_x, shift_y, fluence].
+        """
+        shift_x, shift_y, fluence = args
+        window, _ = chop(camera, shift2pos(camera, shift_x, shift_y))
+        min_i, max_i, min_j, max_j = window
+        model, model_jac = model_f(shift_x, shift_y, fluence, jac=True, window=window)
+        residual = truth[min_i:max_i, min_j:max_j] - model
+        mse = np.mean(np.square(residual))
+        grad = np.array([-2 * np.mean(residual * dm) for dm in model_jac])
+        return float(mse), grad
+
+    return f
+
+
 def optimize(
     camera: CodedMaskCamera,
     sky: npt.NDArray,
@@ -302,11 +517,13 @@ def optimize(
     Perform two-stage optimization to fit a point source model to sky image data.
 
     This function performs a two-stage optimization:
-    1. Coarse optimization of fluence only, keeping position fixed
+    1. Coarse optimization of fluence only, keeping position fixed.
+       The model being linear in fluence, this step is solved in closed form.
     2. Fine, simultaneous optimization of position and fluence.
        This step is warm-started with the flux value inferred from the coarse step.
 
-    The process uses different model at each stage to balance speed and accuracy.
+    The coarse step solves the linear least squares of `_fluence_lstsq`. The fine step blends
+    decoded components cached across calls, see `_init_model_cached`.
 
     Args:
         camera: CodedMaskCamera instance containing detector and mask parameters
@@ -315,7 +532,7 @@ def optimize(
         vignetting: If true, the model used for optimization will simulate vignetting.
         psfy: If true, the model used for optimization will simulate detector position
         reconstruction effects.
-        verbose: If true, prints the output from the optimizer.
+        verbose: If true, prints the result of the optimizer.
 
     Returns:
         Tuple containing the best-fit parameters `(x, y, fluence)` where:
@@ -330,62 +547,48 @@ def optimize(
     shift_start_x, shift_start_y = _interpmax(camera, arg_sky, sky, UpscaleFactor(10, 10))
     fluence_start = sky.max()
 
-    # initialize the function to compute coarse, fluence-dependent shadowgram model.
-    # to reduce the number of cross-correlation the function is cached. it is our
-    # responsibility to clear cache, freeing memory, after we will be done with the
-    # the coarse fluence step.
-    _compute_model_coarse, _compute_model_coarse_cache_clear = _init_model_coarse(camera, vignetting, psfy)
-    loss_coarse = _loss(_compute_model_coarse)
-    results = minimize(
-        lambda args: loss_coarse((shift_start_x, shift_start_y, args[0]), sky, camera),
-        x0=np.array((fluence_start,)),
-        method="L-BFGS-B",
-        bounds=[
-            (0.75 * fluence_start, 1.5 * fluence_start),
-        ],
-        options={
-            "maxiter": 10,
-            "iprint": 1 if verbose else -1,
-            "ftol": 10e-5,
-        },
+    # the coarse fluence is solved in closed form, the model being linear in fluence.
+    coarse_fluence = _fluence_lstsq(
+        camera,
+        sky,
+        shift_start_x,
+        shift_start_y,
+        bounds=(0.75 * fluence_start, 1.5 * fluence_start),
+        vignetting=vignetting,
+        psfy=psfy,
+    )
+
+    bounds_x = (
+        max(shift_start_x - camera.mdl["slit_deltax"] / 2, camera.bins_sky.x[0]),
+        min(shift_start_x + camera.mdl["slit_deltax"] / 2, camera.bins_sky.x[-1]),
     )
-    # we use the best fluence value as the initial value for the next step.
-    coarse_fluence = results.x[0]
-    # releases model cache memory.
-    _compute_model_coarse_cache_clear()
-
-    # initialize the function to fine coarse, fluence and position dependent shadowgram model.
-    # this is slower to compute and requires more memory. again it leverages caches to reduce
-    # the number of cross-correlation computations, and it is our responsibility to free
-    # memory after we will be done.
-    _compute_model_fine, _compute_model_fine_cache_clear = _init_model_fine(camera, vignetting, psfy)
-    loss_fine = _loss(_compute_model_fine)
+    bounds_y = (
+        max(shift_start_y - camera.mdl["slit_deltay"] / 2, camera.bins_sky.y[0]),
+        min(shift_start_y + camera.mdl["slit_deltay"] / 2, camera.bins_sky.y[-1]),
+    )
+    # the fine model blends the components of the pivots visited within bounds, decoded over the
+    # windows the loss is computed in. they are cached across calls, e.g. over IROS iterations.
+    loss_fine = _loss_jac(_init_model_cached(camera, bounds_x, bounds_y, vignetting, psfy))
     results = minimize(
         lambda args: loss_fine((args[0], args[1], args[2]), sky, camera),
+        jac=True,
         x0=np.array((shift_start_x, shift_start_y, coarse_fluence)),
         method="L-BFGS-B",
         bounds=[
-            (
-                max(shift_start_x - camera.mdl["slit_deltax"] / 2, camera.bins_sky.x[0]),
-                min(shift_start_x + camera.mdl["slit_deltax"] / 2, camera.bins_sky.x[-1]),
-            ),
-            (
-                max(shift_start_y - camera.mdl["slit_deltay"] / 2, camera.bins_sky.y[0]),
-                min(shift_start_y + camera.mdl["slit_deltay"] / 2, camera.bins_sky.y[-1]),
-            ),
+            bounds_x,
+            bounds_y,
             (0.95 * coarse_fluence, 1.05 * coarse_fluence),
         ],
         options={
             "maxiter": 10,
-            "iprint": 1 if verbose else -1,
             "ftol": 10e-5,
         },
     )
+    # L-BFGS-B no longer takes the `disp` and `iprint` options, its result is printed instead.
+    if verbose:
+        print(results)
     # store the final optimized positions and fluence.
     x, y, fluence = map(float, results.x[:3])
-
-    # releases model cache memory.
-    _compute_model_fine_cache_clear()
     return x, y, fluence
 
 
@@ -415,6 +618,82 @@ jesus pleasee look upon it
 """
 
 
+# name of the file recording the state of a checkpointed `iros` run.
+_CHECKPOINT_STATE = "state.json"
+# state entries a run must share with the checkpoint it resumes.
+_CHECKPOINT_KEYS = ("loaders", "dataset", "sky_shape", "dtype", "snr_threshold", "psf_library")
+
+
+def _save_checkpoint(
+    checkpoint_dir: Path,
+    state: dict,
+    skys: tuple[npt.NDArray, ...] | None = None,
+    variances: tuple[npt.NDArray, ...] | None = None,
+) -> None:
+    """
+    Records the state of an `iros` run, and optionally its residual skies and variances.
+
+    Skies alternate between two slots of files, and the state file pointing to the
+    latest complete slot is replaced last, atomically. An interruption at any point
+    thus leaves the previous checkpoint intact. Variances are only written when a run starts,
+    after removing the state file of any previous run, which would not match them.
+
+    Args:
+        checkpoint_dir: the checkpoint directory.
+        state: the run state, updated in place with the slot of `skys`.
+        skys: the residual skies after the present iteration, None if they did not change.
+        variances: the sky variances of a starting run, None if they did not change.
+    """
+    if variances is not None:
+        (checkpoint_dir / _CHECKPOINT_STATE).unlink(missing_ok=True)
+        for k, var_ in enumerate(variances):
+            tmp_path = checkpoint_dir / f".var{k}.npy"
+            np.save(tmp_path, var_)
+            os.replace(tmp_path, checkpoint_dir / f"var{k}.npy")
+    if skys is not None:
+        state["slot"] = 1 - state["slot"]
+        for k, sky in enumerate(skys):
+            # arrays are written to a new file and renamed, so that arrays still mapping the old one stay valid.
+            tmp_path = checkpoint_dir / f".sky{k}_{state['slot']}.npy"
+            np.save(tmp_path, sky)
+            os.replace(tmp_path, checkpoint_dir / f"sky{k}_{state['slot']}.npy")
+    tmp_path = checkpoint_dir / f".{_CHECKPOINT_STATE}"
+    with open(tmp_path, "w") as f:
+        json.dump(state, f)
+    os.replace(tmp_path, checkpoint_dir / _CHECKPOINT_STATE)
+
+
+def _load_checkpoint(
+    checkpoint_dir: Path,
+    state: dict,
+) -> tuple[dict, tuple[npt.NDArray, ...], tuple[npt.NDArray, ...]] | None:
+    """
+    Reads the state of an interrupted `iros` run, with memory-mapped skies and variances.
+
+    Args:
+        checkpoint_dir: the checkpoint directory.
+        state: the initial state of the run being resumed, whose data and settings must match the checkpoint's.
+
+    Returns:
+        The checkpointed run state, residual skies and variances. None if there is no checkpoint.
+
+    Raises:
+        ValueError: If the checkpoint was written by a run over different data, or with different settings.
+    """
+    try:
+        with open(checkpoint_dir / _CHECKPOINT_STATE) as f:
+            saved = json.load(f)
+    except FileNotFoundError:
+        return None
+    if mismatches := [key for key in _CHECKPOINT_KEYS if saved.get(key) != state[key]]:
+        raise ValueError(
+            f"Checkpoint in {checkpoint_dir} was written by an IROS run with different {', '.join(mismatches)}."
+        )
+    skys = tuple(np.load(checkpoint_dir / f"sky{k}_{saved['slot']}.npy", mmap_mode="r") for k in range(2))
+    variances = tuple(np.load(checkpoint_dir / f"var{k}.npy", mmap_mode="r") for k in range(2))
+    return saved, skys, variances
+
+
 def iros(
     camera: CodedMaskCamera,
     sdl_cam1a: SimulationDataLoader,
@@ -422,6 +701,12 @@ def iros(
     max_iterations: int,
     snr_threshold: float = 0.0,
     dataset: Literal["detected", "reconstructed"] = "reconstructed",
+    detectors: tuple[npt.NDArray, npt.NDArray] | None = None,
+    checkpoint_dir: str | Path | None = None,
+    resume: bool = False,
+    psf_library: PSFLibrary | None = None,
+    psf_tolerance: float = PSFLIB_TOLERANCE,
+    on_reconstruct: Callable[[tuple, tuple], None] | None = None,
 ) -> Iterable:
     """Performs Iterative Removal of Sources (IROS) for dual-camera WFM observations.
 
@@ -442,6 +727,25 @@ def iros(
             residual SNR falls below this value. Defaults to 0. (no threshold).
         dataset: Which dataset to analyze. Either "detected" (simulated data prior to reconstruction)
             or "reconstructed" (position-reconstructed data). Defaults to "reconstructed"
+        detectors: Optional detector images of the two cameras, ordered as sdl_cam1a, sdl_cam1b,
+            e.g. from `mbloodmoon.io.prefetch`. Defaults to None, counting the loaders' photon events.
+        checkpoint_dir: Optional directory where the residual skies, variances, sources found and
+            iteration index are stored after each iteration. Defaults to None, no checkpoints.
+        resume: If true, continues the run checkpointed in `checkpoint_dir` from its next iteration,
+            without counting or decoding again. Starts a new run if there is no checkpoint.
+            Defaults to False, overwriting any checkpoint.
+        psf_library: Optional library of decoded point-source responses, from `mbloodmoon.psflib`, simulating
+            the effects of `dataset`. If provided, sources whose library error is within `psf_tolerance` are
+            removed by subtracting the library model, which takes no sky correlation, rather than `model_sky`.
+            Defaults to None, subtracting `model_sky`.
+        psf_tolerance: Largest library error of the sources removed with the library model, the whole-sky
+            difference from `model_sky` relative to the source peak, see `PSFLibrary.error`.
+            Defaults to `psflib.PSFLIB_TOLERANCE`.
+        on_reconstruct: Optional callback receiving the sky images and variances of the two cameras,
+            ordered as sdl_cam1a, sdl_cam1b, before the first iteration, e.g. `CatalogWriter.start`.
+            When resuming, sky images are the residuals of the last checkpointed iteration, so that the SNR of
+            a resumed `CatalogWriter` is measured on them, see `CatalogWriter`.
+            Defaults to None.
 
     Yields:
         For each iteration, yields:
@@ -453,6 +757,8 @@ def iros(
     Raises:
         ValueError: If cameras are not oriented orthogonally (90° rotation in azimuth)
         ValueError: If dataset argument is not "detected" or "reconstructed"
+        ValueError: If resuming without a checkpoint directory, or from a checkpoint of different data or settings
+        ValueError: If the PSF library does not simulate the effects of `dataset`
         RuntimeError: If source parameter optimization fails (with detailed error message)
 
     Notes:
@@ -471,6 +777,12 @@ def iros(
     >>>     source_1a, source_1b = sources
     >>>     residual_1a, residual_1b = residuals
     >>>     ...
+
+    Sources found before an interruption are stored in the checkpoint state, e.g.:
+    >>> for sources, residuals in iros(camera, sdl_cam1a, sdl_cam1b, 30, checkpoint_dir=path, resume=True):
+    >>>     ...
+    >>> with open(path / "state.json") as f:
+    >>>     all_sources = json.load(f)["sources"]
     """
     from astropy.coordinates import angular_separation
 
@@ -501,6 +813,12 @@ def iros(
 
     if dataset not in ["detected", "reconstructed"]:
         raise ValueError("Argument `dataset` must be either `detected` or `reconstructed`.")
+    if resume and checkpoint_dir is None:
+        raise ValueError("Resuming requires a checkpoint directory.")
+    # reconstructed data feature vignetting and detector position reconstruction effects, detected data do not.
+    effects = dataset == "reconstructed"
+    if psf_library is not None and (psf_library.vignetting != effects or psf_library.psfy != effects):
+        raise ValueError(f"The PSF library effects do not match the `{dataset}` dataset.")
 
     def direction_match(
         a: tuple[int, int],
@@ -623,25 +941,84 @@ def iros(
                 camera,
                 sky,
                 arg,
-                psfy=True if dataset == "reconstructed" else False,
-                vignetting=True if dataset == "reconstructed" else False,
+                psfy=effects,
+                vignetting=effects,
             )
         except Exception as e:
             raise RuntimeError(f"Optimization failed: {str(e)}") from e
-        model = model_sky(camera, *source)
+        # sources are removed with the same model they were fitted with.
+        # the library does not model the sidelobes beyond its windows, which must be small.
+        if psf_library is not None and psf_library.error(*source[:2]) <= psf_tolerance:
+            model = psf_library.model_sky(*source)
+        else:
+            model = model_sky(camera, *source, vignetting=effects, psfy=effects)
         residual = sky - model
         return source, residual
 
-    detectors = tuple(count(camera, sdl.data)[0] for sdl in sdls)
-    variances = tuple(variance(camera, d) for d in detectors)
-    skys = tuple(decode(camera, d) for d in detectors)
-    for i in range(max_iterations):
+    # the run state is checkpointed with skies and variances in the order of `sdls`,
+    # and sources in the order they are yielded.
+    state = {
+        "loaders": [str(sdl.filepath) for sdl in sdls],
+        "dataset": dataset,
+        "sky_shape": list(camera.sky_shape),
+        "dtype": np.dtype(camera.dtype).name,
+        "snr_threshold": float(snr_threshold),
+        "psf_library": None
+        if psf_library is None
+        else {
+            "nodes": [len(psf_library.nodes_i), len(psf_library.nodes_j)],
+            "radius": list(psf_library.radius),
+            "vignetting": psf_library.vignetting,
+            "psfy": psf_library.psfy,
+            "tolerance": float(psf_tolerance),
+        },
+        "iteration": 0,
+        "slot": 1,
+        "sources": [],
+    }
+    checkpoint = None
+    if checkpoint_dir is not None:
+        checkpoint_dir = Path(checkpoint_dir)
+        checkpoint_dir.mkdir(parents=True, exist_ok=True)
+        if resume:
+            checkpoint = _load_checkpoint(checkpoint_dir, state)
+
+    if checkpoint is not None:
+        state, skys, variances = checkpoint
+    else:
+        if detectors is None:
+            detectors = tuple(count(camera, sdl.data)[0] for sdl in sdls)
+        elif sdls != (sdl_cam1a, sdl_cam1b):
+            detectors = detectors[::-1]
+        skys, variances, _ = zip(*(reconstruct(camera, d) for d in detectors))
+        if checkpoint_dir is not None:
+            _save_checkpoint(checkpoint_dir, state, skys, variances)
+
+    if on_reconstruct is not None:
+        if sdls != (sdl_cam1a, sdl_cam1b):
+            on_reconstruct(skys[::-1], variances[::-1])
+        else:
+            on_reconstruct(skys, variances)
+
+    for i in range(state["iteration"], max_iterations):
         candidates = find_candidates(skys)
         if not candidates:
             break
         try:
-            sources, skys = zip(*(subtract(index, sky) for index, sky in zip(candidates, skys)))
+            sources, skys_ = zip(*(subtract(index, sky) for index, sky in zip(candidates, skys)))
         except RuntimeError as e:
             warnings.warn(f"Optimizer failed at iteration {i}:\n\n{e}")
+            if checkpoint_dir is not None:
+                state["iteration"] = i + 1
+                _save_checkpoint(checkpoint_dir, state)
             continue
-        yield (sources, skys) if sdls == (sdl_cam1a, sdl_cam1b) else (sources[::-1], skys)
+        skys = skys_
+        # residuals are kept in the order of `sdls` and yielded together with their sources.
+        residuals = skys
+        if sdls != (sdl_cam1a, sdl_cam1b):
+            sources, residuals = sources[::-1], skys[::-1]
+        if checkpoint_dir is not None:
+            state["iteration"] = i + 1
+            state["sources"].append(sources)
+            _save_checkpoint(checkpoint_dir, state, skys)
+        yield sources, residuals
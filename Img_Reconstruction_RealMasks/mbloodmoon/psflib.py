@@ -0,0 +1,452 @@
+"""
+Libraries of decoded point-source responses.
+
+This module provides:
+- A builder decoding the response of a unit point source at the nodes of a coarse sky grid,
+  and storing it on disk as a memory-mappable array with a JSON sidecar
+- A reader opening a stored library for a camera
+- A sky model interpolating the library, to be used in place of `model_sky`
+- A quality check of the library model against `model_sky`
+
+Each node stores the decoded shadowgram of a point source at its center, before normalization,
+over a window centered on the node, together with the shadowgram sum. Decoding is linear, so that blending
+these as `model_shadowgram` blends shadowgrams and normalizing by the blended sum models a source with
+lookups over its window, rather than with a sky correlation. Pixels between nodes translate the node responses.
+
+The library does not model the sky beyond the windows, where random masks leave sidelobes, nor translation
+errors between nodes. Both are measured when building the library: each grid cell records the largest
+whole-sky difference from `model_sky` of the sources at its corners and center, relative to their peak.
+Sidelobes are small in the fully coded field, while partially coded sources may cast ghosts far from
+their peak, so that the library is only to be used where the error of the cell is within a tolerance.
+"""
+
+from dataclasses import dataclass
+import json
+import os
+from pathlib import Path
+import shutil
+import tempfile
+
+import numpy as np
+import numpy.typing as npt
+
+from .images import _rbilinear_relative
+from .mask import _camera_cache_key
+from .mask import _unnormalized_shadowgram
+from .mask import CodedMaskCamera
+from .mask import decode
+from .mask import model_sky
+
+# names of the library files.
+_PSFLIB_RESPONSES = "responses.npy"
+_PSFLIB_SUMS = "sums.npy"
+_PSFLIB_ERRORS = "errors.npy"
+_PSFLIB_META = "meta.json"
+
+# largest whole-sky difference from `model_sky` relative to the source peak, for which `iros`
+# subtracts the library model of a source, see `PSFLibrary.error`.
+PSFLIB_TOLERANCE = 0.1
+
+
+def _nodes(length: int, stride: int) -> npt.NDArray:
+    """Indices of the grid nodes along an axis of `length` pixels, including both ends."""
+    return np.unique(np.append(np.arange(0, length, stride), length - 1))
+
+
+def _node_weights(nodes: npt.NDArray, index: int) -> list[tuple[int, float]]:
+    """Linear interpolation weights of the nodes around a pixel index."""
+    if len(nodes) == 1:
+        return [(0, 1.0)]
+    k = _cell(nodes, index)
+    t = (index - nodes[k]) / (nodes[k + 1] - nodes[k])
+    return [(k, 1.0 - t), (k + 1, t)]
+
+
+def _cell(nodes: npt.NDArray, index: int) -> int:
+    """Grid cell holding a pixel index, numbered after its first node."""
+    return int(np.clip(np.searchsorted(nodes, index, side="right") - 1, 0, max(len(nodes) - 2, 0)))
+
+
+def _model_errors(library: "PSFLibrary", shift_x: float, shift_y: float, exact: npt.NDArray) -> tuple[float, float]:
+    """
+    Relative norm of the difference between the library model of a unit source and `model_sky` within the
+    library window, and the largest difference over the whole sky relative to the peak of the source.
+    The peak is that of the source at the center of the pixels it is blended from, as sources
+    between pixels have lower peaks than the sidelobes they blend.
+    """
+    min_i, max_i, min_j, max_j = library.window(shift_x, shift_y)
+    difference = library.model_sky(shift_x, shift_y, 1.0) - exact
+    components, (pivot_i, pivot_j) = _rbilinear_relative(
+        shift_x, shift_y, library.camera.bins_sky.x, library.camera.bins_sky.y
+    )
+    peak = max(
+        np.max(np.abs(response)) / total
+        for response, total in (
+            library._interpolate(pivot_i + di, pivot_j + dj) for (di, dj), weight in components.items() if weight
+        )
+        if total > 0
+    )
+    return (
+        float(np.linalg.norm(difference[min_i:max_i, min_j:max_j]) / np.linalg.norm(exact[min_i:max_i, min_j:max_j])),
+        float(np.max(np.abs(difference)) / peak),
+    )
+
+
+@dataclass(frozen=True)
+class PSFLibrary:
+    """
+    Decoded responses of a unit point source at the nodes of a sky grid, see `build_psf_library`.
+
+    Attributes:
+        camera: CodedMaskCamera the library was built for
+        nodes_i: Sky rows of the grid nodes
+        nodes_j: Sky columns of the grid nodes
+        responses: (len(nodes_i), len(nodes_j), 2 * radius_i + 1, 2 * radius_j + 1) array of decoded shadowgrams
+            before normalization, each centered on its node. Parts of the windows out of the sky are zero.
+        sums: (len(nodes_i), len(nodes_j)) array of shadowgram sums before normalization,
+            zero for nodes out of the field of view.
+        errors: (len(nodes_i) - 1, len(nodes_j) - 1) array of the largest whole-sky differences from `model_sky`
+            of sources at the corners and center of each grid cell, relative to the source peak.
+            Sources between these samples may exceed it by a few percent.
+            Infinite for cells whose center is out of the field of view.
+        radius: (radius_i, radius_j) half sizes of the response windows, in sky pixels
+        vignetting: If true, responses simulate vignetting
+        psfy: If true, responses simulate detector position reconstruction effects
+    """
+
+    camera: CodedMaskCamera
+    nodes_i: npt.NDArray
+    nodes_j: npt.NDArray
+    responses: npt.NDArray
+    sums: npt.NDArray
+    errors: npt.NDArray
+    radius: tuple[int, int]
+    vignetting: bool
+    psfy: bool
+
+    def _interpolate(self, i: int, j: int) -> tuple[npt.NDArray, float]:
+        """
+        Decoded shadowgram and shadowgram sum before normalization of a point source at the center of a sky pixel.
+        Those of the four nodes around the pixel are translated onto it and linearly interpolated.
+        """
+        weights = [
+            (ki, kj, wi * wj)
+            for ki, wi in _node_weights(self.nodes_i, i)
+            for kj, wj in _node_weights(self.nodes_j, j)
+        ]
+        return (
+            sum(self.responses[ki, kj] * w for ki, kj, w in weights),
+            float(sum(self.sums[ki, kj] * w for ki, kj, w in weights)),
+        )
+
+    def response(self, i: int, j: int) -> npt.NDArray:
+        """
+        Decoded response of a unit point source at the center of a sky pixel.
+        Nodes out of the field of view do not contribute to the interpolation.
+
+        Args:
+            i: sky row of the source pixel
+            j: sky column of the source pixel
+
+        Returns:
+            (2 * radius_i + 1, 2 * radius_j + 1) array, centered on the pixel.
+
+        Raises:
+            ValueError: If all the nodes around the pixel are out of the field of view.
+        """
+        response, total = self._interpolate(i, j)
+        if total <= 0:
+            raise ValueError("The source is out of the field of view of the library.")
+        return response / total
+
+    def window(self, shift_x: float, shift_y: float) -> tuple[int, int, int, int]:
+        """
+        Sky window modeled by `model_sky`, where the responses of all the pixels blended for a source overlap.
+
+        Args:
+            shift_x: Source position x-coordinate in sky-shift space (mm)
+            shift_y: Source position y-coordinate in sky-shift space (mm)
+
+        Returns:
+            (min_i, max_i, min_j, max_j) sky window, upper bounds excluded.
+        """
+        n, m = self.camera.sky_shape
+        radius_i, radius_j = self.radius
+        components, (pivot_i, pivot_j) = _rbilinear_relative(
+            shift_x, shift_y, self.camera.bins_sky.x, self.camera.bins_sky.y
+        )
+        di, dj = map(np.array, zip(*(k for k, weight in components.items() if weight)))
+        return (
+            max(pivot_i + di.max() - radius_i, 0),
+            min(pivot_i + di.min() + radius_i + 1, n),
+            max(pivot_j + dj.max() - radius_j, 0),
+            min(pivot_j + dj.min() + radius_j + 1, m),
+        )
+
+    def error(self, shift_x: float, shift_y: float) -> float:
+        """
+        Largest whole-sky difference of `model_sky` from `mbloodmoon.model_sky`, relative to the source peak,
+        as measured over the grid cells of the pixels blended for a source.
+
+        Args:
+            shift_x: Source position x-coordinate in sky-shift space (mm)
+            shift_y: Source position y-coordinate in sky-shift space (mm)
+
+        Returns:
+            The error of the source, see `errors`.
+        """
+        components, (pivot_i, pivot_j) = _rbilinear_relative(
+            shift_x, shift_y, self.camera.bins_sky.x, self.camera.bins_sky.y
+        )
+        return float(
+            max(
+                self.errors[_cell(self.nodes_i, pivot_i + di), _cell(self.nodes_j, pivot_j + dj)]
+                for (di, dj), weight in components.items()
+                if weight
+            )
+        )
+
+    def model_sky(self, shift_x: float, shift_y: float, fluence: float) -> npt.NDArray:
+        """
+        Same as `model_sky`, from library responses rather than from a sky correlation.
+        Sub-pixel positions blend pixel responses with the bilinear weights of `model_shadowgram`,
+        and are normalized by the blended shadowgram sum.
+
+        Args:
+            shift_x: Source position x-coordinate in sky-shift space (mm)
+            shift_y: Source position y-coordinate in sky-shift space (mm)
+            fluence: Source intensity/fluence value
+
+        Returns:
+            2D array representing the modeled sky reconstruction within `window`, and zero beyond it.
+
+        Raises:
+            ValueError: If the source is out of the field of view of the library.
+        """
+        radius_i, radius_j = self.radius
+        components, (pivot_i, pivot_j) = _rbilinear_relative(
+            shift_x, shift_y, self.camera.bins_sky.x, self.camera.bins_sky.y
+        )
+        # out of the window, some of the blended responses are missing.
+        min_i, max_i, min_j, max_j = self.window(shift_x, shift_y)
+        sky = np.zeros(self.camera.sky_shape, dtype=self.camera.dtype)
+        total = 0.0
+        for (di, dj), weight in components.items():
+            if not weight:
+                continue
+            i, j = pivot_i + di, pivot_j + dj
+            response, sum_ = self._interpolate(i, j)
+            sky[min_i:max_i, min_j:max_j] += (
+                response[min_i - i + radius_i : max_i - i + radius_i, min_j - j + radius_j : max_j - j + radius_j]
+                * weight
+            )
+            total += sum_ * weight
+        if total <= 0:
+            raise ValueError("The source is out of the field of view of the library.")
+        return sky * (float(fluence) / total)
+
+
+def build_psf_library(
+    camera: CodedMaskCamera,
+    dirpath: str | Path,
+    stride: tuple[int, int] | None = None,
+    radius: tuple[int, int] | None = None,
+    vignetting: bool = True,
+    psfy: bool = True,
+) -> PSFLibrary:
+    """
+    Decodes the response of a point source at the center of each node of a sky grid, and stores
+    its window in a library directory, written to a memory-mapped array so that memory does not grow
+    with the grid size. The library takes `len(nodes_i) * len(nodes_j) * (2 * radius_i + 1) * (2 * radius_j + 1)`
+    elements on disk. The directory is written under a temporary name first and then renamed, so that
+    it is never seen incomplete.
+
+    Args:
+        camera: CodedMaskCamera instance containing all geometric parameters
+        dirpath: Path to the library directory, to be created
+        stride: (rows, columns) sky pixels between grid nodes.
+            Defaults to the slit size, the resolution of the camera.
+        radius: (rows, columns) half sizes of the response windows, in sky pixels.
+            Defaults to four times the slit size, covering the peak and its first sidelobes.
+        vignetting: If true, responses simulate vignetting.
+        psfy: If true, responses simulate detector position reconstruction effects.
+
+    Returns:
+        The library, with memory-mapped responses.
+
+    Raises:
+        ValueError: If stride or radius are not positive and non-negative integers, respectively.
+        OSError: If the library directory already exists and is not empty.
+
+    Notes:
+        - Building takes a shadowgram and a whole-sky decoding per node, measuring the sidelobes out of
+          its window, and a `model_sky` per grid cell, measuring the error at its center, see `PSFLibrary.errors`.
+        - Nodes out of the field of view cast no shadowgram. Their sum is zero, so that they do not contribute
+          to the responses of the pixels around them.
+    """
+    bins = camera.bins_sky
+    n, m = camera.sky_shape
+    # slit sizes are rounded before taking the ceiling, against floating point noise.
+    slit = (
+        max(int(np.ceil(np.round(camera.mdl["slit_deltay"] / (bins.y[1] - bins.y[0]), 6))), 1),
+        max(int(np.ceil(np.round(camera.mdl["slit_deltax"] / (bins.x[1] - bins.x[0]), 6))), 1),
+    )
+    stride = slit if stride is None else tuple(stride)
+    radius = (4 * slit[0], 4 * slit[1]) if radius is None else tuple(radius)
+    if not all(isinstance(s, (int, np.integer)) and s > 0 for s in stride):
+        raise ValueError("Grid stride must be a couple of positive integers.")
+    if not all(isinstance(r, (int, np.integer)) and r >= 0 for r in radius):
+        raise ValueError("Window radius must be a couple of non-negative integers.")
+
+    (radius_i, radius_j), nodes_i, nodes_j = map(int, radius), _nodes(n, stride[0]), _nodes(m, stride[1])
+    dirpath = Path(dirpath)
+    dirpath.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = Path(tempfile.mkdtemp(dir=dirpath.parent))
+    try:
+        responses = np.lib.format.open_memmap(
+            tmp_path / _PSFLIB_RESPONSES,
+            mode="w+",
+            dtype=camera.dtype,
+            shape=(len(nodes_i), len(nodes_j), 2 * radius_i + 1, 2 * radius_j + 1),
+        )
+        sums = np.zeros((len(nodes_i), len(nodes_j)))
+        sidelobes = np.zeros((len(nodes_i), len(nodes_j)))
+        for ki, i in enumerate(nodes_i):
+            for kj, j in enumerate(nodes_j):
+                window = (
+                    max(i - radius_i, 0),
+                    min(i + radius_i + 1, n),
+                    max(j - radius_j, 0),
+                    min(j + radius_j + 1, m),
+                )
+                shadowgram = _unnormalized_shadowgram(
+                    camera,
+                    (bins.x[j] + bins.x[j + 1]) / 2,
+                    (bins.y[i] + bins.y[i + 1]) / 2,
+                    vignetting,
+                    psfy,
+                )
+                sums[ki, kj] = np.sum(shadowgram)
+                # sources out of the field of view cast no shadowgram, their response is left zero.
+                if sums[ki, kj] <= 0:
+                    sums[ki, kj] = 0.0
+                    continue
+                sky = decode(camera, shadowgram)
+                responses[
+                    ki,
+                    kj,
+                    window[0] - i + radius_i : window[1] - i + radius_i,
+                    window[2] - j + radius_j : window[3] - j + radius_j,
+                ] = sky[window[0] : window[1], window[2] : window[3]]
+                # sidelobes out of the window, relative to the peak within it.
+                peak = np.max(np.abs(sky[window[0] : window[1], window[2] : window[3]]))
+                sky[window[0] : window[1], window[2] : window[3]] = 0.0
+                sidelobes[ki, kj] = np.max(np.abs(sky)) / peak
+
+        errors = np.zeros((max(len(nodes_i) - 1, 1), max(len(nodes_j) - 1, 1)))
+        library = PSFLibrary(
+            camera=camera,
+            nodes_i=nodes_i,
+            nodes_j=nodes_j,
+            responses=responses,
+            sums=sums,
+            errors=errors,
+            radius=(radius_i, radius_j),
+            vignetting=vignetting,
+            psfy=psfy,
+        )
+        for ci, cj in np.ndindex(errors.shape):
+            i, j = nodes_i[ci : ci + 2].sum() // 2, nodes_j[cj : cj + 2].sum() // 2
+            shift_x, shift_y = (bins.x[j] + bins.x[j + 1]) / 2, (bins.y[i] + bins.y[i + 1]) / 2
+            # cell centers out of the field of view cast no shadowgram, their model is not finite,
+            # and they are never modeled by the library.
+            with np.errstate(invalid="ignore", divide="ignore"):
+                exact = model_sky(camera, shift_x, shift_y, 1.0, vignetting, psfy)
+            if not np.all(np.isfinite(exact)) or library._interpolate(i, j)[1] <= 0:
+                errors[ci, cj] = np.inf
+                continue
+            _, center = _model_errors(library, shift_x, shift_y, exact)
+            errors[ci, cj] = max(center, np.max(sidelobes[ci : ci + 2, cj : cj + 2]))
+        responses.flush()
+        del library, responses
+        np.save(tmp_path / _PSFLIB_SUMS, sums)
+        np.save(tmp_path / _PSFLIB_ERRORS, errors)
+        with open(tmp_path / _PSFLIB_META, "w") as f:
+            json.dump(
+                {
+                    "camera": _camera_cache_key(camera.mdl.filepath, camera.upscale_f, camera.dtype),
+                    "nodes_i": nodes_i.tolist(),
+                    "nodes_j": nodes_j.tolist(),
+                    "radius": [radius_i, radius_j],
+                    "vignetting": vignetting,
+                    "psfy": psfy,
+                },
+                f,
+            )
+        os.rename(tmp_path, dirpath)
+    except BaseException:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        raise
+    return load_psf_library(camera, dirpath)
+
+
+def load_psf_library(camera: CodedMaskCamera, dirpath: str | Path) -> PSFLibrary:
+    """
+    Opens a library written by `build_psf_library`.
+
+    Args:
+        camera: CodedMaskCamera the library was built for
+        dirpath: Path to the library directory
+
+    Returns:
+        The library, with memory-mapped responses.
+
+    Raises:
+        FileNotFoundError: If the directory does not exist or lacks its files.
+        ValueError: If the library was built for a different mask, upscale, data type or library version.
+    """
+    dirpath = Path(dirpath)
+    if not (dirpath / _PSFLIB_META).is_file():
+        raise FileNotFoundError("The library directory does not exist or lacks its sidecar.")
+    with open(dirpath / _PSFLIB_META) as f:
+        meta = json.load(f)
+    if meta["camera"] != _camera_cache_key(camera.mdl.filepath, camera.upscale_f, camera.dtype):
+        raise ValueError("The library was built for a different camera.")
+    return PSFLibrary(
+        camera=camera,
+        nodes_i=np.array(meta["nodes_i"]),
+        nodes_j=np.array(meta["nodes_j"]),
+        responses=np.load(dirpath / _PSFLIB_RESPONSES, mmap_mode="r"),
+        sums=np.load(dirpath / _PSFLIB_SUMS),
+        errors=np.load(dirpath / _PSFLIB_ERRORS),
+        radius=tuple(meta["radius"]),
+        vignetting=meta["vignetting"],
+        psfy=meta["psfy"],
+    )
+
+
+def check_psf_library(
+    library: PSFLibrary,
+    shifts: npt.NDArray,
+) -> tuple[npt.NDArray, npt.NDArray]:
+    """
+    Compares the library model of unit point sources with `model_sky`.
+
+    Args:
+        library: the library to check
+        shifts: (N, 2) array of (shift_x, shift_y) source positions in sky-shift space (mm)
+
+    Returns:
+        Two arrays of N relative errors. The first is the norm of the difference between the library model
+        and `model_sky` within the library `window` of the source, which the library models, over the norm
+        of `model_sky`. The second is the largest difference over the whole sky, including the sidelobes
+        the library does not model, over the `model_sky` peak. The latter is what `PSFLibrary.error` bounds.
+    """
+    camera = library.camera
+    window_errors, sky_errors = [], []
+    for shift_x, shift_y in np.atleast_2d(shifts):
+        exact = model_sky(camera, shift_x, shift_y, 1.0, library.vignetting, library.psfy)
+        window_error, sky_error = _model_errors(library, shift_x, shift_y, exact)
+        window_errors.append(window_error)
+        sky_errors.append(sky_error)
+    return np.array(window_errors), np.array(sky_errors)
@@ -0,0 +1,910 @@
+"""
+Tests for coded mask imaging with mbloodmoon.
+
+This module provides:
+- mock_mask: Writes a small, random WFM-like mask FITS file
+- mock_simulation: Writes a small, random WFM-like simulation FITS file
+- TestDecode: Tests the reconstruction routines in mbloodmoon/mask.py
+- TestBackend: Tests the backend configuration in mbloodmoon/backend.py
+- TestSimulation: Tests the simulation data loader in mbloodmoon/io.py
+- TestIros: Tests the source optimization and removal routines in mbloodmoon/optim.py
+"""
+
+import json
+from pathlib import Path
+import pickle
+import tempfile
+import threading
+import unittest
+from unittest import mock
+from unittest import TestCase
+import warnings
+
+from astropy.coordinates import angular_separation
+from astropy.io import fits
+import numpy as np
+from scipy import signal
+from scipy.optimize import minimize_scalar
+from scipy.signal import correlate
+from scipy.stats import binned_statistic_2d
+
+from mbloodmoon import backend
+from mbloodmoon import codedmask
+from mbloodmoon import count
+from mbloodmoon import count_cube
+from mbloodmoon import count_stream
+from mbloodmoon import IncrementalReconstructor
+from mbloodmoon import index_events
+from mbloodmoon import iros
+from mbloodmoon import prefetch
+from mbloodmoon import products
+from mbloodmoon import ProductWriter
+from mbloodmoon import simulation
+from mbloodmoon.backend import configure
+from mbloodmoon.backend import get_config
+from mbloodmoon.catalog import CatalogWriter
+from mbloodmoon.catalog import load_catalog
+from mbloodmoon.coords import shift2equatorial
+from mbloodmoon.images import _rbilinear_relative_gradient
+from mbloodmoon.mask import _correlate_sparse
+from mbloodmoon.mask import _decode_window_batch
+from mbloodmoon.mask import _fold
+from mbloodmoon.mask import _is_sparse
+from mbloodmoon.mask import chop
+from mbloodmoon.mask import decode
+from mbloodmoon.mask import decode_batch
+from mbloodmoon.mask import decode_tiled
+from mbloodmoon.mask import decode_window
+from mbloodmoon.mask import encode
+from mbloodmoon.mask import model_shadowgram
+from mbloodmoon.mask import model_sky
+from mbloodmoon.mask import psf
+from mbloodmoon.mask import reconstruct
+from mbloodmoon.mask import shift2pos
+from mbloodmoon.mask import snratio
+from mbloodmoon.mask import variance
+from mbloodmoon.mask import variance_batch
+from mbloodmoon.optim import _blend
+from mbloodmoon.optim import _fluence_lstsq
+from mbloodmoon.optim import _init_model_cached
+from mbloodmoon.optim import _loss
+from mbloodmoon.optim import _loss_jac
+from mbloodmoon.optim import _normalized_components
+from mbloodmoon.optim import component_cache_clear
+from mbloodmoon.optim import component_cache_info
+from mbloodmoon.psflib import build_psf_library
+from mbloodmoon.psflib import check_psf_library
+from mbloodmoon.psflib import load_psf_library
+from mbloodmoon.psflib import PSFLIB_TOLERANCE
+from mbloodmoon.types import BinsRectangular
+from mbloodmoon.types import UpscaleFactor
+
+
+def mock_mask(filepath: str | Path,
+              shape: tuple[int, int] = (12, 40),
+              delta: tuple[float, float] = (4.0, 1.0),
+              seed: int = 0,
+              ) -> Path:
+    """Writes a random mask FITS file with the same layout as the WFM one.
+    The detector plane covers the central half of the mask."""
+    rng = np.random.default_rng(seed)
+    (ny, nx), (dy, dx) = shape, delta
+    minx, miny = -nx * dx / 2, -ny * dy / 2
+    detx, dety = nx * dx / 4, ny * dy / 4
+    xs, ys = np.meshgrid(minx + dx * (np.arange(nx) + 0.5), miny + dy * (np.arange(ny) + 0.5))
+    pattern = (rng.random(xs.shape) < 0.33).astype(float)
+    bulk = ((np.abs(xs) < detx) & (np.abs(ys) < dety)).astype(float)
+
+    header = fits.Header()
+    header.update({"MINX": minx, "MINY": miny, "MAXX": -minx, "MAXY": -miny,
+                   "ELXDIM": dx, "ELYDIM": dy, "MASKTHK": 0.15, "DXSLIT": dx, "DYSLIT": dy,
+                   "PLNXMIN": -detx, "PLNXMAX": detx, "PLNYMIN": -dety, "PLNYMAX": dety,
+                   "MDDIST": 202.9})
+
+    def table(values):
+        return fits.BinTableHDU.from_columns(
+            [fits.Column(name=name, array=a.ravel(), format="D") for name, a in zip("XY", (xs, ys))]
+            + [fits.Column(name="VAL", array=values.ravel(), format="D")]
+        )
+
+    decoder = table(2 * pattern - 1)
+    decoder.header.update({"OPENFR": 0.33, "RLOPENFR": 0.33})
+    hdul = fits.HDUList([fits.PrimaryHDU(header=header), fits.ImageHDU(), table(pattern), decoder, table(bulk)])
+    hdul.writeto(filepath)
+    return Path(filepath)
+
+
+def mock_simulation(filepath: str | Path,
+                    camera,
+                    nevents: int = 1000,
+                    seed: int = 0,
+                    ) -> Path:
+    """Writes a simulation FITS file with photon events uniformly spread over the camera's detector."""
+    rng = np.random.default_rng(seed)
+    bins = camera.bins_detector
+    events = {
+        "X": rng.uniform(bins.x[0], bins.x[-1], nevents),
+        "Y": rng.uniform(bins.y[0], bins.y[-1], nevents),
+        "ENERGY": rng.uniform(2.0, 50.0, nevents),
+        "TIME": np.sort(rng.uniform(0.0, 100.0, nevents)),
+    }
+    table = fits.BinTableHDU.from_columns([fits.Column(name=k, array=v, format="D") for k, v in events.items()])
+    fits.HDUList([fits.PrimaryHDU(), table]).writeto(filepath)
+    return Path(filepath)
+
+
+class TestDecode(TestCase):
+    """Tests the reconstruction routines in mbloodmoon/mask.py."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.TemporaryDirectory()
+        cls.maskpath = mock_mask(Path(cls.tmpdir.name) / "mask.fits")
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmpdir.cleanup()
+
+    def setUp(self):
+        self.camera = codedmask(self.maskpath, upscale_x=3, upscale_y=2)
+        self.detector = np.random.default_rng(1).poisson(2.0, self.camera.detector_shape).astype(float)
+
+    def test_balancing(self):
+        expected = correlate(self.camera.decoder, self.camera.bulk, mode="full")
+        self.assertTrue(np.allclose(self.camera.balancing, expected))
+
+    def test_decode(self):
+        cc = correlate(self.camera.decoder, self.detector, mode="full")
+        expected = cc - self.camera.balancing * self.detector.sum() / self.camera.bulk.sum()
+        self.assertEqual(decode(self.camera, self.detector).shape, self.camera.sky_shape)
+        self.assertTrue(np.allclose(decode(self.camera, self.detector), expected))
+
+    def test_variance(self):
+        cc = correlate(self.camera.decoder, self.detector, mode="full")
+        var = correlate(np.square(self.camera.decoder), self.detector, mode="full")
+        sum_det, sum_bulk = self.detector.sum(), self.camera.bulk.sum()
+        balancing = self.camera.balancing
+        expected = var + np.square(balancing) * sum_det / np.square(sum_bulk) - 2 * cc * balancing / sum_bulk
+        self.assertTrue(np.allclose(variance(self.camera, self.detector), expected))
+
+    def test_decode_window(self):
+        sky = decode(self.camera, self.detector)
+        n, m = self.camera.sky_shape
+        for window in [(0, 3, 0, 5), (n // 2, n // 2 + 4, m // 3, m // 3 + 7), (n - 2, n, m - 9, m), (0, n, 0, m)]:
+            min_i, max_i, min_j, max_j = window
+            expected = sky[min_i:max_i, min_j:max_j]
+            self.assertTrue(np.allclose(decode_window(self.camera, self.detector, window), expected))
+        detectors = np.random.default_rng(4).poisson(2.0, (3, *self.camera.detector_shape)).astype(float)
+        window = (n // 2 - 2, n // 2 + 3, m // 2 - 6, m // 2 + 4)
+        skys = _decode_window_batch(self.camera, detectors, window)
+        for detector, sky in zip(detectors, skys):
+            self.assertTrue(np.allclose(sky, decode_window(self.camera, detector, window)))
+        # direct and FFT correlations agree, whichever the window.
+        for window in [(0, 3, 0, 5), (n // 2, n // 2 + 4, m // 3, m // 3 + 7), (0, n, 0, m)]:
+            with mock.patch("mbloodmoon.mask._DECODE_WINDOW_DIRECT", float("inf")):
+                direct = decode_window(self.camera, self.detector, window)
+            with mock.patch("mbloodmoon.mask._DECODE_WINDOW_DIRECT", 0.0):
+                self.assertTrue(np.allclose(decode_window(self.camera, self.detector, window), direct))
+        with self.assertRaises(ValueError):
+            decode_window(self.camera, self.detector, (0, n + 1, 0, m))
+        with self.assertRaises(ValueError):
+            decode_window(self.camera, self.detector, (2, 2, 0, m))
+
+    def test_decode_tiled(self):
+        sky = decode(self.camera, self.detector)
+        self.assertTrue(np.allclose(decode_tiled(self.camera, self.detector), sky))
+        self.assertTrue(np.allclose(decode_tiled(self.camera, self.detector, max_memory=2**12), sky))
+        out = np.lib.format.open_memmap(
+            Path(self.tmpdir.name) / "sky.npy", mode="w+", dtype=self.camera.dtype, shape=self.camera.sky_shape
+        )
+        self.assertIs(decode_tiled(self.camera, self.detector, max_memory=2**14, out=out), out)
+        self.assertTrue(np.allclose(np.load(Path(self.tmpdir.name) / "sky.npy"), sky))
+        with self.assertRaises(ValueError):
+            decode_tiled(self.camera, self.detector, max_memory=16)
+
+    def test_reconstruct(self):
+        sky, var, snr = reconstruct(self.camera, self.detector)
+        self.assertTrue(np.allclose(sky, decode(self.camera, self.detector)))
+        self.assertTrue(np.allclose(var, variance(self.camera, self.detector)))
+        self.assertTrue(np.allclose(snr, snratio(sky, var)))
+
+    def test_batch(self):
+        detectors = np.random.default_rng(2).poisson(2.0, (4, *self.camera.detector_shape)).astype(float)
+        skys, variances = decode_batch(self.camera, detectors), variance_batch(self.camera, detectors)
+        self.assertEqual(skys.shape, (4, *self.camera.sky_shape))
+        for detector, sky, var in zip(detectors, skys, variances):
+            self.assertTrue(np.allclose(sky, decode(self.camera, detector)))
+            self.assertTrue(np.allclose(var, variance(self.camera, detector)))
+        with self.assertRaises(ValueError):
+            decode_batch(self.camera, self.detector)
+
+    def test_upscale_engine(self):
+        detectors = np.random.default_rng(3).poisson(2.0, (2, *self.camera.detector_shape)).astype(float)
+        skys, variances = decode_batch(self.camera, detectors), variance_batch(self.camera, detectors)
+        camera = codedmask(self.maskpath, upscale_x=3, upscale_y=2)
+        with configure(engine="upscale"):
+            self.assertTrue(np.allclose(camera.balancing, self.camera.balancing))
+            self.assertTrue(np.allclose(decode_batch(camera, detectors), skys))
+            self.assertTrue(np.allclose(variance_batch(camera, detectors), variances))
+        with self.assertRaises(ValueError):
+            with configure(engine="winograd"):
+                pass
+
+    def test_float32(self):
+        camera = codedmask(self.maskpath, upscale_x=3, upscale_y=2, dtype=np.float32)
+        sky, var, snr = reconstruct(camera, self.detector)
+        for a in (camera.decoder, camera.bulk, camera.balancing, sky, var, snr):
+            self.assertEqual(a.dtype, np.float32)
+        scale = np.max(np.abs(decode(self.camera, self.detector)))
+        self.assertTrue(np.allclose(sky, decode(self.camera, self.detector), atol=1e-5 * scale))
+        with self.assertRaises(ValueError):
+            codedmask(self.maskpath, dtype=np.int32)
+
+    def test_sparse(self):
+        detector = np.zeros(self.camera.detector_shape)
+        detector[[0, 3, 3, -1], [0, 5, 6, -1]] = [1.0, 2.0, 1.0, 3.0]
+        self.assertTrue(_is_sparse(self.camera, detector))
+        expected = correlate(self.camera.decoder, detector, mode="full")
+        self.assertTrue(np.allclose(_correlate_sparse(self.camera, detector), expected))
+        products = reconstruct(self.camera, detector)
+        with configure(sparse=0.0):
+            self.assertFalse(_is_sparse(self.camera, detector))
+            self.assertTrue(np.allclose(decode(self.camera, detector), products[0]))
+            self.assertTrue(np.allclose(variance(self.camera, detector), products[1]))
+        self.assertFalse(_is_sparse(self.camera, self.detector))
+
+    def test_cache(self):
+        cache_dir = Path(self.tmpdir.name) / "cache"
+        camera = codedmask(self.maskpath, upscale_x=3, upscale_y=2, cache_dir=cache_dir)
+        self.assertEqual(len(list(cache_dir.iterdir())), 1)
+        cached = codedmask(self.maskpath, upscale_x=3, upscale_y=2, cache_dir=cache_dir)
+        for name in ["mask", "decoder", "bulk", "balancing"]:
+            self.assertIsInstance(cached.__dict__[name], np.memmap)
+            self.assertTrue(np.array_equal(getattr(cached, name), getattr(self.camera, name)))
+        self.assertTrue(np.array_equal(cached.bins_sky.x, camera.bins_sky.x))
+        self.assertEqual(cached.sky_shape, self.camera.sky_shape)
+        for a, b in zip(reconstruct(cached, self.detector), reconstruct(self.camera, self.detector)):
+            self.assertTrue(np.allclose(a, b, equal_nan=True))
+        self.assertTrue(np.allclose(model_shadowgram(cached, 0.3, 1.1, 10.0), model_shadowgram(camera, 0.3, 1.1, 10.0)))
+        codedmask(self.maskpath, upscale_x=2, cache_dir=cache_dir)
+        self.assertEqual(len(list(cache_dir.iterdir())), 2)
+
+    def test_mask_loader(self):
+        camera = codedmask(self.maskpath)
+        mdl = camera.mdl
+        self.assertLess(mdl.bytes_read, Path(self.maskpath).stat().st_size)
+        self.assertIs(mdl.decoder, mdl.decoder)
+        _ = camera.decoder, camera.bulk, camera.mask
+        self.assertEqual(mdl.bytes_read, Path(self.maskpath).stat().st_size)
+
+        # loaders are pickled without their open file, e.g. for multiprocessing.
+        loaded = pickle.loads(pickle.dumps(camera))
+        self.assertEqual(loaded.mdl.bytes_read, 0)
+        self.assertEqual(loaded.mdl.specs, mdl.specs)
+        self.assertTrue(np.array_equal(loaded.mdl.decoder, mdl.decoder))
+        self.assertTrue(np.array_equal(loaded.decoder, camera.decoder))
+
+    def test_fold(self):
+        def fold_reference(ml, bins):
+            return binned_statistic_2d(ml["X"], ml["Y"], ml["VAL"], statistic="max", bins=[bins.x, bins.y])[0].T
+
+        bins = self.camera._bins_mask(UpscaleFactor(1, 1))
+        for ml in (self.camera.mdl.mask, self.camera.mdl.decoder, self.camera.mdl.bulk):
+            self.assertTrue(np.array_equal(_fold(ml, bins), fold_reference(ml, bins), equal_nan=True))
+
+        # scattered records, with repeated bins, empty bins, records on edges and out of range.
+        rng = np.random.default_rng(4)
+        bins = BinsRectangular(x=np.linspace(-3.0, 5.0, 17), y=np.linspace(-1.0, 1.0, 9))
+        x = np.concatenate([rng.uniform(-4.0, 6.0, 300), bins.x, bins.x[::2]])
+        y = np.concatenate([rng.uniform(-1.5, 1.5, 300), np.resize(bins.y, 2 * len(bins.x) - 8)])
+        ml = {"X": x, "Y": y, "VAL": rng.normal(size=len(x))}
+        self.assertTrue(np.array_equal(_fold(ml, bins), fold_reference(ml, bins), equal_nan=True))
+
+    def test_detector_shape(self):
+        with self.assertRaises(ValueError):
+            decode(self.camera, self.detector[:-1])
+
+
+class TestBackend(TestCase):
+    """Tests the backend configuration in mbloodmoon/backend.py."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.TemporaryDirectory()
+        cls.maskpath = mock_mask(Path(cls.tmpdir.name) / "mask.fits")
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmpdir.cleanup()
+
+    def setUp(self):
+        self.camera = codedmask(self.maskpath, upscale_x=2)
+        self.detector = np.random.default_rng(1).poisson(2.0, self.camera.detector_shape).astype(float)
+
+    def test_configure(self):
+        default = get_config()
+        with configure(workers=2, method="direct") as config:
+            self.assertEqual(config["workers"], 2)
+            self.assertEqual(get_config()["method"], "direct")
+        self.assertEqual(get_config(), default)
+        with self.assertRaises(ValueError):
+            with configure(workers=0):
+                pass
+        with self.assertRaises(ValueError):
+            with configure(sparse=-1.0):
+                pass
+        with self.assertRaises(ValueError):
+            with configure(threads=4):
+                pass
+
+        # values set in a thread do not affect the others.
+        entered, released = threading.Event(), threading.Event()
+
+        def configured():
+            with configure(workers=5):
+                entered.set()
+                released.wait()
+
+        thread = threading.Thread(target=configured)
+        thread.start()
+        entered.wait()
+        self.assertEqual(get_config(), default)
+        released.set()
+        thread.join()
+        # prefetch workers run with the values of the thread starting them.
+        seen = []
+
+        def dirpaths():
+            seen.append(get_config()["workers"])
+            yield from ()
+
+        with configure(workers=3):
+            self.assertEqual(list(prefetch(dirpaths(), dataset="detected")), [])
+        self.assertEqual(seen, [3])
+
+    def test_methods(self):
+        sky = np.random.default_rng(2).random(self.camera.sky_shape)
+        expected = (
+            encode(self.camera, sky),
+            psf(self.camera),
+            model_shadowgram(self.camera, 0.3, 1.1, 10.0),
+            decode(self.camera, self.detector),
+        )
+        for workers, method in [(2, "fft"), (-1, "direct"), (1, "auto")]:
+            with configure(workers=workers, method=method):
+                camera = codedmask(self.maskpath, upscale_x=2)
+                results = (
+                    encode(camera, sky),
+                    psf(camera),
+                    model_shadowgram(camera, 0.3, 1.1, 10.0),
+                    decode(camera, self.detector),
+                )
+                for result, target in zip(results, expected):
+                    self.assertTrue(np.allclose(result, target))
+
+    def test_small_kernels(self):
+        rng = np.random.default_rng(3)
+        image = rng.random((12, 30))
+        for shape in [(1, 1), (2, 1), (3, 2), (4, 4), (5, 4)]:
+            kernel = rng.random(shape)
+            for mode in ["full", "same", "valid"]:
+                # kernels up to 16 elements are shifted and added, larger ones go through the FFT.
+                for f, f_scipy in [(backend.convolve, signal.convolve), (backend.correlate, signal.correlate)]:
+                    expected = f_scipy(image, kernel, mode=mode, method="direct")
+                    result = f(image, kernel, mode=mode)
+                    self.assertEqual(result.shape, expected.shape)
+                    self.assertTrue(np.allclose(result, expected))
+
+
+class TestSimulation(TestCase):
+    """Tests the simulation data loader in mbloodmoon/io.py."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.TemporaryDirectory()
+        cls.camera = codedmask(mock_mask(Path(cls.tmpdir.name) / "mask.fits"), upscale_x=2)
+        cls.simpath = mock_simulation(Path(cls.tmpdir.name) / "simulation.fits", cls.camera)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmpdir.cleanup()
+
+    def test_columns(self):
+        sdl, sdl_xy = simulation(self.simpath), simulation(self.simpath, columns=("X", "Y"))
+        self.assertEqual(sdl.nevents, 1000)
+        self.assertEqual(sdl_xy.data.dtype.names, ("X", "Y"))
+        self.assertTrue(np.array_equal(sdl_xy.data["X"], sdl.data["X"]))
+        self.assertTrue(np.array_equal(count(self.camera, sdl_xy.data)[0], count(self.camera, sdl.data)[0]))
+        with self.assertRaises(KeyError):
+            _ = simulation(self.simpath, columns=("X", "PHI")).data
+
+    def test_pickle(self):
+        for sdl in [simulation(self.simpath), simulation(self.simpath, columns=("X", "Y"))]:
+            self.assertEqual(sdl.nevents, 1000)
+            _ = sdl.data
+            loaded = pickle.loads(pickle.dumps(sdl))
+            self.assertNotIn("_hdul", loaded.__dict__)
+            self.assertEqual(loaded.columns, sdl.columns)
+            self.assertTrue(np.array_equal(count(self.camera, loaded.data)[0], count(self.camera, sdl.data)[0]))
+
+    def test_chunks(self):
+        sdl = simulation(self.simpath, columns=("X", "Y"))
+        chunks = list(sdl.chunks(size=300))
+        self.assertEqual([len(c) for c in chunks], [300, 300, 300, 100])
+        self.assertTrue(np.array_equal(np.concatenate([c["Y"] for c in chunks]), sdl.data["Y"]))
+        detector = sum(count(self.camera, c)[0] for c in chunks)
+        self.assertTrue(np.array_equal(detector, count(self.camera, sdl.data)[0]))
+        with self.assertRaises(ValueError):
+            next(sdl.chunks(size=0))
+
+    def test_count_stream(self):
+        bins = self.camera.bins_detector
+        rng = np.random.default_rng(5)
+        x = np.concatenate([rng.uniform(bins.x[0] - 2, bins.x[-1] + 2, 5000), bins.x, [np.nan, bins.x[-1]]])
+        y = np.concatenate([rng.uniform(bins.y[0] - 2, bins.y[-1] + 2, 5000), np.resize(bins.y, len(bins.x)), [0, 0]])
+        events = np.rec.fromarrays([x, y], names=["X", "Y"])
+        expected, *_ = np.histogram2d(y, x, bins=[bins.y, bins.x])
+        detector, detector_bins = count_stream(self.camera, [events[:1234], events[1234:4000], events[4000:]])
+        self.assertTrue(np.array_equal(detector, expected))
+        self.assertTrue(np.array_equal(detector_bins.x, bins.x))
+        self.assertTrue(np.array_equal(count(self.camera, events)[0], expected))
+        sdl = simulation(self.simpath, columns=("X", "Y"))
+        expected, *_ = np.histogram2d(sdl.data["Y"], sdl.data["X"], bins=[bins.y, bins.x])
+        self.assertTrue(np.array_equal(count_stream(self.camera, sdl.chunks(size=256))[0], expected))
+
+    def test_incremental(self):
+        data = simulation(self.simpath).data
+        live = IncrementalReconstructor(self.camera)
+        for start, stop in [(0, 5), (5, 400), (400, 1000)]:
+            live.add_events(data[start:stop])
+            detector = count(self.camera, data[:stop])[0]
+            sky, var, snr = reconstruct(self.camera, detector)
+            self.assertTrue(np.array_equal(live.detector, detector))
+            self.assertTrue(np.allclose(live.sky, sky))
+            self.assertTrue(np.allclose(live.var, var))
+            self.assertTrue(np.allclose(live.snr, snr, equal_nan=True))
+        with self.assertRaises(ValueError):
+            live.add_counts(detector[:-1])
+
+    def test_count_cube(self):
+        data = simulation(self.simpath).data
+        time_edges, energy_edges = np.array([0.0, 10.0, 45.5, 100.0]), np.array([2.0, 5.0, 20.0, 40.0])
+        cube, _ = count_cube(self.camera, data, time_edges, energy_edges)
+        self.assertEqual(cube.shape, (3, 3, *self.camera.detector_shape))
+        for i, (t0, t1) in enumerate(zip(time_edges[:-1], time_edges[1:])):
+            for j, (e0, e1) in enumerate(zip(energy_edges[:-1], energy_edges[1:])):
+                in_time = (data["TIME"] >= t0) & ((data["TIME"] < t1) | ((i == 2) & (data["TIME"] == t1)))
+                in_energy = (data["ENERGY"] >= e0) & ((data["ENERGY"] < e1) | ((j == 2) & (data["ENERGY"] == e1)))
+                self.assertTrue(np.array_equal(cube[i, j], count(self.camera, data[in_time & in_energy])[0]))
+
+        events = index_events(self.camera, data, energy_column=None)
+        cube, _ = count_cube(self.camera, events, time_edges=[20.0, 30.0, 60.0])
+        in_time = (data["TIME"] >= 20.0) & (data["TIME"] < 30.0)
+        self.assertEqual(cube.shape, (2, 1, *self.camera.detector_shape))
+        self.assertTrue(np.array_equal(cube[0, 0], count(self.camera, data[in_time])[0]))
+        skys = decode_batch(self.camera, cube.reshape(-1, *self.camera.detector_shape))
+        self.assertTrue(np.allclose(skys[1], decode(self.camera, cube[1, 0])))
+        with self.assertRaises(ValueError):
+            count_cube(self.camera, events, time_edges=[20.0, 30.0], energy_edges=[2.0, 5.0])
+        with self.assertRaises(ValueError):
+            count_cube(self.camera, events, time_edges=[30.0, 20.0])
+
+    def test_prefetch(self):
+        dirpaths = [Path(self.tmpdir.name) / f"observation{i}" for i in range(3)]
+        for i, dirpath in enumerate(dirpaths):
+            for j, cam in enumerate(["cam1a", "cam1b"]):
+                (dirpath / cam).mkdir(parents=True)
+                for k, name in enumerate(["detected", "reconstructed", "sources"]):
+                    mock_simulation(dirpath / cam / f"{cam}_{name}.fits", self.camera, seed=6 * i + 3 * j + k)
+
+        observations = list(prefetch(dirpaths, self.camera, columns=("X", "Y"), chunksize=300))
+        self.assertEqual([obs.dirpath for obs in observations], dirpaths)
+        for obs in observations:
+            self.assertEqual(obs.loaders[0].filepath.name, "cam1a_reconstructed.fits")
+            for sdl, detector in zip(obs.loaders, obs.detectors):
+                self.assertTrue(np.array_equal(detector, count(self.camera, sdl.data)[0]))
+        obs, *_ = prefetch(dirpaths[:1], dataset="detected")
+        self.assertIsNone(obs.detectors)
+        self.assertEqual(obs.loaders[1].filepath.name, "cam1b_detected.fits")
+
+        # errors are raised when the failing observation is reached, and iterating can stop early.
+        loader = prefetch([dirpaths[0], Path(self.tmpdir.name) / "missing", dirpaths[1]], self.camera)
+        self.assertEqual(next(loader).dirpath, dirpaths[0])
+        with self.assertRaises(ValueError):
+            next(loader)
+        loader = prefetch(dirpaths, self.camera)
+        next(loader)
+        loader.close()
+
+    def test_products(self):
+        dirpath = Path(self.tmpdir.name) / "products"
+        sky, var, _ = reconstruct(self.camera, count(self.camera, simulation(self.simpath).data)[0])
+        residuals = [sky - model_sky(self.camera, 5.0 * i, -2.0 * i, 10.0 * i) for i in range(3)]
+        writer = ProductWriter(dirpath, self.camera, metadata={"dataset": "reconstructed"})
+        writer.write("sky", sky)
+        writer.write("variance", var)
+        writer.write_delta("residual_0", residuals[0], reference="sky")
+        writer.write_delta("residual_1", residuals[1], reference="sky")
+        writer.write_delta("residual_2", residuals[2], reference="residual_1")
+        with self.assertRaises(ValueError):
+            writer.write_delta("residual_3", residuals[2], reference="residual_9")
+        with self.assertRaises(ValueError):
+            writer.write_delta("residual_3", residuals[2][:-1], reference="sky")
+        # referenced products cannot be overwritten, unreferenced ones can.
+        with self.assertRaises(ValueError):
+            writer.write("sky", var)
+        with self.assertRaises(ValueError):
+            writer.write_delta("residual_1", residuals[0], reference="sky")
+        with self.assertRaises(ValueError):
+            writer.write_delta("residual_2", residuals[2], reference="residual_2")
+        writer.write("variance", var)
+
+        loader = products(dirpath)
+        self.assertEqual(loader.names, ("sky", "variance", "residual_0", "residual_1", "residual_2"))
+        self.assertIsInstance(loader["sky"], np.memmap)
+        self.assertTrue(np.array_equal(loader["variance"], var))
+        for i, residual in enumerate(residuals):
+            self.assertTrue(np.array_equal(loader[f"residual_{i}"], residual))
+        self.assertTrue(np.array_equal(loader.bins.x, self.camera.bins_sky.x))
+        self.assertEqual(loader.camera["upscale"], [2, 1])
+        self.assertEqual(loader.metadata, {"dataset": "reconstructed"})
+
+        # appending to the directory, with downcast products.
+        with self.assertRaises(ValueError):
+            ProductWriter(dirpath, dtype=np.float16).write_delta("residual_3", residuals[2], reference="sky")
+        writer = ProductWriter(dirpath, dtype=np.float16)
+        writer.write("sky16", sky)
+        writer.write_delta("residual16", residuals[1], reference="sky16")
+        loader = products(dirpath)
+        self.assertTrue(np.array_equal(loader["residual16"], residuals[1].astype(np.float16)))
+        self.assertEqual(loader.names[0], "sky")
+        with self.assertRaises(FileNotFoundError):
+            products(Path(self.tmpdir.name) / "missing")
+
+    def test_catalog(self):
+        sdls = []
+        for k, (ra_x, dec_x) in enumerate([(40.0, 0.0), (30.0, 10.0)]):
+            filepath = mock_simulation(Path(self.tmpdir.name) / f"catalog_{k}.fits", self.camera, seed=k)
+            for key, value in {"CAMZRA": 30.0, "CAMZDEC": -80.0, "CAMXRA": ra_x, "CAMXDEC": dec_x}.items():
+                fits.setval(filepath, key, value=value)
+            sdls.append(simulation(filepath))
+        skys, variances, _ = zip(*(reconstruct(self.camera, count(self.camera, sdl.data)[0]) for sdl in sdls))
+        bins = self.camera.bins_sky
+        sources = [((bins.x[10 + i], bins.y[5], 50.0 + i), (bins.x[20], bins.y[8 - i], 60.0)) for i in range(5)]
+
+        filepath = Path(self.tmpdir.name) / "catalog.fits"
+        residuals = skys
+        with self.assertRaises(RuntimeError):
+            with CatalogWriter(filepath, self.camera, sdls, skys, variances, flush_every=2) as catalog:
+                for i, iteration_sources in enumerate(sources):
+                    if i == 3:
+                        raise RuntimeError("Optimizer failed.")
+                    previous = residuals
+                    residuals = [r - model_sky(self.camera, *s) for r, s in zip(previous, iteration_sources)]
+                    catalog.append(iteration_sources, residuals)
+        with fits.open(filepath) as hdul:
+            self.assertEqual([hdu.name for hdu in hdul], ["PRIMARY", "CATALOG", "CATALOG"])
+            self.assertEqual(hdul[0].header["UPSCALEX"], 2)
+
+        rows = load_catalog(filepath)
+        self.assertEqual(len(rows), 6)
+        self.assertEqual(list(rows["ITERATION"]), [0, 0, 1, 1, 2, 2])
+        self.assertEqual(list(rows["CAMERA"].astype(str)), ["cam1a", "cam1b"] * 3)
+        self.assertEqual((rows["PIX_I"][4], rows["PIX_J"][4]), (5, 12))
+        self.assertAlmostEqual(rows["FLUENCE"][4], 52.0)
+        ra, dec = shift2equatorial(sdls[1], self.camera, bins.x[20], bins.y[6])
+        self.assertAlmostEqual(rows["RA"][5], ra)
+        self.assertAlmostEqual(rows["DEC"][5], dec)
+        self.assertAlmostEqual(rows["SNR"][5], previous[1][6, 20] / np.sqrt(max(variances[1][6, 20], 1.0)))
+        (min_i, max_i, min_j, max_j), _ = chop(self.camera, (5, 12))
+        self.assertAlmostEqual(rows["FIT_MSE"][4], np.mean(np.square(residuals[0][min_i:max_i, min_j:max_j])))
+        with self.assertRaises(OSError):
+            CatalogWriter(filepath, self.camera, sdls, skys, variances)
+
+
+class TestIros(TestCase):
+    """Tests the source optimization and removal routines in mbloodmoon/optim.py."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.TemporaryDirectory()
+        cls.camera = codedmask(mock_mask(Path(cls.tmpdir.name) / "mask.fits"), upscale_x=2)
+        # the two cameras share the optical axis, with x axes 90 degrees apart.
+        cls.sdls = []
+        for k, phi_x in enumerate([0.0, 90.0]):
+            filepath = mock_simulation(Path(cls.tmpdir.name) / f"simulation_{k}.fits", cls.camera, seed=k)
+            header = {"CAMZPH": 0.0, "CAMZTH": 0.0, "CAMXPH": phi_x, "CAMXTH": 90.0}
+            header |= {"CAMZRA": 30.0, "CAMZDEC": -80.0, "CAMXRA": 30.0 + phi_x, "CAMXDEC": 0.0}
+            for key, value in header.items():
+                fits.setval(filepath, key, value=value)
+            cls.sdls.append(simulation(filepath))
+        # a bright source on axis, over a flat background.
+        rng = np.random.default_rng(3)
+        shadowgram = model_shadowgram(cls.camera, 0.0, 0.0, 500.0, vignetting=False, psfy=False)
+        cls.detectors = tuple(rng.poisson(1.0 + shadowgram).astype(float) for _ in range(2))
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmpdir.cleanup()
+
+    def test_fluence(self):
+        sky, _, _ = reconstruct(self.camera, self.detectors[0])
+        shift_x, shift_y = 0.3, 0.2
+        window, _ = chop(self.camera, shift2pos(self.camera, shift_x, shift_y))
+        loss = _loss(lambda x, y, fluence: model_sky(self.camera, x, y, fluence, vignetting=False, psfy=False))
+        fluence = _fluence_lstsq(self.camera, sky, shift_x, shift_y, (0.0, 1e4), vignetting=False, psfy=False)
+        expected = minimize_scalar(
+            lambda f: loss((shift_x, shift_y, f), sky, self.camera), bounds=(0.0, 1e4), options={"xatol": 1e-8}
+        )
+        self.assertAlmostEqual(fluence, expected.x, places=5)
+        self.assertEqual(_fluence_lstsq(self.camera, sky, shift_x, shift_y, (0.0, 0.5 * fluence)), 0.5 * fluence)
+
+        # weights only matter relative to each other.
+        min_i, max_i, min_j, max_j = window
+        weights = np.random.default_rng(4).uniform(0.5, 2.0, (max_i - min_i, max_j - min_j))
+        weighted = _fluence_lstsq(self.camera, sky, shift_x, shift_y, (0.0, 1e4), weights=weights)
+        rescaled = _fluence_lstsq(self.camera, sky, shift_x, shift_y, (0.0, 1e4), weights=3 * weights)
+        self.assertAlmostEqual(rescaled, weighted)
+
+    def test_loss_jac(self):
+        sky, _, _ = reconstruct(self.camera, self.detectors[0])
+        step_x, step_y = np.diff(self.camera.bins_sky.x[:2])[0], np.diff(self.camera.bins_sky.y[:2])[0]
+        model_cached = _init_model_cached(
+            self.camera, (-3.0 * step_x, 1.0 * step_x), (-1.0 * step_y, 2.0 * step_y), vignetting=False, psfy=False
+        )
+
+        def model_f(shift_x, shift_y, fluence):
+            # `_loss` reads the model over the `chop` window of the source, the only part the cached model computes.
+            (min_i, max_i, min_j, max_j), _ = chop(self.camera, shift2pos(self.camera, shift_x, shift_y))
+            model = np.zeros(self.camera.sky_shape)
+            model[min_i:max_i, min_j:max_j] = model_cached(
+                shift_x, shift_y, fluence, window=(min_i, max_i, min_j, max_j)
+            )
+            return model
+
+        loss, loss_jac = _loss(model_f), _loss_jac(model_cached)
+        for args in [(0.3 * step_x, 0.2 * step_y, 400.0), (-2.6 * step_x, 1.1 * step_y, 150.0)]:
+            value, grad = loss_jac(np.array(args), sky, self.camera)
+            self.assertAlmostEqual(value, loss(np.array(args), sky, self.camera))
+            # central differences, with steps small enough not to cross bin midpoints.
+            for k, h in enumerate([1e-4 * step_x, 1e-4 * step_y, 1e-3]):
+                dargs = np.eye(3)[k] * h
+                expected = (loss(args + dargs, sky, self.camera) - loss(args - dargs, sky, self.camera)) / (2 * h)
+                self.assertTrue(np.isclose(grad[k], expected, rtol=1e-4, atol=1e-6 * abs(value)))
+
+    def test_model_cached(self):
+        bins = self.camera.bins_sky
+        step_x, step_y = np.diff(bins.x[:2])[0], np.diff(bins.y[:2])[0]
+        bounds_x, bounds_y = (-2.5 * step_x, 1.5 * step_x), (-0.5 * step_y, 0.5 * step_y)
+        model_cached = _init_model_cached(self.camera, bounds_x, bounds_y)
+        for shift_x, shift_y in [(0.3 * step_x, 0.2 * step_y), (-2.4 * step_x, -0.4 * step_y), (1.4 * step_x, 0.0)]:
+            window, _ = chop(self.camera, shift2pos(self.camera, shift_x, shift_y))
+            model, model_jac = model_cached(shift_x, shift_y, 300.0, jac=True, window=window)
+            # the same components, decoded over the whole sky.
+            weights, grad_x, grad_y, pivot = _rbilinear_relative_gradient(shift_x, shift_y, bins.x, bins.y)
+            min_i, max_i, min_j, max_j = window
+            components = tuple(
+                decode(self.camera, c)[min_i:max_i, min_j:max_j]
+                for c in _normalized_components(self.camera, pivot, tuple(weights))
+            )
+            expected, expected_jac = _blend(components, 300.0, weights, grad_x, grad_y)
+            self.assertTrue(np.allclose(model, expected))
+            for dm, expected_dm in zip(model_jac, expected_jac):
+                self.assertTrue(np.allclose(dm, expected_dm))
+        with self.assertRaises(ValueError):
+            model_cached(5.5 * step_x, 0.0, 300.0)
+
+    def test_components_edge(self):
+        # on the last row and column of the sky, the components past the pivot are out of the sky.
+        n, m = self.camera.sky_shape
+        positions = ((0, 0), (0, 1), (1, 0), (1, 1), (-1, -1))
+        with np.errstate(all="raise"):
+            components = _normalized_components(self.camera, (n - 1, m - 1), positions, False, False)
+        self.assertTrue(np.all(np.isfinite(components)))
+        self.assertTrue(np.allclose(np.sum(components, axis=(1, 2)), [1.0, 0.0, 0.0, 0.0, 1.0]))
+
+    def test_component_cache(self):
+        component_cache_clear()
+        step_x, step_y = np.diff(self.camera.bins_sky.x[:2])[0], np.diff(self.camera.bins_sky.y[:2])[0]
+        bounds_x, bounds_y = (-2.5 * step_x, 2.5 * step_x), (-0.5 * step_y, 0.5 * step_y)
+        model = _init_model_cached(self.camera, bounds_x, bounds_y)
+        expected = model(0.3 * step_x, 0.2 * step_y, 300.0)
+        self.assertEqual(component_cache_info()["misses"], 1)
+        # the cache is shared across models, e.g. across `optimize` calls.
+        model = _init_model_cached(self.camera, bounds_x, bounds_y)
+        self.assertTrue(np.array_equal(model(0.3 * step_x, 0.2 * step_y, 300.0), expected))
+        info = component_cache_info()
+        self.assertEqual((info["hits"], info["misses"], info["entries"]), (1, 1, 1))
+
+        # values are evicted least recently used first, to stay within the memory budget.
+        with configure(cache_bytes=info["nbytes"]):
+            model(-1.0 * step_x, 0.0, 300.0)
+            info = component_cache_info()
+            self.assertEqual((info["evictions"], info["entries"]), (1, 1))
+            self.assertLessEqual(info["nbytes"], info["max_bytes"])
+        # values larger than the budget are not cached, and do not evict the others.
+        with configure(cache_bytes=info["nbytes"] - 1):
+            self.assertTrue(np.array_equal(model(0.3 * step_x, 0.2 * step_y, 300.0), expected))
+            info = component_cache_info()
+            self.assertEqual((info["misses"], info["evictions"], info["entries"]), (3, 1, 1))
+            model(-1.0 * step_x, 0.0, 300.0)
+            self.assertEqual(component_cache_info()["hits"], info["hits"] + 1)
+        component_cache_clear()
+        self.assertEqual(component_cache_info()["misses"], 0)
+
+    def run_iros(self, **kwargs) -> list:
+        return list(iros(self.camera, *self.sdls, 3, dataset="detected", detectors=self.detectors, **kwargs))
+
+    def test_checkpoint(self):
+        with warnings.catch_warnings():
+            warnings.simplefilter("error", DeprecationWarning)
+            expected = self.run_iros()
+        self.assertEqual(len(expected), 3)
+        self.assertTrue(all(np.hypot(*s[:2]) < 1.0 for s in expected[0][0]))
+
+        checkpoint_dir = Path(self.tmpdir.name) / "checkpoint"
+        loop = iros(
+            self.camera, *self.sdls, 3, dataset="detected", detectors=self.detectors, checkpoint_dir=checkpoint_dir
+        )
+        next(loop)
+        loop.close()
+        # resuming needs no detectors, skies and variances are read from the checkpoint.
+        resumed = list(iros(self.camera, *self.sdls, 3, dataset="detected", checkpoint_dir=checkpoint_dir, resume=True))
+        self.assertEqual(len(resumed), 2)
+        for (sources, residuals), (expected_sources, expected_residuals) in zip(resumed, expected[1:]):
+            self.assertEqual(sources, expected_sources)
+            self.assertTrue(all(np.array_equal(r, e) for r, e in zip(residuals, expected_residuals)))
+        with open(checkpoint_dir / "state.json") as f:
+            state = json.load(f)
+        self.assertEqual(state["iteration"], 3)
+        self.assertEqual([tuple(map(tuple, s)) for s in state["sources"]], [s for s, _ in expected])
+        self.assertEqual(self.run_iros(checkpoint_dir=checkpoint_dir, resume=True), [])
+        # runs with other settings do not resume the checkpoint.
+        with self.assertRaises(ValueError):
+            self.run_iros(checkpoint_dir=checkpoint_dir, resume=True, snr_threshold=1.0)
+        camera = codedmask(self.camera.mdl.filepath, upscale_x=2, dtype=np.float32)
+        with self.assertRaises(ValueError):
+            list(iros(camera, *self.sdls, 3, dataset="detected", checkpoint_dir=checkpoint_dir, resume=True))
+        # arrays and state are written to temporary files, all renamed into place.
+        self.assertEqual([p.name for p in checkpoint_dir.iterdir() if p.name.startswith(".")], [])
+
+        with self.assertRaises(ValueError):
+            next(iros(self.camera, *self.sdls, 3, dataset="reconstructed", checkpoint_dir=checkpoint_dir, resume=True))
+        with self.assertRaises(ValueError):
+            next(iros(self.camera, *self.sdls, 3, resume=True))
+        # a new run overwrites the checkpoint.
+        self.assertEqual(len(self.run_iros(checkpoint_dir=checkpoint_dir)), 3)
+
+    def test_swapped_cameras(self):
+        loaders, detectors = self.sdls[::-1], self.detectors[::-1]
+        expected = list(iros(self.camera, *loaders, 3, dataset="detected", detectors=detectors))
+        # a negative separation of the x axes swaps the cameras, which then run in the order above.
+        with mock.patch("astropy.coordinates.angular_separation", side_effect=lambda *a: -angular_separation(*a)):
+            swapped = self.run_iros()
+        # residuals are yielded in the order of the loaders, together with their sources.
+        for (sources, residuals), (expected_sources, expected_residuals) in zip(swapped, expected, strict=True):
+            self.assertEqual(sources, expected_sources[::-1])
+            self.assertTrue(all(np.array_equal(r, e) for r, e in zip(residuals, expected_residuals[::-1])))
+
+    def test_iros_catalog(self):
+        filepath = Path(self.tmpdir.name) / "iros_catalog.fits"
+        with CatalogWriter(filepath, self.camera, tuple(self.sdls)) as catalog:
+            with self.assertRaises(ValueError):
+                catalog.append(((0.0, 0.0, 1.0), (0.0, 0.0, 1.0)), self.detectors)
+            results = self.run_iros(on_reconstruct=catalog.start)
+            self.assertEqual(catalog.iteration, 0)
+            for sources, residuals in results:
+                catalog.append(sources, residuals)
+        rows = load_catalog(filepath)
+        self.assertEqual(len(rows), 2 * len(results))
+        # the SNR column is computed from the skys and variances reconstructed by `iros`.
+        sky, var, _ = reconstruct(self.camera, self.detectors[0])
+        i, j = rows["PIX_I"][0], rows["PIX_J"][0]
+        self.assertAlmostEqual(rows["SNR"][0], sky[i, j] / np.sqrt(max(var[i, j], 1.0)))
+
+    def test_catalog_resume(self):
+        expected_path, filepath = Path(self.tmpdir.name) / "expected.fits", Path(self.tmpdir.name) / "resumed.fits"
+        checkpoint_dir = Path(self.tmpdir.name) / "catalog_checkpoint"
+        with CatalogWriter(expected_path, self.camera, tuple(self.sdls)) as catalog:
+            for sources, residuals in self.run_iros(on_reconstruct=catalog.start):
+                catalog.append(sources, residuals)
+
+        with CatalogWriter(filepath, self.camera, tuple(self.sdls)) as catalog:
+            loop = iros(
+                self.camera,
+                *self.sdls,
+                3,
+                dataset="detected",
+                detectors=self.detectors,
+                checkpoint_dir=checkpoint_dir,
+                on_reconstruct=catalog.start,
+            )
+            catalog.append(*next(loop))
+            loop.close()
+        with self.assertRaises(OSError):
+            CatalogWriter(filepath, self.camera, tuple(self.sdls))
+        with self.assertRaises(ValueError):
+            CatalogWriter(filepath, codedmask(self.camera.mdl.filepath, upscale_x=3), tuple(self.sdls), resume=True)
+        # iterations are numbered after the last one, and skys are the checkpointed residuals.
+        with CatalogWriter(filepath, self.camera, tuple(self.sdls), resume=True) as catalog:
+            self.assertEqual(catalog.iteration, 1)
+            for sources, residuals in iros(
+                self.camera,
+                *self.sdls,
+                3,
+                dataset="detected",
+                checkpoint_dir=checkpoint_dir,
+                resume=True,
+                on_reconstruct=catalog.start,
+            ):
+                catalog.append(sources, residuals)
+        rows, expected = load_catalog(filepath), load_catalog(expected_path)
+        self.assertEqual(list(rows["ITERATION"]), [0, 0, 1, 1, 2, 2])
+        for name in expected.dtype.names:
+            self.assertTrue(np.array_equal(rows[name], expected[name]))
+        # a catalog resumed before any table was flushed starts from the first iteration.
+        with CatalogWriter(Path(self.tmpdir.name) / "empty.fits", self.camera, tuple(self.sdls), resume=True):
+            pass
+        catalog = CatalogWriter(Path(self.tmpdir.name) / "empty.fits", self.camera, tuple(self.sdls), resume=True)
+        self.assertEqual(catalog.iteration, 0)
+
+    def test_psf_library(self):
+        bins = self.camera.bins_sky
+        rng = np.random.default_rng(5)
+        shifts = np.column_stack([rng.uniform(bins.x[0], bins.x[-1], 40), rng.uniform(bins.y[0], bins.y[-1], 40)])
+        nodes = np.array(
+            [((bins.x[j] + bins.x[j + 1]) / 2, (bins.y[i] + bins.y[i + 1]) / 2) for i, j in [(8, 60), (2, 4)]]
+        )
+        dirpath = Path(self.tmpdir.name) / "psflib"
+        library = build_psf_library(self.camera, dirpath, vignetting=False, psfy=False)
+        # a node every slit, windows of four slits on each side.
+        self.assertEqual(library.responses.shape, (17, 60, 9, 17))
+        self.assertEqual(library.errors.shape, (16, 59))
+        window_errors, _ = check_psf_library(library, nodes)
+        self.assertTrue(np.all(window_errors < 1e-8))
+        # whole-sky errors, sidelobes included, are measured over the grid cells and hold between samples.
+        shifts = np.array([shift for shift in shifts if np.isfinite(library.error(*shift))])
+        errors = np.array([library.error(*shift) for shift in shifts])
+        _, sky_errors = check_psf_library(library, shifts)
+        self.assertGreater(len(shifts), 20)
+        self.assertTrue(np.all(sky_errors <= 1.1 * errors))
+        # nodes out of the field of view do not contribute, rather than halving the responses around them.
+        self.assertEqual(library.sums[0, 0], 0.0)
+        with self.assertRaises(ValueError):
+            library.model_sky((bins.x[0] + bins.x[1]) / 2, (bins.y[0] + bins.y[1]) / 2, 1.0)
+
+        loaded = load_psf_library(self.camera, dirpath)
+        self.assertTrue(np.array_equal(loaded.responses, library.responses))
+        self.assertTrue(np.array_equal(loaded.errors, library.errors))
+        self.assertTrue(np.allclose(loaded.model_sky(0.3, 1.7, 10.0), library.model_sky(0.3, 1.7, 10.0)))
+        with self.assertRaises(ValueError):
+            load_psf_library(codedmask(self.camera.mdl.filepath, upscale_x=3), dirpath)
+        with self.assertRaises(FileNotFoundError):
+            load_psf_library(self.camera, Path(self.tmpdir.name) / "missing")
+        with self.assertRaises(OSError):
+            build_psf_library(self.camera, dirpath, stride=(2, 4))
+
+        # sources out of tolerance are removed with model_sky.
+        expected = self.run_iros()
+        for (sources, residuals), (expected_sources, expected_residuals) in zip(
+            self.run_iros(psf_library=library, psf_tolerance=0.0), expected, strict=True
+        ):
+            self.assertEqual(sources, expected_sources)
+            self.assertTrue(all(np.array_equal(r, e) for r, e in zip(residuals, expected_residuals)))
+        results = self.run_iros(psf_library=library, psf_tolerance=np.inf)
+        self.assertEqual(results[0][0], expected[0][0])
+        # the first sources are found before any removal, and removed with the library model instead.
+        for source, residual, expected_residual in zip(*results[0], expected[0][1]):
+            difference = model_sky(self.camera, *source, vignetting=False, psfy=False) - library.model_sky(*source)
+            self.assertTrue(np.allclose(residual - expected_residual, difference))
+        # detected data are modeled without vignetting.
+        with self.assertRaises(ValueError):
+            vignetted = build_psf_library(self.camera, Path(self.tmpdir.name) / "psflib_vignetted", stride=(16, 118))
+            self.run_iros(psf_library=vignetted)
+
+
+if __name__ == "__main__":
+    unittest.main()
+
+
+# end